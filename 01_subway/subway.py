@@ -9,52 +9,67 @@
 import csv
 import json
 import math
+import numpy as np
 import os
 import random
 import re
+import sys
 import time
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import activation
+import jitter
+import report
+import sample_schedule
+import sequence_file
+import sequencer
+import table_cache
+import timeline
+import tracing
+import visualization_file
+import voices
+from sequence_buffer import SequenceBuffer
+
 # Config
 BPM = 120 # Beats per minute, e.g. 60, 75, 100, 120, 150
 METERS_PER_BEAT = 75 # Higher numbers creates shorter songs
 DIVISIONS_PER_BEAT = 4 # e.g. 4 = quarter notes, 8 = eighth notes
 VARIANCE_MS = 20 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER_STREAMS = 'global' # 'global' keeps the jitter of earlier builds, 'instrument' gives each instrument its own reproducible jitter stream
 VARIANCE_RATE = 0 # for adding variance to the playback rate
 INSTRUMENTS_INPUT_FILE = 'data/instruments.csv'
 STATIONS_INPUT_FILE = 'data/stations.csv'
 REPORT_SUMMARY_OUTPUT_FILE = 'data/report_summary.csv'
 REPORT_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
+SCHEDULE_OUTPUT_FILE = 'data/ck_schedule.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+BINARY_SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.cks'
+TRACE_OUTPUT_FILE = 'data/trace.json'
 STATIONS_VISUALIZATION_OUTPUT_FILE = 'visualization/stations/data/stations.json'
 MAP_VISUALIZATION_OUTPUT_FILE = 'visualization/map/data/stations.json'
 INSTRUMENTS_DIR = 'instruments/'
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'csv' # 'csv' or 'binary' (a compact .cks file that loads faster in ChucK)
+SIZE_BUFFERS = False # give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers
+SCHEDULE_SAMPLES = False # load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts
 WRITE_REPORT = True
 WRITE_JSON = True
+VISUALIZATION_FORMAT = 'json' # 'json' or 'chunked' (gzipped columns in windows of time with an index, so a visualization can load as it plays)
+WRITE_TRACE = False # write a Chrome trace of where the build's time and memory go (open it in chrome://tracing or ui.perfetto.dev)
 
 # Calculations
 BEAT_MS = round(60.0 / BPM * 1000)
-ROUND_TO_NEAREST = round(BEAT_MS/DIVISIONS_PER_BEAT)
+ROUND_TO_NEAREST = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # ms of a tick, the grid beats are laid out on
 
 print('Building sequence at '+str(BPM)+' BPM ('+str(BEAT_MS)+'ms per beat)')
 
 # Initialize Variables
 instruments = []
 stations = []
-sequence = []
-hindex = 0
-
-# For creating pseudo-random numbers
-def halton(index, base):
-	result = 0.0
-	f = 1.0 / base
-	i = 1.0 * index
-	while(i > 0):
-		result += f * (i % base)  
-		i = math.floor(i / base)
-		f = f / base
-	return result
+sequence = SequenceBuffer(['rate'])
+jitter_streams = {}
 
 # Find index of first item that matches value
 def findInList(list, key, value):
@@ -65,12 +80,12 @@ def findInList(list, key, value):
 			break
 	return found
 
-def roundToNearest(n, nearest):
-	return 1.0 * round(1.0*n/nearest) * nearest
-
+if WRITE_TRACE:
+	tracing.start(TRACE_OUTPUT_FILE)
+tracing.phase('load')
 # Read instruments from file
 with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter='\t')
+	r = table_cache.reader(f, delimiter='\t')
 	next(r, None) # remove header
 	for name,type,price,bracket_min,bracket_max,file,from_gain,to_gain,from_tempo,to_tempo,gain_phase,tempo_phase,tempo_offset,interval_phase,interval,interval_offset,active in r:
 		if file and int(active):
@@ -101,25 +116,23 @@ with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
 			instruments.append(instrument)
 
 # Read stations from file
-with open(STATIONS_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter='\t')
-	next(r, None) # remove header
-	for name,income_annual,income,lat,lng,borough in r:
-		index = len(stations)
-		stations.append({
-			'index': index,
-			'name': name,
-			'budget': float(re.sub(r'[\$|,]', '', income)),
-			'percentile': 0.0,
-			'lat': float(lat),
-			'lng': float(lng),
-			'beats': 0,
-			'distance': 0,
-			'duration': 0,
-			'borough': borough,
-			'borough_next': borough,
-			'instruments': []
-		})
+columns = table_cache.readColumns(STATIONS_INPUT_FILE, delimiter='\t')
+for name,income_annual,income,lat,lng,borough in table_cache.getRows(columns, [('Station Name', str), ('Median Income 2011', None), ('Month Income', str), ('Latitude', float), ('Longitude', float), ('Borough', str)]):
+	index = len(stations)
+	stations.append({
+		'index': index,
+		'name': name,
+		'budget': float(re.sub(r'[\$|,]', '', income)),
+		'percentile': 0.0,
+		'lat': lat,
+		'lng': lng,
+		'beats': 0,
+		'distance': 0,
+		'duration': 0,
+		'borough': borough,
+		'borough_next': borough,
+		'instruments': []
+	})
 
 # For calculating distance between two coords(lat, lng)
 def distBetweenCoords(lat1, lng1, lat2, lng2):
@@ -139,24 +152,23 @@ def getIncomePercentile(station, sorted_station_list):
 	return percentile
 
 # Buy instruments based on a specified budget
-def buyInstruments(station, instruments_shelf):
-	budget = station['budget']
-	percentile = station['percentile']
-	instruments_cart = []
-	for i in instruments_shelf:
-		# skip if not in bracket
-		if percentile < i['bracket_min'] or percentile >= i['bracket_max']:
-			continue
-		# add to cart if in budget
-		elif i['price'] < budget:
-			budget -= i['price']
-			if i['type'] != 'placeholder':
-				instruments_cart.append(i)
-		# out of budget, finished
-		else:
-			break
-	return instruments_cart
-
+# Returns an instruments x stations mask of the instruments each station buys
+def buyInstruments(stations, instruments_shelf):
+	# skip if not in bracket
+	percentiles = activation.getColumns(stations, ['percentile'])
+	in_bracket = activation.getMask(activation.getColumns(instruments_shelf, ['bracket_min']), activation.getColumns(instruments_shelf, ['bracket_max']), percentiles)
+	# add to cart if in budget, spending the budget on each instrument in bracket in order
+	prices = np.array([i['price'] for i in instruments_shelf], dtype=np.float64)[:, np.newaxis]
+	budgets = np.array([s['budget'] for s in stations], dtype=np.float64)[np.newaxis, :]
+	spending = np.concatenate((budgets, np.where(in_bracket, prices, 0.0)))
+	budgets_left = np.subtract.accumulate(spending, axis=0)[:-1]
+	# out of budget, finished
+	out_of_budget = np.cumsum(in_bracket & (prices >= budgets_left), axis=0) > 0
+	placeholders = np.array([i['type'] == 'placeholder' for i in instruments_shelf])[:, np.newaxis]
+	return in_bracket & ~out_of_budget & ~placeholders
+
+tracing.phase('normalize')
+tracing.count(len(stations))
 # Pre-process stations
 min_distance = 0
 max_distance = 0
@@ -174,8 +186,6 @@ sorted_stations = sorted(sorted_stations, key=lambda k: k['budget'])
 for index, station in enumerate(stations):
 	# determine station's income percentile
 	stations[index]['percentile'] = getIncomePercentile(station, sorted_stations)
-	# determine the station's instruments based on budget
-	stations[index]['instruments'] = buyInstruments(stations[index], instruments)
 	if index > 0:
 		# determine distance between last station
 		distance = distBetweenCoords(station['lat'], station['lng'], stations[index-1]['lat'], stations[index-1]['lng'])
@@ -195,6 +205,12 @@ for index, station in enumerate(stations):
 			min_distance = distance
 			min_duration = duration
 
+tracing.phase('match instruments')
+# Determine each station's instruments based on budget
+station_instruments = buyInstruments(stations, instruments)
+for index, station in enumerate(stations):
+	stations[index]['instruments'] = [instruments[i] for i in np.flatnonzero(station_instruments[:, index])]
+
 # Calculate how many beats
 station_count = len(stations)-1
 total_seconds = int(1.0*total_ms/1000)
@@ -207,46 +223,6 @@ print('Average time per station: '+time.strftime('%M:%S', time.gmtime(seconds_pe
 print('Main sequence beats: '+str(total_beats))
 print('Main sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds)) + '(' + str(total_seconds) + 's)')
 
-# Multiplier based on sine curve
-def getMultiplier(percent_complete):
-	radians = percent_complete * math.pi
-	multiplier = math.sin(radians)
-	if multiplier < 0:
-		multiplier = 0.0
-	elif multiplier > 1:
-		multplier = 1.0
-	return multiplier
-
-# Retrieve gain based on current beat
-def getGain(instrument, beat):
-	beats_per_phase = instrument['gain_phase']
-	percent_complete = float(beat % beats_per_phase) / beats_per_phase
-	multiplier = getMultiplier(percent_complete)
-	from_gain = instrument['from_gain']
-	to_gain = instrument['to_gain']
-	min_gain = min(from_gain, to_gain)
-	gain = multiplier * (to_gain - from_gain) + from_gain
-	gain = max(min_gain, round(gain, 2))
-	return gain
-
-# Get beat duration in ms based on current point in time
-def getBeatMs(instrument, beat, round_to):	
-	from_beat_ms = instrument['from_beat_ms']
-	to_beat_ms = instrument['to_beat_ms']
-	beats_per_phase = instrument['tempo_phase']
-	percent_complete = float(beat % beats_per_phase) / beats_per_phase
-	multiplier = getMultiplier(percent_complete)
-	ms = multiplier * (to_beat_ms - from_beat_ms) + from_beat_ms
-	ms = int(roundToNearest(ms, round_to))
-	return ms
-
-# Return if the instrument should be played in the given interval
-def isValidInterval(instrument, elapsed_ms):
-	interval_ms = instrument['interval_ms']
-	interval = instrument['interval']
-	interval_offset = instrument['interval_offset']	
-	return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
-
 # Make sure there's no sudden drop in gain
 def continueFromPrevious(instrument):
 	return instrument['bracket_min'] > 0 or instrument['bracket_max'] < 100
@@ -254,92 +230,64 @@ def continueFromPrevious(instrument):
 # Add beats to sequence
 def addBeatsToSequence(instrument, duration, ms, beat_ms, round_to):
 	global sequence
-	global hindex
+	global jitter_streams
 	offset_ms = int(instrument['tempo_offset'] * beat_ms)
-	ms += offset_ms
-	previous_ms = int(ms)
-	from_beat_ms = instrument['from_beat_ms']
-	to_beat_ms = instrument['to_beat_ms']
-	min_ms = min(from_beat_ms, to_beat_ms)
-	remaining_duration = int(duration)
-	elapsed_duration = offset_ms
-	continue_from_prev = continueFromPrevious(instrument)
-	while remaining_duration >= min_ms:
-		elapsed_ms = int(ms)
-		elapsed_beat = int((elapsed_ms-previous_ms) / beat_ms)
-		# continue beat from previous
-		if continue_from_prev:
-			elapsed_beat = int(elapsed_ms / beat_ms)
-		this_beat_ms = getBeatMs(instrument, elapsed_beat, round_to)
-		# add to sequence if in valid interval
-		if isValidInterval(instrument, elapsed_ms):
-			h = halton(hindex, 3)
-			variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-			rate_variance = float(h * VARIANCE_RATE * 2 - VARIANCE_RATE)
-			sequence.append({
-				'instrument_index': instrument['index'],
-				'instrument': instrument,
-				'position': 0,
-				'gain': getGain(instrument, elapsed_beat),
-				'rate': 1.0 + rate_variance,
-				'elapsed_ms': max([elapsed_ms + variance, 0])
-			})
-			hindex += 1
-		remaining_duration -= this_beat_ms
-		elapsed_duration += this_beat_ms
-		ms += this_beat_ms
-
+	beats = sequencer.getBeats(instrument, ms, duration, round_to, offset_ms=offset_ms, tempo='beat', gain='beat', beat_ms=beat_ms, continue_beat=continueFromPrevious(instrument))
+	count = len(beats['ms'])
+	indices = jitter.takeIndices(jitter_streams, jitter.getStream(JITTER_STREAMS, instrument['index']), count)
+	h = jitter.haltonIndices(indices, 3)
+	variance = (h * VARIANCE_MS * 2 - VARIANCE_MS).astype(int)
+	rate_variance = h * VARIANCE_RATE * 2 - VARIANCE_RATE
+	elapsed_ms = jitter.addVariance(beats['ms'], variance)
+	sequence.append(instrument['index'], elapsed_ms, beats['gain'], rate=1.0 + rate_variance)
+
+tracing.phase('generate beats')
 # Build main sequence
-for instrument in instruments:
-	ms = 0
-	station_queue_duration = 0
-	if instrument['type'] == 'misc':
-		continue
-	# Each station in stations
-	for station in stations:
-		# Check if instrument is in this station
-		instrument_index = findInList(station['instruments'], 'index', instrument['index'])
-		# Instrument not here, just add the station duration and continue
-		if instrument_index < 0 and station_queue_duration > 0:
-			addBeatsToSequence(instrument, station_queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
-			ms += station_queue_duration + station['duration']
-			station_queue_duration = 0
-		elif instrument_index < 0:
-			ms += station['duration']
-		else:
-			station_queue_duration += station['duration']
-	if station_queue_duration > 0:
-		addBeatsToSequence(instrument, station_queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
+misc = np.array([instrument['type'] == 'misc' for instrument in instruments])[:, np.newaxis]
+station_durations = [station['duration'] for station in stations]
+for index, ms, station_queue_duration, stop in activation.getQueueSegments(station_instruments & ~misc, station_durations):
+	addBeatsToSequence(instruments[index], station_queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
 
 # Calculate total time
 total_seconds = int(1.0*total_ms/1000)
 print('Total sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds)) + '(' + str(total_seconds) + 's)')
+tracing.count(len(sequence))
 		
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for index, step in enumerate(sequence):
-	sequence[index]['milliseconds'] = step['elapsed_ms'] - elapsed
-	elapsed = step['elapsed_ms']
+sequence.sort()
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments to file
 if WRITE_SEQUENCE:
+	buffers = voices.getBufferCounts(sequence, instruments) if SIZE_BUFFERS else None
 	with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)	
 		for index, instrument in enumerate(instruments):
-			w.writerow([index])
+			w.writerow([index] if buffers is None else [index, buffers[index]])
 			w.writerow([instrument['file']])
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
+		if buffers is not None:
+			print('Sized instrument buffers: %s in all, at most %s for an instrument' % (sum(buffers), max(buffers)))
+	schedule = sample_schedule.getSchedule(sequence, instruments) if SCHEDULE_SAMPLES else None
+	sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
+
+# Write sequence report to file on another thread while the sequence is written
+reports = report.ReportWriter()
+if WRITE_REPORT:
+	reports.writeSequence(REPORT_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain'], sequence.merged(), instruments, ['gain'])
 
 # Write sequence to file
-if WRITE_SEQUENCE:
+if WRITE_SEQUENCE and SEQUENCE_FORMAT == 'binary':
+	sequence_file.writeBinary(BINARY_SEQUENCE_OUTPUT_FILE, sequence)
+	print('Successfully wrote sequence to file: '+BINARY_SEQUENCE_OUTPUT_FILE)
+elif WRITE_SEQUENCE:
 	with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)	
-		for step in sequence:
+		for step in sequence.steps():
 			w.writerow([step['instrument_index']])
 			w.writerow([step['position']])
 			w.writerow([step['gain']])
@@ -348,36 +296,18 @@ if WRITE_SEQUENCE:
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+	# players prefer a binary sequence, so don't leave one from an earlier build
+	if os.path.exists(BINARY_SEQUENCE_OUTPUT_FILE):
+		os.remove(BINARY_SEQUENCE_OUTPUT_FILE)
 
 # Write summary file
 if WRITE_REPORT:
-	with open(REPORT_SUMMARY_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Name', 'Distance', 'Duration', 'Beats', 'Instruments'])
-		elapsed = 0
-		for station in stations:
-			duration = station['duration']
-			duration_f = time.strftime('%M:%S', time.gmtime(int(duration/1000)))
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			elapsed += duration
-			w.writerow([elapsed_f, station['name'], round(station['distance'], 2), duration_f, station['beats'], ' '.join([i['name'] for i in station['instruments']])])
-		print('Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
-
-# Write sequence report to file
-if WRITE_REPORT:
-	with open(REPORT_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Instrument', 'Gain'])
-		for step in sequence:
-			instrument = instruments[step['instrument_index']]
-			elapsed = step['elapsed_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = elapsed % 1000
-			elapsed_f += '.' + str(ms)
-			w.writerow([elapsed_f, instrument['file'], step['gain']])
-		f.seek(-2, os.SEEK_END) # remove newline
-		f.truncate()
-		print('Successfully wrote sequence report to file: '+REPORT_SEQUENCE_OUTPUT_FILE)
+	durations = [station['duration'] for station in stations]
+	elapsed_f = report.formatTimes(np.cumsum([0] + durations[:-1]), milliseconds=False)
+	duration_f = report.formatTimes(durations, milliseconds=False)
+	rows = [[elapsed_f[i], station['name'], round(station['distance'], 2), duration_f[i], station['beats'], ' '.join([inst['name'] for inst in station['instruments']])] for i, station in enumerate(stations)]
+	reports.write(REPORT_SUMMARY_OUTPUT_FILE, ['Time', 'Name', 'Distance', 'Duration', 'Beats', 'Instruments'], rows, 'Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
+reports.close()
 
 # Write JSON data for the visualization
 if WRITE_JSON:
@@ -395,10 +325,15 @@ if WRITE_JSON:
 			'lng': station['lng']
 		})
 		elapsed_duration += station['duration']
-	with open(STATIONS_VISUALIZATION_OUTPUT_FILE, 'w') as outfile:
-		json.dump(json_data, outfile)
-	print('Successfully wrote to JSON file: '+STATIONS_VISUALIZATION_OUTPUT_FILE)
-	with open(MAP_VISUALIZATION_OUTPUT_FILE, 'w') as outfile:
-		json.dump(json_data, outfile)
-	print('Successfully wrote to JSON file: '+MAP_VISUALIZATION_OUTPUT_FILE)
+	# both visualizations load the same data
+	if VISUALIZATION_FORMAT == 'chunked':
+		for filename in [STATIONS_VISUALIZATION_OUTPUT_FILE, MAP_VISUALIZATION_OUTPUT_FILE]:
+			visualization_file.write(filename, json_data, times='elapsed_duration')
+			print('Successfully wrote chunked visualization file: '+visualization_file.getIndexFile(filename))
+	else:
+		json_text = json.dumps(json_data)
+		for filename in [STATIONS_VISUALIZATION_OUTPUT_FILE, MAP_VISUALIZATION_OUTPUT_FILE]:
+			with open(filename, 'w') as outfile:
+				outfile.write(json_text)
+			print('Successfully wrote to JSON file: '+filename)
 
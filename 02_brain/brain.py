@@ -10,15 +10,32 @@ import csv
 import json
 import math
 import os
+import sys
 import time
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import jitter
+import report
+import sample_schedule
+import sequence_file
+import sequencer
+import table_cache
+import timeline
+import tracing
+import visualization_file
+import voices
+from sequence_buffer import SequenceBuffer, toSteps
+
 # Config
 BPM = 75 # Beats per minute, e.g. 60, 75, 100, 120, 150
 DIVISIONS_PER_BEAT = 16 # e.g. 4 = quarter notes, 8 = eighth notes, etc
 VARIANCE_MS = 10 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER_STREAMS = 'global' # 'global' keeps the jitter of earlier builds, 'instrument' gives each instrument its own reproducible jitter stream
 PRECISION = 6 # decimal places after 0 for reading value
 GAIN = 0.2 # base gain
 TEMPO = 0.25 # base tempo
+MEMORY_BUDGET_MB = 0 # MB of notes to hold in memory before spilling sorted runs to disk, e.g. 256 for full-night recordings (0 for no limit)
 LABELS = ['Time', 'FP1-F7', 'F7-T7', 'T7-P7', 'P7-O1', 'FP1-F3', 'F3-C3', 'C3-P3', 'P3-O1', 'FP2-F4', 'F4-C4', 'C4-P4', 'P4-O2', 'FP2-F8', 'F8-T8', 'T8-P8', 'P8-O2', 'FZ-CZ', 'CZ-PZ']
 
 # Files
@@ -28,19 +45,27 @@ REPORT_SUMMARY_OUTPUT_FILE = 'data/report_summary.csv'
 REPORT_SUMMARY_CHANNEL_OUTPUT_FILE = 'data/report_channel_summary.csv'
 REPORT_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
+SCHEDULE_OUTPUT_FILE = 'data/ck_schedule.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+BINARY_SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.cks'
+TRACE_OUTPUT_FILE = 'data/trace.json'
 VISUALIZATION_OUTPUT_FILE = 'visualization/data/eeg.json'
 INSTRUMENTS_DIR = 'instruments/'
 
 # Output options
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'csv' # 'csv' or 'binary' (a compact .cks file that loads faster in ChucK)
+SIZE_BUFFERS = False # give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers
+SCHEDULE_SAMPLES = False # load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts
 WRITE_REPORT = True
 WRITE_JSON = False
+VISUALIZATION_FORMAT = 'json' # 'json' or 'chunked' (gzipped columns in windows of time with an index, so a visualization can load as it plays)
+WRITE_TRACE = False # write a Chrome trace of where the build's time and memory go (open it in chrome://tracing or ui.perfetto.dev)
 
 # Calculations
 BEAT_MS = round(60.0 / BPM * 1000)
 MEASURE_MS = BEAT_MS * 4.0
-ROUND_TO_NEAREST = round(BEAT_MS/DIVISIONS_PER_BEAT)
+ROUND_TO_NEAREST = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # ms of a tick, the grid beats are laid out on
 CHANNEL_COUNT = len(LABELS) - 1
 
 print('Building sequence at '+str(BPM)+' BPM ('+str(BEAT_MS)+'ms per beat)')
@@ -53,21 +78,10 @@ eeg_max = []
 measures = []
 abs_min = 0
 abs_max = 0
-sequence = []
-hindex = 0
+sequence = SequenceBuffer(memory_budget=MEMORY_BUDGET_MB*1024*1024)
+jitter_streams = {}
 total_ms = 0
 
-# For creating pseudo-random numbers
-def halton(index, base):
-	result = 0.0
-	f = 1.0 / base
-	i = 1.0 * index
-	while(i > 0):
-		result += f * (i % base)	
-		i = math.floor(i / base)
-		f = f / base
-	return result
-
 # Mean of list
 def mean(data):
     if iter(data) is data:
@@ -105,13 +119,12 @@ def findInList(list, key, value):
 			break
 	return found
 
-# round {n} to nearest {nearest}
-def roundToNearest(n, nearest):
-	return 1.0 * round(1.0*n/nearest) * nearest
-	
+if WRITE_TRACE:
+	tracing.start(TRACE_OUTPUT_FILE)
+tracing.phase('load')
 # Read instruments from file
 with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter='\t')
+	r = table_cache.reader(f, delimiter='\t')
 	next(r, None) # remove header
 	for name,channel,amp_min,amp_max,freq_min,freq_max,sync_min,sync_max,file,from_gain,to_gain,tempo,tempo_offset,interval_phase,interval,interval_offset,active in r:
 		if int(active):
@@ -166,52 +179,52 @@ def getFrequency(data, _min, _max, _stdev):
 	return waves
 
 # Read eeg from file
-with open(EEG_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter=',')
-	next(r, None) # remove header
-	last_ms = 0
-	measure = []
-	next_measure = MEASURE_MS
-	for t,s1,s2,s3,s4,s5,s6,s7,s8,s9,s10,s11,s12,s13,s14,s15,s16,s17,s18,s19,s20,s21,s22,s23 in r:
-		ms = int(t)
-		row = [ms,float(s1),float(s2),float(s3),float(s4),float(s5),float(s6),float(s7),float(s8),float(s9),float(s10),float(s11),float(s12),float(s13),float(s14),float(s15),float(s16),float(s17),float(s18)]
-		# get row with minimum values
-		if ms <= -2:
-			eeg_min = row
-			abs_min = min(eeg_min)
-		# get row with maximum values
-		elif ms <= -1:
-			eeg_max = row
-			abs_max = max(eeg_max)
-		# all other rows
+columns = table_cache.readColumns(EEG_INPUT_FILE)
+last_ms = 0
+measure = []
+next_measure = MEASURE_MS
+for t,s1,s2,s3,s4,s5,s6,s7,s8,s9,s10,s11,s12,s13,s14,s15,s16,s17,s18,s19,s20,s21,s22,s23 in table_cache.getRows(columns, [('Time', int), ('S1', float), ('S2', float), ('S3', float), ('S4', float), ('S5', float), ('S6', float), ('S7', float), ('S8', float), ('S9', float), ('S10', float), ('S11', float), ('S12', float), ('S13', float), ('S14', float), ('S15', float), ('S16', float), ('S17', float), ('S18', float), ('S19', None), ('S20', None), ('S21', None), ('S22', None), ('S23', None)]):
+	ms = t
+	row = [ms,s1,s2,s3,s4,s5,s6,s7,s8,s9,s10,s11,s12,s13,s14,s15,s16,s17,s18]
+	# get row with minimum values
+	if ms <= -2:
+		eeg_min = row
+		abs_min = min(eeg_min)
+	# get row with maximum values
+	elif ms <= -1:
+		eeg_max = row
+		abs_max = max(eeg_max)
+	# all other rows
+	else:
+		normalized_row = normalizeRow(row, abs_min, abs_max)
+		eeg.append(normalized_row)
+		if ms >= next_measure:
+			measures.append({								
+				"readings": measure,
+				"channels": [],
+				"duration": MEASURE_MS
+			})
+			measure = []
+			next_measure += MEASURE_MS
 		else:
-			normalized_row = normalizeRow(row, abs_min, abs_max)
-			eeg.append(normalized_row)
-			if ms >= next_measure:
-				measures.append({								
-					"readings": measure,
-					"channels": [],
-					"duration": MEASURE_MS
-				})
-				measure = []
-				next_measure += MEASURE_MS
-			else:
-				measure.append(normalized_row[1:])
-			total_ms += (ms - last_ms)
-			last_ms = ms
-	# Add the last measure
-	if len(measure) > 0:
-		measures.append({				
-			"readings": measure,
-			"channels": [],
-			"duration": total_ms - MEASURE_MS * len(measures)
-		})
+			measure.append(normalized_row[1:])
+		total_ms += (ms - last_ms)
+		last_ms = ms
+# Add the last measure
+if len(measure) > 0:
+	measures.append({				
+		"readings": measure,
+		"channels": [],
+		"duration": total_ms - MEASURE_MS * len(measures)
+	})
 
 # Report EEG data
 print('Retrieved EEG data with '+ str(len(LABELS)-1) + ' channels')
 print('uV range: ['+str(abs_min)+','+str(abs_max)+'], uV length: '+str(abs_max-abs_min))
 print(str(len(measures)) + ' total measures created, ' + str(MEASURE_MS) + 'ms each')
 		
+tracing.phase('normalize')
+tracing.count(len(measures))
 # Keep track of min/max stdev for normalization
 min_amp = None
 max_amp = None
@@ -319,6 +332,7 @@ def getChannelInstruments(_instruments, _channel):
 			valid_instruments.append(_instrument)
 	return valid_instruments
 
+tracing.phase('match instruments')
 # Determine instruments
 for mindex, measure in enumerate(measures):
 	_instruments = []
@@ -328,64 +342,20 @@ for mindex, measure in enumerate(measures):
 		_instruments.extend(getChannelInstruments(instruments, channel))
 	measures[mindex]["instruments"] = _instruments
 
-# Return if the instrument should be played in the given interval
-def isValidInterval(instrument, elapsed_ms):
-	interval_ms = instrument['interval_ms']
-	interval = instrument['interval']
-	interval_offset = instrument['interval_offset']	
-	return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
-
-# Multiplier based on sine curve
-def getMultiplier(percent_complete):
-	radians = percent_complete * (math.pi / 2.0)
-	multiplier = math.sin(radians)
-	if multiplier < 0:
-		multiplier = 0.0
-	elif multiplier > 1:
-		multplier = 1.0
-	return multiplier
-
-# Retrieve gain based on current beat
-def getGain(instrument, total_ms, elapsed_ms):
-	percent_complete = elapsed_ms / total_ms
-	multiplier = getMultiplier(percent_complete)
-	from_gain = instrument['from_gain']
-	to_gain = instrument['to_gain']
-	min_gain = min(from_gain, to_gain)
-	gain = multiplier * (to_gain - from_gain) + from_gain
-	gain = max(min_gain, round(gain, 2))
-	return gain
-	
 # Add beats to sequence
 def addBeatsToSequence(_instrument, _duration, _ms, _beat_ms, _round_to):
 	global sequence
-	global hindex
-	beat_ms = int(roundToNearest((1.0/_instrument['tempo']) * _beat_ms, _round_to))
+	global jitter_streams
+	beat_ms = int(sequencer.roundToNearest((1.0/_instrument['tempo']) * _beat_ms, _round_to))
 	offset_ms = int(_instrument['tempo_offset'] * beat_ms)
-	ms = _ms + offset_ms
-	previous_ms = int(ms)
-	remaining_duration = int(_duration)
-	elapsed_duration = offset_ms
-	while remaining_duration >= beat_ms:
-		elapsed_ms = int(ms)
-		elapsed_beat = int((elapsed_ms-previous_ms) / beat_ms)
-		# add to sequence if in valid interval
-		if isValidInterval(_instrument, elapsed_ms):
-			h = halton(hindex, 3)
-			variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-			sequence.append({
-				'instrument_index': _instrument['index'],
-				'instrument': _instrument,
-				'position': 0,
-				'gain': getGain(_instrument, _duration, elapsed_ms),
-				'rate': 1,
-				'elapsed_ms': max([elapsed_ms + variance, 0])
-			})
-			hindex += 1
-		remaining_duration -= beat_ms
-		elapsed_duration += beat_ms
-		ms += beat_ms
-
+	beats = sequencer.getBeats(_instrument, _ms, _duration, _round_to, offset_ms=offset_ms, tempo='constant', beat_ms=beat_ms, gain='elapsed', gain_rad=0.5)
+	count = len(beats['ms'])
+	indices = jitter.takeIndices(jitter_streams, jitter.getStream(JITTER_STREAMS, _instrument['index']), count)
+	variance = jitter.getVariance(indices, VARIANCE_MS)
+	elapsed_ms = jitter.addVariance(beats['ms'], variance)
+	sequence.append(_instrument['index'], elapsed_ms, beats['gain'])
+
+tracing.phase('generate beats')
 # Build main sequence
 ms = 0
 for measure in measures:
@@ -400,85 +370,86 @@ for measure in measures:
 # Calculate total time
 total_seconds = int(1.0*total_ms/1000)
 print('Total sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds)) + '(' + str(total_seconds) + 's)')
+tracing.count(len(sequence))
 
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for index, step in enumerate(sequence):
-	sequence[index]['milliseconds'] = step['elapsed_ms'] - elapsed
-	elapsed = step['elapsed_ms']
+sequence.sort()
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments to file
 if WRITE_SEQUENCE and len(instruments) > 0:
+	buffers = voices.getBufferCounts(sequence, instruments) if SIZE_BUFFERS else None
 	with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)	
 		for index, instrument in enumerate(instruments):
-			w.writerow([index])
+			w.writerow([index] if buffers is None else [index, buffers[index]])
 			w.writerow([instrument['file']])
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
-
-# Write sequence to file
-if WRITE_SEQUENCE and len(sequence) > 0:
-	with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)	
-		for step in sequence:
-			w.writerow([step['instrument_index']])
-			w.writerow([step['position']])
-			w.writerow([step['gain']])
-			w.writerow([step['rate']])
-			w.writerow([step['milliseconds']])
-		f.seek(-2, os.SEEK_END) # remove newline
-		f.truncate()
+		if buffers is not None:
+			print('Sized instrument buffers: %s in all, at most %s for an instrument' % (sum(buffers), max(buffers)))
+	schedule = sample_schedule.getSchedule(sequence, instruments) if SCHEDULE_SAMPLES else None
+	sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
+
+# Write sequence and sequence report to file in one pass over the notes in order; the report is written on
+# another thread as the sequence is
+reports = report.ReportWriter()
+if (WRITE_SEQUENCE or WRITE_REPORT) and len(sequence) > 0:
+	binary_writer = None
+	sequence_f = None
+	report_blocks = None
+	if WRITE_SEQUENCE and SEQUENCE_FORMAT == 'binary':
+		binary_writer = sequence_file.BinaryWriter(BINARY_SEQUENCE_OUTPUT_FILE, sequence)
+	elif WRITE_SEQUENCE:
+		sequence_f = open(SEQUENCE_OUTPUT_FILE, 'wb')
+		sequence_w = csv.writer(sequence_f)
+	if WRITE_REPORT:
+		report_blocks = report.BlockQueue()
+		reports.writeSequence(REPORT_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain'], report_blocks, instruments, ['gain'])
+	for block in sequence.merged():
+		if binary_writer:
+			binary_writer.write(block)
+		if report_blocks:
+			report_blocks.put(block)
+		if not sequence_f:
+			continue
+		for step in toSteps(block):
+			sequence_w.writerow([step['instrument_index']])
+			sequence_w.writerow([step['position']])
+			sequence_w.writerow([step['gain']])
+			sequence_w.writerow([step['rate']])
+			sequence_w.writerow([step['milliseconds']])
+	if report_blocks:
+		report_blocks.close()
+	if binary_writer:
+		binary_writer.close()
+		print('Successfully wrote sequence to file: '+BINARY_SEQUENCE_OUTPUT_FILE)
+	if sequence_f:
+		sequence_f.seek(-2, os.SEEK_END) # remove newline
+		sequence_f.truncate()
+		sequence_f.close()
 		print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+		# players prefer a binary sequence, so don't leave one from an earlier build
+		if os.path.exists(BINARY_SEQUENCE_OUTPUT_FILE):
+			os.remove(BINARY_SEQUENCE_OUTPUT_FILE)
 
 # Write summary files
 if WRITE_REPORT:
-	with open(REPORT_SUMMARY_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Amplitude', 'Frequency', 'Synchrony', 'Duration'])
-		for mindex, measure in enumerate(measures):
-			elapsed = mindex * MEASURE_MS
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			w.writerow([elapsed_f, measure['mean_amp'], measure['mean_freq'], measure['sync'], int(measure['duration'])])
-		print('Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
-	with open(REPORT_SUMMARY_CHANNEL_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(LABELS)
-		for mindex, measure in enumerate(measures):
-			elapsed = mindex * MEASURE_MS
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			channels = [elapsed_f]
-			for channel in measure["channels"]:
-				channels.append(channel["amp"])
-			w.writerow(channels)
-		print('Successfully wrote channel summary file: '+REPORT_SUMMARY_CHANNEL_OUTPUT_FILE)
-
-# Write sequence report to file
-if WRITE_REPORT and len(sequence) > 0:
-	with open(REPORT_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Instrument', 'Gain'])
-		for step in sequence:
-			instrument = instruments[step['instrument_index']]
-			elapsed = step['elapsed_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			w.writerow([elapsed_f, instrument['file'], step['gain']])
-		f.seek(-2, os.SEEK_END) # remove newline
-		f.truncate()
-		print('Successfully wrote sequence report to file: '+REPORT_SEQUENCE_OUTPUT_FILE)
+	times = report.formatTimes([mindex * MEASURE_MS for mindex in range(len(measures))])
+	rows = [[elapsed_f, measure['mean_amp'], measure['mean_freq'], measure['sync'], int(measure['duration'])] for elapsed_f, measure in zip(times, measures)]
+	reports.write(REPORT_SUMMARY_OUTPUT_FILE, ['Time', 'Amplitude', 'Frequency', 'Synchrony', 'Duration'], rows, 'Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
+	rows = [[elapsed_f] + [channel["amp"] for channel in measure["channels"]] for elapsed_f, measure in zip(times, measures)]
+	reports.write(REPORT_SUMMARY_CHANNEL_OUTPUT_FILE, LABELS, rows, 'Successfully wrote channel summary file: '+REPORT_SUMMARY_CHANNEL_OUTPUT_FILE)
+reports.close()
 
 # Write JSON data for the visualization
-if WRITE_JSON:
+if WRITE_JSON and VISUALIZATION_FORMAT == 'chunked':
+	visualization_file.write(VISUALIZATION_OUTPUT_FILE, eeg, {'labels': LABELS, 'min': eeg_min, 'max': eeg_max}, names=LABELS, times='Time')
+	print('Successfully wrote chunked visualization file: '+visualization_file.getIndexFile(VISUALIZATION_OUTPUT_FILE))
+elif WRITE_JSON:
 	json_data = eeg
 	json_data.insert(0, eeg_max)
 	json_data.insert(0, eeg_min)
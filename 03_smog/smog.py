@@ -10,19 +10,38 @@ import csv
 import json
 import math
 import os
+import sys
 import time
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import activation
+import build_stream
+import jitter
+import report
+import sample_schedule
+import sequence_file
+import sequencer
+import table_cache
+import timeline
+import tracing
+import visualization_file
+import voices
+from sequence_buffer import SequenceBuffer, toSteps
+
 # Config
 BPM = 120 # Beats per minute, e.g. 60, 75, 100, 120, 150
 READINGS_PER_BEAT = 2 # pm2.5 readings per beat
 DIVISIONS_PER_BEAT = 4 # e.g. 4 = quarter notes, 8 = eighth notes, etc
 VARIANCE_MS = 10 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER_STREAMS = 'global' # 'global' keeps the jitter of earlier builds, 'instrument' gives each instrument its own reproducible jitter stream
 GAIN = 0.4 # base gain
 TEMPO = 1.0 # base tempo
 DATE_FORMAT = "%Y-%m-%d" # e.g. 2012-01-01
 DATE_FORMAT_DISPLAY = "%b %d, %Y" # e.g. Jan 1, 2012
 PM_THRESHOLD = 50 # any value above this will generate "residue"
 PM_UNIT = 1 # the lower this number, the longer residue lasts
+MEMORY_BUDGET_MB = 0 # MB of notes to hold in memory before spilling sorted runs to disk, e.g. 256 for multi-year hourly readings (0 for no limit)
 
 # Files
 INSTRUMENTS_INPUT_FILE = 'data/instruments.csv'
@@ -30,45 +49,42 @@ PM25_INPUT_FILE = 'data/pm25_readings.csv'
 REPORT_SUMMARY_OUTPUT_FILE = 'data/report_summary.csv'
 REPORT_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
+SCHEDULE_OUTPUT_FILE = 'data/ck_schedule.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+BINARY_SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.cks'
+TRACE_OUTPUT_FILE = 'data/trace.json'
 VISUALIZATION_OUTPUT_FILE = 'visualization/data/pm25_data.json'
 INSTRUMENTS_DIR = 'instruments/'
 
 # Output options
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'csv' # 'csv' or 'binary' (a compact .cks file that loads faster in ChucK)
+SIZE_BUFFERS = False # give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers
+SCHEDULE_SAMPLES = False # load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts
 WRITE_REPORT = True
 WRITE_JSON = True
+VISUALIZATION_FORMAT = 'json' # 'json' or 'chunked' (gzipped columns in windows of time with an index, so a visualization can load as it plays)
+WRITE_TRACE = False # write a Chrome trace of where the build's time and memory go (open it in chrome://tracing or ui.perfetto.dev)
 
 # Calculations
 BEAT_MS = round(60.0 / BPM * 1000)
-ROUND_TO_NEAREST = round(BEAT_MS/DIVISIONS_PER_BEAT)
+ROUND_TO_NEAREST = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # ms of a tick, the grid beats are laid out on
 
 print('Building sequence at '+str(BPM)+' BPM ('+str(BEAT_MS)+'ms per beat)')
 
 # Initialize Variables
 instruments = []
 pm25 = []
-sequence = []
+sequence = SequenceBuffer(memory_budget=MEMORY_BUDGET_MB*1024*1024)
 pm25_min = None
 pm25_max = None
 pm25_residue_min = None
 pm25_residue_max = None
 pm25_count = 0
-hindex = 0
+jitter_streams = {}
 total_beats = 0
 total_ms = 0
 
-# For creating pseudo-random numbers
-def halton(index, base):
-	result = 0.0
-	f = 1.0 / base
-	i = 1.0 * index
-	while(i > 0):
-		result += f * (i % base)	
-		i = math.floor(i / base)
-		f = f / base
-	return result
-
 # Find index of first item that matches value
 def findInList(list, key, value):
 	found = -1
@@ -78,10 +94,6 @@ def findInList(list, key, value):
 			break
 	return found
 
-# round {n} to nearest {nearest}
-def roundToNearest(n, nearest):
-	return 1.0 * round(1.0*n/nearest) * nearest
-	
 # ceil {n} to nearest {nearest}
 def ceilToNearest(n, nearest):
 	return 1.0 * math.ceil(1.0*n/nearest) * nearest
@@ -95,9 +107,12 @@ def decrementList(list, amount, min_amount=0):
 			new_list.append(item)
 	return new_list
 
+if WRITE_TRACE:
+	tracing.start(TRACE_OUTPUT_FILE)
+tracing.phase('load')
 # Read instruments from file
 with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter='\t')
+	r = table_cache.reader(f, delimiter='\t')
 	next(r, None) # remove header
 	for name,pm25_min,pm25_max,residue_min,residue_max,file,from_gain,to_gain,round_to,from_tempo,to_tempo,tempo_offset,interval_phase,interval,interval_offset,active in r:
 		if int(active):
@@ -128,30 +143,29 @@ with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
 
 # Read PM2.5 from file
 pm_residue = []
-with open(PM25_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter=',')
-	next(r, None) # remove header
-	pm25_min = int(next(r, None)[-1])
-	pm25_max = int(next(r, None)[-1])
-	pm25_count = int(next(r, None)[-1])
-	pm_residue_value = 0
-	for _datetime, _value in r:
-		datetime = time.strptime(_datetime, DATE_FORMAT)
-		pm_value = int(_value)
-		if pm_value > PM_THRESHOLD:
-			pm_residue.append(pm_value)
-			pm_residue_value = sum(pm_residue)
-			# Track min/max residue
-			if pm25_residue_max is None or pm_residue_value > pm25_residue_max:
-				pm25_residue_max = pm_residue_value
-			if pm25_residue_min is None or pm_residue_value < pm25_residue_min:
-				pm25_residue_min = pm_residue_value
-		pm25.append({
-			'date': time.strftime(DATE_FORMAT_DISPLAY, datetime).replace(' 0', ' '),
-			'val': pm_value,
-			'residue': pm_residue_value
-		})
-		pm_residue = decrementList(pm_residue, PM_UNIT)
+columns = table_cache.readColumns(PM25_INPUT_FILE)
+r = iter(table_cache.getRows(columns, [('Date', str), ('PM2.5 Value', int)]))
+pm25_min = next(r, None)[-1]
+pm25_max = next(r, None)[-1]
+pm25_count = next(r, None)[-1]
+pm_residue_value = 0
+for _datetime, _value in r:
+	datetime = time.strptime(_datetime, DATE_FORMAT)
+	pm_value = _value
+	if pm_value > PM_THRESHOLD:
+		pm_residue.append(pm_value)
+		pm_residue_value = sum(pm_residue)
+		# Track min/max residue
+		if pm25_residue_max is None or pm_residue_value > pm25_residue_max:
+			pm25_residue_max = pm_residue_value
+		if pm25_residue_min is None or pm_residue_value < pm25_residue_min:
+			pm25_residue_min = pm_residue_value
+	pm25.append({
+		'date': time.strftime(DATE_FORMAT_DISPLAY, datetime).replace(' 0', ' '),
+		'val': pm_value,
+		'residue': pm_residue_value
+	})
+	pm_residue = decrementList(pm_residue, PM_UNIT)
 
 # Report PM2.5 data
 print('Retrieved PM2.5 data with '+ str(pm25_count) + ' data points')
@@ -168,78 +182,23 @@ MAX_READING_MS = READING_MS * 40
 print('Main sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds)) + '(' + str(total_seconds) + 's, '+str(total_beats)+' beats)')
 print(str(READING_MS)+'ms per reading')
 
-# Multiplier based on sine curve
-def getMultiplier(percent_complete, rad=1.0):
-	radians = percent_complete * (math.pi * rad)
-	multiplier = math.sin(radians)
-	if multiplier < 0:
-		multiplier = 0.0
-	elif multiplier > 1:
-		multplier = 1.0
-	return multiplier
-
-# Retrieve gain based on current beat
-def getGain(instrument, percent_complete):
-	multiplier = getMultiplier(percent_complete)
-	from_gain = instrument['from_gain']
-	to_gain = instrument['to_gain']
-	min_gain = min(from_gain, to_gain)
-	gain = multiplier * (to_gain - from_gain) + from_gain
-	gain = max(min_gain, round(gain, 2))
-	return gain
-
-# Get beat duration in ms based on current point in time
-def getBeatMs(instrument, percent_complete, round_to):
-	multiplier = getMultiplier(percent_complete, 0.5)
-	from_beat_ms = instrument['from_beat_ms']
-	to_beat_ms = instrument['to_beat_ms']	
-	ms = multiplier * (to_beat_ms - from_beat_ms) + from_beat_ms
-	ms = int(roundToNearest(ms, round_to))
-	return ms
-
-# Return if the instrument should be played in the given interval
-def isValidInterval(instrument, elapsed_ms):
-	interval_ms = instrument['interval_ms']
-	interval = instrument['interval']
-	interval_offset = instrument['interval_offset']	
-	return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
-
 # Add beats to sequence
 def addBeatsToSequence(instrument, duration, ms, beat_ms, round_to):
 	global sequence
-	global hindex
+	global jitter_streams
 	offset_ms = int(instrument['tempo_offset'] * beat_ms)
-	ms += offset_ms
-	if instrument['round_to_ms'] > 0:
-		ms = roundToNearest(ms, instrument['round_to_ms'])
-	previous_ms = int(ms)
-	from_beat_ms = instrument['from_beat_ms']
-	to_beat_ms = instrument['to_beat_ms']
-	min_ms = min(from_beat_ms, to_beat_ms)
-	remaining_duration = int(duration)
-	elapsed_duration = offset_ms
-	while remaining_duration >= min_ms:
-		elapsed_ms = int(ms)
-		elapsed_beat = int((elapsed_ms-previous_ms) / beat_ms)
-		percent_complete = 1.0 * elapsed_duration / duration
-		this_beat_ms = getBeatMs(instrument, percent_complete, round_to)
-		# add to sequence if in valid interval
-		if isValidInterval(instrument, elapsed_ms):
-			h = halton(hindex, 3)
-			variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-			sequence.append({
-				'instrument_index': instrument['index'],
-				'instrument': instrument,
-				'position': 0,
-				'rate': 1,
-				'gain': getGain(instrument, percent_complete),
-				'elapsed_ms': max([elapsed_ms + variance, 0])
-			})
-			hindex += 1
-		remaining_duration -= this_beat_ms
-		elapsed_duration += this_beat_ms
-		ms += this_beat_ms
+	beats = sequencer.getBeats(instrument, ms, duration, round_to, offset_ms=offset_ms, tempo_rad=0.5, round_start_to=instrument['round_to_ms'])
+	count = len(beats['ms'])
+	indices = jitter.takeIndices(jitter_streams, jitter.getStream(JITTER_STREAMS, instrument['index']), count)
+	variance = jitter.getVariance(indices, VARIANCE_MS)
+	elapsed_ms = jitter.addVariance(beats['ms'], variance)
+	if notes:
+		notes.append(instrument['index'], elapsed_ms, beats['gain'])
+	else:
+		sequence.append(instrument['index'], elapsed_ms, beats['gain'])
 
+tracing.phase('normalize')
+tracing.count(len(pm25))
 # Get/set normalized values		
 for ri, reading in enumerate(pm25):	
 	nval = (1.0 * reading['val'] - pm25_min) / (pm25_max - pm25_min)
@@ -247,98 +206,121 @@ for ri, reading in enumerate(pm25):
 	pm25[ri]['nval'] = nval
 	pm25[ri]['nresidue'] = nresidue
 
+tracing.phase('match instruments')
 # Build Sequence
-for instrument in instruments:
-	ms = 0
-	queue_duration = 0
-	# Each reading
-	for ri, reading in enumerate(pm25):
-		# Check if instrument is valid for this reading
-		nval = reading['nval']
-		nresidue = reading['nresidue']
-		is_valid = (nval >= instrument['pm25_min'] and nval < instrument['pm25_max'] and nresidue >= instrument['residue_min'] and nresidue < instrument['residue_max'])
-		# Instrument not here, just add the reading duration and continue
-		if not is_valid and queue_duration > 0:
-			addBeatsToSequence(instrument.copy(), queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
-			ms += queue_duration + READING_MS
-			queue_duration = 0
-		elif not is_valid:
-			ms += READING_MS
-		else:
-			queue_duration += READING_MS
-	if queue_duration > 0:
-		addBeatsToSequence(instrument.copy(), queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
+# Check which instruments are valid for each reading
+mins = activation.getColumns(instruments, ['pm25_min', 'residue_min'])
+maxs = activation.getColumns(instruments, ['pm25_max', 'residue_max'])
+features = activation.getColumns(pm25, ['nval', 'nresidue'])
+mask = activation.getMask(mins, maxs, features)
+tracing.phase('generate beats')
+segments = activation.getQueueSegments(mask, READING_MS)
+# When stream.py -build plays this build, generate the segments in order of time and stream their notes as the
+# build moves past them: a segment's notes start at most an instrument's offset and rounding, plus the variance,
+# before it. With the global jitter stream the jitter is then drawn in that order, so it isn't the jitter of a build
+# that isn't streamed; a streamed build writes no files, so the track's files are always a build's that isn't
+notes = build_stream.getStream(int(max([abs(instrument['tempo_offset']) * BEAT_MS + instrument['round_to_ms'] for instrument in instruments] + [0])) + VARIANCE_MS + 1)
+if notes:
+	segments = sorted(segments, key=lambda segment: segment[1])
+for index, ms, queue_duration, stop in segments:
+	addBeatsToSequence(instruments[index], queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
+	if notes:
+		notes.advance(ms)
+if notes:
+	notes.close()
+	print('Streamed %s notes' % notes.sent)
+	sys.exit()
+tracing.count(len(sequence))
 
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for index, step in enumerate(sequence):
-	sequence[index]['milliseconds'] = step['elapsed_ms'] - elapsed
-	elapsed = step['elapsed_ms']
+sequence.sort()
 
 # Output total time with ending tail
+elapsed = 0
+if len(sequence) > 0:
+	elapsed = sequence.getLastMs()
 elapsed_seconds = int(1.0*(elapsed+BEAT_MS)/1000)
 print('Total sequence time: '+time.strftime('%M:%S', time.gmtime(elapsed_seconds)) + '(' + str(elapsed_seconds) + 's)')
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments to file
 if WRITE_SEQUENCE and len(instruments) > 0:
+	buffers = voices.getBufferCounts(sequence, instruments) if SIZE_BUFFERS else None
 	with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)	
 		for index, instrument in enumerate(instruments):
-			w.writerow([index])
+			w.writerow([index] if buffers is None else [index, buffers[index]])
 			w.writerow([instrument['file']])
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
+		if buffers is not None:
+			print('Sized instrument buffers: %s in all, at most %s for an instrument' % (sum(buffers), max(buffers)))
+	schedule = sample_schedule.getSchedule(sequence, instruments) if SCHEDULE_SAMPLES else None
+	sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
 
-# Write sequence to file
-if WRITE_SEQUENCE and len(sequence) > 0:
-	with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)	
-		for step in sequence:
-			w.writerow([step['instrument_index']])
-			w.writerow([step['position']])
-			w.writerow([step['gain']])
-			w.writerow([step['rate']])
-			w.writerow([step['milliseconds']])
-		f.seek(-2, os.SEEK_END) # remove newline
-		f.truncate()
+# Write sequence and sequence report to file in one pass over the notes in order; the report is written on
+# another thread as the sequence is
+reports = report.ReportWriter()
+if (WRITE_SEQUENCE or WRITE_REPORT) and len(sequence) > 0:
+	binary_writer = None
+	sequence_f = None
+	report_blocks = None
+	if WRITE_SEQUENCE and SEQUENCE_FORMAT == 'binary':
+		binary_writer = sequence_file.BinaryWriter(BINARY_SEQUENCE_OUTPUT_FILE, sequence)
+	elif WRITE_SEQUENCE:
+		sequence_f = open(SEQUENCE_OUTPUT_FILE, 'wb')
+		sequence_w = csv.writer(sequence_f)
+	if WRITE_REPORT:
+		report_blocks = report.BlockQueue()
+		reports.writeSequence(REPORT_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain'], report_blocks, instruments, ['gain'])
+	for block in sequence.merged():
+		if binary_writer:
+			binary_writer.write(block)
+		if report_blocks:
+			report_blocks.put(block)
+		if not sequence_f:
+			continue
+		for step in toSteps(block):
+			sequence_w.writerow([step['instrument_index']])
+			sequence_w.writerow([step['position']])
+			sequence_w.writerow([step['gain']])
+			sequence_w.writerow([step['rate']])
+			sequence_w.writerow([step['milliseconds']])
+	if report_blocks:
+		report_blocks.close()
+	if binary_writer:
+		binary_writer.close()
+		print('Successfully wrote sequence to file: '+BINARY_SEQUENCE_OUTPUT_FILE)
+	if sequence_f:
+		sequence_f.seek(-2, os.SEEK_END) # remove newline
+		sequence_f.truncate()
+		sequence_f.close()
 		print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+		# players prefer a binary sequence, so don't leave one from an earlier build
+		if os.path.exists(BINARY_SEQUENCE_OUTPUT_FILE):
+			os.remove(BINARY_SEQUENCE_OUTPUT_FILE)
 
 # Write summary files
 if WRITE_REPORT:
-	with open(REPORT_SUMMARY_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Date', 'Value', 'Residue', 'Normalized Value', 'Normalized Residue'])
-		elapsed = 0
-		for mindex, entry in enumerate(pm25):
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			w.writerow([elapsed_f, entry['date'], entry['val'], entry['residue'], entry['nval'], entry['nresidue']])
-			elapsed += READING_MS
-		print('Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
-
-# Write sequence report to file
-if WRITE_REPORT and len(sequence) > 0:
-	with open(REPORT_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Instrument', 'Gain'])
-		for step in sequence:
-			instrument = instruments[step['instrument_index']]
-			elapsed = step['elapsed_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			w.writerow([elapsed_f, instrument['file'], step['gain']])
-		f.seek(-2, os.SEEK_END) # remove newline
-		f.truncate()
-		print('Successfully wrote sequence report to file: '+REPORT_SEQUENCE_OUTPUT_FILE)
+	times = report.formatTimes(report.getElapsed(len(pm25), READING_MS))
+	rows = [[elapsed_f, entry['date'], entry['val'], entry['residue'], entry['nval'], entry['nresidue']] for elapsed_f, entry in zip(times, pm25)]
+	reports.write(REPORT_SUMMARY_OUTPUT_FILE, ['Time', 'Date', 'Value', 'Residue', 'Normalized Value', 'Normalized Residue'], rows, 'Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
+reports.close()
 
 # Write JSON data for the visualization
-if WRITE_JSON:
+if WRITE_JSON and VISUALIZATION_FORMAT == 'chunked':
+	meta = {
+		'pm25_min': pm25_min,
+		'pm25_max': pm25_max,
+		'pm25_count': pm25_count,
+		'total_ms': total_ms
+	}
+	visualization_file.write(VISUALIZATION_OUTPUT_FILE, pm25, meta, times=report.getElapsed(len(pm25), READING_MS).tolist())
+	print('Successfully wrote chunked visualization file: '+visualization_file.getIndexFile(VISUALIZATION_OUTPUT_FILE))
+elif WRITE_JSON:
 	json_data = {
 		'pm25_min': pm25_min,
 		'pm25_max': pm25_max,
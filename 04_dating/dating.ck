@@ -13,22 +13,48 @@ if (base_dir.charAt(base_dir.length()-1) != '/')
 // instrument object
 class Instrument {
     string filename;
-    SndBuf buf[8];
+    SndBuf buf[];
+    int buffers;
     //JCRev rvb;
     //NRev rvb;
     PRCRev rvb;
     int plays;
+    int loaded;
+    float rvb_max;
 }
 
 // data files
 base_dir + "data/ck_instruments.csv" => string instruments_file;
 base_dir + "data/ck_sequence.csv" => string sequence_file;
+base_dir + "data/ck_sequence.cks" => string binary_sequence_file;
+base_dir + "data/ck_schedule.csv" => string schedule_file;
 
 // read data files
 FileIO instruments_fio;
 FileIO sequence_fio;
 instruments_fio.open( instruments_file, FileIO.READ );
-sequence_fio.open( sequence_file, FileIO.READ );
+
+// prefer a binary sequence if the builder wrote one
+1 => int binary;
+0 => int binary_count;
+0 => int binary_read;
+sequence_fio.open( binary_sequence_file, FileIO.READ | FileIO.BINARY );
+if( sequence_fio.good() )
+{
+    // header: "CKS1", fields per record, record count
+    if( sequence_fio.readInt(IO.INT32) != 827542339 || sequence_fio.readInt(IO.INT32) != 6 )
+    {
+        cherr <= "can't read binary sequence file..."
+              <= IO.newline();
+        me.exit();
+    }
+    sequence_fio.readInt(IO.INT32) => binary_count;
+}
+else
+{
+    0 => binary;
+    sequence_fio.open( sequence_file, FileIO.READ );
+}
 
 // check if files are valid
 if( !instruments_fio.good() || !sequence_fio.good() )
@@ -40,12 +66,20 @@ if( !instruments_fio.good() || !sequence_fio.good() )
 
 // create instruments array
 Instrument instruments[256];
+int instrument_indices[0];
 
 // read instruments file
 while( instruments_fio.more() )
 {
-    // read instrument index and filename
-    Std.atoi(instruments_fio.readLine()) => int instrument_index;
+    // read instrument index (and its number of buffers if the builder sized them, e.g. "12,3") and filename
+    instruments_fio.readLine() => string index_line;
+    Std.atoi(index_line) => int instrument_index;
+    instrument_buffers => instruments[instrument_index].buffers;
+    index_line.find(",") => int buffers_match;
+    if (buffers_match >= 0)
+    {
+        Std.atoi(index_line.substring(buffers_match + 1)) => instruments[instrument_index].buffers;
+    }
     Std.atof(instruments_fio.readLine()) => float rvb_max;
     instruments_fio.readLine() => string filename;
     filename.find("\r") => int return_match;
@@ -55,14 +89,29 @@ while( instruments_fio.more() )
     }
     base_dir + filename => instruments[instrument_index].filename;
     0 => instruments[instrument_index].plays;
+    rvb_max => instruments[instrument_index].rvb_max;
     0 => instruments[instrument_index].rvb.mix;
-    // create buffers from filename
-    for( 0 => int i; i < instrument_buffers; i++ )
+    0 => instruments[instrument_index].loaded;
+    instrument_indices << instrument_index;
+
+}
+
+
+// create an instrument's buffers from its filename, unless they're loaded
+fun void loadInstrument(int instrument_index)
+{
+    if (instruments[instrument_index].loaded)
+    {
+        return;
+    }
+    SndBuf bufs[instruments[instrument_index].buffers];
+    bufs @=> instruments[instrument_index].buf;
+    for( 0 => int i; i < instruments[instrument_index].buffers; i++ )
     {
         instruments[instrument_index].filename => instruments[instrument_index].buf[i].read;
         // set position to end, so it won't play immediately upon open
         instruments[instrument_index].buf[i].samples() => instruments[instrument_index].buf[i].pos;
-        if (rvb_max > 0)
+        if (instruments[instrument_index].rvb_max > 0)
         {
            instruments[instrument_index].buf[i] => instruments[instrument_index].rvb => dac;
         }
@@ -71,22 +120,131 @@ while( instruments_fio.more() )
            instruments[instrument_index].buf[i] => dac;
         }
     }
+    1 => instruments[instrument_index].loaded;
+}
 
+// release an instrument's buffers, so its sample can be freed
+fun void unloadInstrument(int instrument_index)
+{
+    if (!instruments[instrument_index].loaded)
+    {
+        return;
+    }
+    for( 0 => int i; i < instruments[instrument_index].buffers; i++ )
+    {
+        if (instruments[instrument_index].rvb_max > 0)
+        {
+           instruments[instrument_index].buf[i] =< instruments[instrument_index].rvb;
+        }
+        else
+        {
+           instruments[instrument_index].buf[i] =< dac;
+        }
+    }
+    null @=> instruments[instrument_index].buf;
+    0 => instruments[instrument_index].loaded;
+}
+
+// read the sample schedule if the builder wrote one: ms into the sequence, 1 to load or 0 to release, instrument index
+int schedule_ms[0];
+int schedule_loads[0];
+int schedule_instruments[0];
+FileIO schedule_fio;
+schedule_fio.open( schedule_file, FileIO.READ );
+schedule_fio.good() => int scheduled;
+while( scheduled && schedule_fio.more() )
+{
+    schedule_ms << Std.atoi(schedule_fio.readLine());
+    schedule_loads << Std.atoi(schedule_fio.readLine());
+    schedule_instruments << Std.atoi(schedule_fio.readLine());
+}
+
+// load and release samples on schedule from the {next} entry, {skipped_ms} into the sequence
+fun void runSchedule(int next, int skipped_ms)
+{
+    now => time begin;
+    for( next => int i; i < schedule_ms.size(); i++ )
+    {
+        if (schedule_ms[i] - skipped_ms > 0)
+        {
+            begin + (schedule_ms[i] - skipped_ms)::ms => now;
+        }
+        if (schedule_loads[i])
+        {
+            loadInstrument(schedule_instruments[i]);
+        }
+        else
+        {
+            unloadInstrument(schedule_instruments[i]);
+        }
+    }
 }
 
+// load the samples due before the sequence starts (or every sample without a schedule), the rest as they're due
+0 => int skipped_ms;
+if (start > padding_start)
+{
+    start - padding_start => skipped_ms;
+}
+0 => int schedule_next;
+if (scheduled)
+{
+    while( schedule_next < schedule_ms.size() && schedule_ms[schedule_next] <= skipped_ms )
+    {
+        if (schedule_loads[schedule_next])
+        {
+            loadInstrument(schedule_instruments[schedule_next]);
+        }
+        else
+        {
+            unloadInstrument(schedule_instruments[schedule_next]);
+        }
+        schedule_next++;
+    }
+}
+else
+{
+    for( 0 => int i; i < instrument_indices.size(); i++ )
+    {
+        loadInstrument(instrument_indices[i]);
+    }
+}
 
 // Add padding
 padding_start::ms => now;
 padding_start => int elapsed_ms;
+if (scheduled)
+{
+    spork ~ runSchedule(schedule_next, skipped_ms);
+}
 
 // read sequence from file
-while( sequence_fio.more() ) {
-    Std.atoi(sequence_fio.readLine()) => int instrument_index;
-    Std.atoi(sequence_fio.readLine()) => int position;
-    Std.atof(sequence_fio.readLine()) => float gain;
-    Std.atof(sequence_fio.readLine()) => float rate;
-    Std.atof(sequence_fio.readLine()) => float reverb;
-    Std.atoi(sequence_fio.readLine()) => int milliseconds;
+while( (binary && binary_read < binary_count) || (!binary && sequence_fio.more()) ) {
+    int instrument_index;
+    int position;
+    float gain;
+    float rate;
+    float reverb;
+    int milliseconds;
+    if (binary)
+    {
+        sequence_fio.readInt(IO.INT32) => instrument_index;
+        sequence_fio.readInt(IO.INT32) => position;
+        sequence_fio.readInt(IO.INT32) / 1000000.0 => gain;
+        sequence_fio.readInt(IO.INT32) / 1000000.0 => rate;
+        sequence_fio.readInt(IO.INT32) / 1000000.0 => reverb;
+        sequence_fio.readInt(IO.INT32) => milliseconds;
+        binary_read++;
+    }
+    else
+    {
+        Std.atoi(sequence_fio.readLine()) => instrument_index;
+        Std.atoi(sequence_fio.readLine()) => position;
+        Std.atof(sequence_fio.readLine()) => gain;
+        Std.atof(sequence_fio.readLine()) => rate;
+        Std.atof(sequence_fio.readLine()) => reverb;
+        Std.atoi(sequence_fio.readLine()) => milliseconds;
+    }
 
     elapsed_ms + milliseconds => elapsed_ms;
     if (start > elapsed_ms)
@@ -100,8 +258,14 @@ while( sequence_fio.more() ) {
         milliseconds::ms => now;
     }
 
+    // load an instrument whose note comes before its sample was due
+    if (!instruments[instrument_index].loaded)
+    {
+        loadInstrument(instrument_index);
+    }
+
     // choose buffer index
-    instruments[instrument_index].plays % instrument_buffers => int buffer_index;
+    instruments[instrument_index].plays % instruments[instrument_index].buffers => int buffer_index;
     instruments[instrument_index].plays++;
 
     // set reverb
@@ -9,14 +9,32 @@
 import csv
 import json
 import math
+import numpy as np
 import os
+import sys
 import time
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import activation
+import jitter
+import report
+import sample_schedule
+import sequence_file
+import sequencer
+import table_cache
+import timeline
+import tracing
+import visualization_file
+import voices
+from sequence_buffer import SequenceBuffer
+
 # Config
 BPM = 60 # Beats per minute, e.g. 60, 75, 100, 120, 150
 DIVISIONS_PER_BEAT = 16 # e.g. 4 = quarter notes, 8 = eighth notes, etc
 BEATS_PER_PAIR = 1
 VARIANCE_MS = 20 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER_STREAMS = 'global' # 'global' keeps the jitter of earlier builds, 'instrument' gives each instrument its own reproducible jitter stream
 GAIN = 0.5 # base gain
 TEMPO = 1.0 # base tempo
 
@@ -26,18 +44,26 @@ PAIRS_INPUT_FILE = 'data/pairs.csv'
 REPORT_SUMMARY_OUTPUT_FILE = 'data/report_summary.csv'
 REPORT_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
+SCHEDULE_OUTPUT_FILE = 'data/ck_schedule.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+BINARY_SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.cks'
+TRACE_OUTPUT_FILE = 'data/trace.json'
 VISUALIZATION_OUTPUT_FILE = 'visualization/data/pairs.json'
 INSTRUMENTS_DIR = 'instruments/'
 
 # Output options
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'csv' # 'csv' or 'binary' (a compact .cks file that loads faster in ChucK)
+SIZE_BUFFERS = False # give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers
+SCHEDULE_SAMPLES = False # load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts
 WRITE_REPORT = True
 WRITE_JSON = True
+VISUALIZATION_FORMAT = 'json' # 'json' or 'chunked' (gzipped columns in windows of time with an index, so a visualization can load as it plays)
+WRITE_TRACE = False # write a Chrome trace of where the build's time and memory go (open it in chrome://tracing or ui.perfetto.dev)
 
 # Calculations
 BEAT_MS = round(60.0 / BPM * 1000)
-ROUND_TO_NEAREST = round(BEAT_MS/DIVISIONS_PER_BEAT)
+ROUND_TO_NEAREST = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # ms of a tick, the grid beats are laid out on
 PAIR_MS = BEATS_PER_PAIR * BEAT_MS
 
 print('Building sequence at '+str(BPM)+' BPM ('+str(BEAT_MS)+'ms per beat)')
@@ -45,8 +71,8 @@ print('Building sequence at '+str(BPM)+' BPM ('+str(BEAT_MS)+'ms per beat)')
 # Initialize Variables
 instruments = []
 pairs = []
-sequence = []
-hindex = 0
+sequence = SequenceBuffer(['reverb'])
+jitter_streams = {}
 total_ms = 0
 min_percent = None
 max_percent = None
@@ -57,17 +83,6 @@ max_year = None
 min_diff = None
 max_diff = None
 
-# For creating pseudo-random numbers
-def halton(index, base):
-	result = 0.0
-	f = 1.0 / base
-	i = 1.0 * index
-	while(i > 0):
-		result += f * (i % base)	
-		i = math.floor(i / base)
-		f = f / base
-	return result
-
 # Find index of first item that matches value
 def findInList(list, key, value):
 	found = -1
@@ -86,13 +101,12 @@ def mean(data, key):
 		list = [i[key] for i in data]
 		return sum(list)/n
 	
-# round {n} to nearest {nearest}
-def roundToNearest(n, nearest):
-	return 1.0 * round(1.0*n/nearest) * nearest
-
+if WRITE_TRACE:
+	tracing.start(TRACE_OUTPUT_FILE)
+tracing.phase('load')
 # Read instruments from file
 with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter=',')
+	r = table_cache.reader(f, delimiter=',')
 	next(r, None) # remove header
 	for file,f_percent_min,f_percent_max,m_percent_min,m_percent_max,t_percent_min,t_percent_max,f_avg_min,f_avg_max,m_avg_min,m_avg_max,t_avg_min,t_avg_max,rvb_max,gain,tempo,tempo_offset,interval_phase,interval,interval_offset,active in r:
 		if int(active):
@@ -128,50 +142,48 @@ with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
 
 # Read pairs from file
 elapsed = 0
-with open(PAIRS_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter=',')
-	next(r, None) # remove header
-	for _order, _f_race, _m_race, _f_percent, _m_percent, _diff, _total, _year in r:
-		# Keep track of min/max
-		if min_percent is None:
-			min_percent = int(_f_percent)
-		if max_percent is None:
-			max_percent = int(_f_percent)
-		if min_total is None:
-			min_total = int(_total)
-		if max_total is None:
-			max_total = int(_total)
-		if min_year is None:
-			min_year = int(_year)
-		if max_year is None:
-			max_year = int(_year)
-		if min_diff is None:
-			min_diff = int(_diff)
-		if max_diff is None:
-			max_diff = int(_diff)
-		min_percent = min([min_percent, int(_f_percent), int(_m_percent)])
-		max_percent = max([max_percent, int(_f_percent), int(_m_percent)])
-		min_total = min([min_total, int(_total)])
-		max_total = max([max_total, int(_total)])
-		min_year = min([min_year, int(_year)])
-		max_year = max([max_year, int(_year)])
-		min_diff = min([min_diff, int(_diff)])
-		max_diff = max([max_diff, int(_diff)])
-		# Add pair to list
-		index = len(pairs)
-		pairs.append({
-			'index': index,
-			'f_race': _f_race,
-			'm_race': _m_race,
-			'f_percent': int(_f_percent),
-			'm_percent': int(_m_percent),
-			'diff_percent': int(_diff),
-			'total': int(_total),
-			'year': int(_year),
-			'start_ms': elapsed,
-			'stop_ms': elapsed + PAIR_MS
-		})
-		elapsed += PAIR_MS
+columns = table_cache.readColumns(PAIRS_INPUT_FILE)
+for _order, _f_race, _m_race, _f_percent, _m_percent, _diff, _total, _year in table_cache.getRows(columns, [('Order', None), ('Female Race', str), ('Male Race', str), ('Female Attraction', int), ('Male Attraction', int), ('Diff', int), ('Total', int), ('Year', int)]):
+	# Keep track of min/max
+	if min_percent is None:
+		min_percent = _f_percent
+	if max_percent is None:
+		max_percent = _f_percent
+	if min_total is None:
+		min_total = _total
+	if max_total is None:
+		max_total = _total
+	if min_year is None:
+		min_year = _year
+	if max_year is None:
+		max_year = _year
+	if min_diff is None:
+		min_diff = _diff
+	if max_diff is None:
+		max_diff = _diff
+	min_percent = min([min_percent, _f_percent, _m_percent])
+	max_percent = max([max_percent, _f_percent, _m_percent])
+	min_total = min([min_total, _total])
+	max_total = max([max_total, _total])
+	min_year = min([min_year, _year])
+	max_year = max([max_year, _year])
+	min_diff = min([min_diff, _diff])
+	max_diff = max([max_diff, _diff])
+	# Add pair to list
+	index = len(pairs)
+	pairs.append({
+		'index': index,
+		'f_race': _f_race,
+		'm_race': _m_race,
+		'f_percent': _f_percent,
+		'm_percent': _m_percent,
+		'diff_percent': _diff,
+		'total': _total,
+		'year': _year,
+		'start_ms': elapsed,
+		'stop_ms': elapsed + PAIR_MS
+	})
+	elapsed += PAIR_MS
 
 # Report pair data
 print('Retrieved pairs data with '+ str(len(pairs)) + ' data points')
@@ -186,6 +198,8 @@ print('Main sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds))
 print(str(PAIR_MS)+'ms per pair')
 print(str(PAIR_MS*6)+'ms per pair total')
 
+tracing.phase('normalize')
+tracing.count(len(pairs))
 # Add normalized values
 for i, pair in enumerate(pairs):	
 	f_percent = (1.0 * pair['f_percent'] - min_percent) / (max_percent - min_percent)
@@ -211,114 +225,74 @@ for i, pair in enumerate(pairs):
 			pairs[p['index']]['total_n_avg'] = t_avg
 		avg_queue = []
 
-# Return if the instrument should be played in the given interval
-def isValidInterval(instrument, elapsed_ms):
-	interval_ms = instrument['interval_ms']
-	interval = instrument['interval']
-	interval_offset = instrument['interval_offset']	
-	return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
-
 # Add beats to sequence
 def addBeatsToSequence(instrument, rvb, duration, ms, beat_ms, round_to):
 	global sequence
-	global hindex
+	global jitter_streams
 	offset_ms = int(instrument['tempo_offset'] * instrument['beat_ms'])
-	ms += offset_ms
-	previous_ms = int(ms)
-	remaining_duration = int(duration)
-	elapsed_duration = offset_ms
-	while remaining_duration > 0:
-		elapsed_ms = int(ms)
-		percent_complete = 1.0 * elapsed_duration / duration
-		this_beat_ms = instrument['beat_ms']
-		# add to sequence if in valid interval
-		if isValidInterval(instrument, elapsed_ms):
-			h = halton(hindex, 3)
-			variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-			sequence.append({
-				'instrument_index': instrument['index'],
-				'instrument': instrument,
-				'position': 0,
-				'rate': 1,
-				'gain': instrument['gain'],
-				'reverb': round(rvb,2),
-				'elapsed_ms': max([elapsed_ms + variance, 0])
-			})
-			hindex += 1
-		remaining_duration -= this_beat_ms
-		elapsed_duration += this_beat_ms
-		ms += this_beat_ms
+	beats = sequencer.getBeats(instrument, ms, duration, round_to, offset_ms=offset_ms, min_ms=1, tempo='constant', beat_ms=instrument['beat_ms'], gain='constant')
+	count = len(beats['ms'])
+	indices = jitter.takeIndices(jitter_streams, jitter.getStream(JITTER_STREAMS, instrument['index']), count)
+	variance = jitter.getVariance(indices, VARIANCE_MS)
+	elapsed_ms = jitter.addVariance(beats['ms'], variance)
+	sequence.append(instrument['index'], elapsed_ms, instrument['gain'], reverb=round(rvb,2))
 
+tracing.phase('match instruments')
 # Build sequence
-for instrument in instruments:
-	ms = 0
-	queue_duration = 0
-	fp0 = instrument['f_percent_min']
-	fp1 = instrument['f_percent_max']
-	mp0 = instrument['m_percent_min']
-	mp1 = instrument['m_percent_max']
-	tp0 = instrument['t_percent_min']
-	tp1 = instrument['t_percent_max']
-	fa0 = instrument['f_avg_min']
-	fa1 = instrument['f_avg_max']
-	ma0 = instrument['m_avg_min']
-	ma1 = instrument['m_avg_max']
-	ta0 = instrument['t_avg_min']
-	ta1 = instrument['t_avg_max']	
-	# Each pair
-	for pair in pairs:
-		# Check if instrument is valid for this pair
-		fp = pair['f_percent_n']
-		mp = pair['m_percent_n']
-		tp = pair['total_n']
-		fa = pair['f_percent_n_avg']
-		ma = pair['m_percent_n_avg']
-		ta = pair['total_n_avg']
-		is_valid = (fp>=fp0 and fp<fp1 and mp>=mp0 and mp<mp1 and tp>=tp0 and tp<tp1 and fa>=fa0 and fa<fa1 and ma>=ma0 and ma<ma1 and ta>=ta0 and ta<ta1)
-		if instrument['rvb_max'] > 0:
-			if is_valid:
-				rvb = pair['diff_percent_n'] * instrument['rvb_max']
-				addBeatsToSequence(instrument.copy(), rvb, PAIR_MS, ms, BEAT_MS, ROUND_TO_NEAREST)
-			ms += PAIR_MS
-		else:
-			# Instrument not here, just add the pair duration and continue
-			if not is_valid and queue_duration > 0:
-				addBeatsToSequence(instrument.copy(), 0, queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
-				ms += queue_duration + PAIR_MS
-				queue_duration = 0
-			elif not is_valid:
-				ms += PAIR_MS
-			else:
-				queue_duration += PAIR_MS
-	if queue_duration > 0:
-		addBeatsToSequence(instrument.copy(), 0, queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
+# Check which instruments are valid for each pair
+mins = activation.getColumns(instruments, ['f_percent_min', 'm_percent_min', 't_percent_min', 'f_avg_min', 'm_avg_min', 't_avg_min'])
+maxs = activation.getColumns(instruments, ['f_percent_max', 'm_percent_max', 't_percent_max', 'f_avg_max', 'm_avg_max', 't_avg_max'])
+features = activation.getColumns(pairs, ['f_percent_n', 'm_percent_n', 'total_n', 'f_percent_n_avg', 'm_percent_n_avg', 'total_n_avg'])
+mask = activation.getMask(mins, maxs, features)
+reverb = np.array([instrument['rvb_max'] > 0 for instrument in instruments])[:, np.newaxis]
+# Instruments with reverb play each valid pair on its own, the rest play over queued pairs
+pair_segments = [(index, pairs[p]['start_ms'], PAIR_MS, p + 1) for index, p in zip(*np.nonzero(mask & reverb))]
+queue_segments = activation.getQueueSegments(mask & ~reverb, PAIR_MS)
+tracing.phase('generate beats')
+for index, ms, queue_duration, stop in sorted(pair_segments + queue_segments, key=lambda s: s[0]):
+	instrument = instruments[index]
+	rvb = 0
+	if instrument['rvb_max'] > 0:
+		rvb = pairs[stop-1]['diff_percent_n'] * instrument['rvb_max']
+	addBeatsToSequence(instrument, rvb, queue_duration, ms, BEAT_MS, ROUND_TO_NEAREST)
+tracing.count(len(sequence))
 
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for index, step in enumerate(sequence):
-	sequence[index]['milliseconds'] = step['elapsed_ms'] - elapsed
-	elapsed = step['elapsed_ms']
+sequence.sort()
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments to file
 if WRITE_SEQUENCE and len(instruments) > 0:
+	buffers = voices.getBufferCounts(sequence, instruments) if SIZE_BUFFERS else None
 	with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)	
 		for index, instrument in enumerate(instruments):
-			w.writerow([index])
+			w.writerow([index] if buffers is None else [index, buffers[index]])
 			w.writerow([instrument['rvb_max']])
 			w.writerow([instrument['file']])
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
+		if buffers is not None:
+			print('Sized instrument buffers: %s in all, at most %s for an instrument' % (sum(buffers), max(buffers)))
+	schedule = sample_schedule.getSchedule(sequence, instruments) if SCHEDULE_SAMPLES else None
+	sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
+
+# Write sequence report to file on another thread while the sequence is written
+reports = report.ReportWriter()
+if WRITE_REPORT and len(sequence) > 0:
+	reports.writeSequence(REPORT_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain', 'Reverb'], sequence.merged(), instruments, ['gain', 'reverb'])
 
 # Write sequence to file
-if WRITE_SEQUENCE and len(sequence) > 0:
+if WRITE_SEQUENCE and len(sequence) > 0 and SEQUENCE_FORMAT == 'binary':
+	sequence_file.writeBinary(BINARY_SEQUENCE_OUTPUT_FILE, sequence)
+	print('Successfully wrote sequence to file: '+BINARY_SEQUENCE_OUTPUT_FILE)
+elif WRITE_SEQUENCE and len(sequence) > 0:
 	with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)	
-		for step in sequence:
+		for step in sequence.steps():
 			w.writerow([step['instrument_index']])
 			w.writerow([step['position']])
 			w.writerow([step['gain']])
@@ -328,38 +302,28 @@ if WRITE_SEQUENCE and len(sequence) > 0:
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+	# players prefer a binary sequence, so don't leave one from an earlier build
+	if os.path.exists(BINARY_SEQUENCE_OUTPUT_FILE):
+		os.remove(BINARY_SEQUENCE_OUTPUT_FILE)
 
 # Write summary files
 if WRITE_REPORT:
-	with open(REPORT_SUMMARY_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Year', 'F Race', 'M Race', 'F Percent', 'M Percent', 'T Percent', 'F Avg', 'M Avg', 'T Avg'])
-		for pair in pairs:
-			elapsed = pair['start_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			w.writerow([elapsed_f, pair['year'], pair['f_race'], pair['m_race'], pair['f_percent_n'], pair['m_percent_n'], pair['total_n'], pair['f_percent_n_avg'], pair['m_percent_n_avg'], pair['total_n_avg']])
-		print('Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
-
-# Write sequence report to file
-if WRITE_REPORT and len(sequence) > 0:
-	with open(REPORT_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Instrument', 'Gain', 'Reverb'])
-		for step in sequence:
-			instrument = instruments[step['instrument_index']]
-			elapsed = step['elapsed_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			w.writerow([elapsed_f, instrument['file'], step['gain'], step['reverb']])
-		f.seek(-2, os.SEEK_END) # remove newline
-		f.truncate()
-		print('Successfully wrote sequence report to file: '+REPORT_SEQUENCE_OUTPUT_FILE)
+	times = report.formatTimes([pair['start_ms'] for pair in pairs])
+	rows = [[elapsed_f, pair['year'], pair['f_race'], pair['m_race'], pair['f_percent_n'], pair['m_percent_n'], pair['total_n'], pair['f_percent_n_avg'], pair['m_percent_n_avg'], pair['total_n_avg']] for elapsed_f, pair in zip(times, pairs)]
+	reports.write(REPORT_SUMMARY_OUTPUT_FILE, ['Time', 'Year', 'F Race', 'M Race', 'F Percent', 'M Percent', 'T Percent', 'F Avg', 'M Avg', 'T Avg'], rows, 'Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
+reports.close()
 
 # Write JSON data for the visualization
-if WRITE_JSON:
+if WRITE_JSON and VISUALIZATION_FORMAT == 'chunked':
+	meta = {
+		'min_percent': min_percent,
+		'max_percent': max_percent,
+		'min_year': min_year,
+		'max_year': max_year
+	}
+	visualization_file.write(VISUALIZATION_OUTPUT_FILE, pairs, meta, times='start_ms')
+	print('Successfully wrote chunked visualization file: '+visualization_file.getIndexFile(VISUALIZATION_OUTPUT_FILE))
+elif WRITE_JSON:
 	json_data = {
 		'min_percent': min_percent,
 		'max_percent': max_percent,
@@ -10,13 +10,29 @@ import csv
 import json
 import math
 import os
+import sys
 import time
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import activation
+import jitter
+import report
+import sample_schedule
+import sequence_file
+import sequencer
+import table_cache
+import timeline
+import tracing
+import voices
+from sequence_buffer import SequenceBuffer
+
 # Config
 BPM = 60 # Beats per minute, e.g. 60, 75, 100, 120, 150
 DIVISIONS_PER_BEAT = 4 # e.g. 4 = quarter notes, 8 = eighth notes, etc
 PX_PER_BEAT = 40
 VARIANCE_MS = 20 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER_STREAMS = 'global' # 'global' keeps the jitter of earlier builds, 'instrument' gives each instrument its own reproducible jitter stream
 GAIN = 1.0 # base gain
 TEMPO = 1.0 # base tempo
 PERCENT_TOTAL_NOTE_THRESHOLD = 0.16
@@ -32,18 +48,25 @@ REPORT_SUMMARY_OUTPUT_FILE = 'data/report_summary.csv'
 REPORT_NOTES_OUTPUT_FILE = 'data/report_summary_notes.csv'
 REPORT_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
+SCHEDULE_OUTPUT_FILE = 'data/ck_schedule.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+BINARY_SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.cks'
+TRACE_OUTPUT_FILE = 'data/trace.json'
 VISUALIZATION_OUTPUT_FILE = 'visualization/data/paintings.json'
 INSTRUMENTS_DIR = 'instruments/'
 
 # Output options
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'csv' # 'csv' or 'binary' (a compact .cks file that loads faster in ChucK)
+SIZE_BUFFERS = False # give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers
+SCHEDULE_SAMPLES = False # load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts
 WRITE_REPORT = True
 WRITE_JSON = False
+WRITE_TRACE = False # write a Chrome trace of where the build's time and memory go (open it in chrome://tracing or ui.perfetto.dev)
 
 # Calculations
 BEAT_MS = round(60.0 / BPM * 1000)
-ROUND_TO_NEAREST = round(BEAT_MS/DIVISIONS_PER_BEAT)
+ROUND_TO_NEAREST = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # ms of a tick, the grid beats are laid out on
 PX_PER_MS = PX_PER_BEAT / BEAT_MS
 
 print('Building sequence at '+str(BPM)+' BPM ('+str(BEAT_MS)+'ms per beat)')
@@ -54,21 +77,10 @@ paintings = []
 events = []
 synesthesia = []
 notes = []
-sequence = []
-hindex = 0
+sequence = SequenceBuffer()
+jitter_streams = {}
 total_ms = 0
 
-# For creating pseudo-random numbers
-def halton(index, base):
-	result = 0.0
-	f = 1.0 / base
-	i = 1.0 * index
-	while(i > 0):
-		result += f * (i % base)	
-		i = math.floor(i / base)
-		f = f / base
-	return result
-
 # Find index of first item that matches value
 def findInList(list, key, value):
 	found = -1
@@ -109,13 +121,12 @@ def stdev(data):
 def floorToNearest(n, nearest):
 	return 1.0 * math.floor(1.0*n/nearest) * nearest
 
-# round {n} to nearest {nearest}
-def roundToNearest(n, nearest):
-	return 1.0 * round(1.0*n/nearest) * nearest
-	
+if WRITE_TRACE:
+	tracing.start(TRACE_OUTPUT_FILE)
+tracing.phase('load')
 # Read instruments from file
 with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter=',')
+	r = table_cache.reader(f, delimiter=',')
 	next(r, None) # remove header
 	for file,artist,size_min,size_max,bri_min,bri_max,var_min,var_max,year_min,year_max,note,from_gain,to_gain,from_tempo,to_tempo,tempo_offset,interval_phase,interval,interval_offset,active in r:
 		if int(active):
@@ -152,7 +163,7 @@ with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
 
 # Read synesthesia from file
 with open(SYNESTHESIA_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter=',')
+	r = table_cache.reader(f, delimiter=',')
 	next(r, None) # remove header
 	for _hue, _saturation, _color, _note in r:
 		synesthesia.append({
@@ -184,67 +195,67 @@ def getNote(hue, saturation):
 # Read paintings from file
 min_year = None
 max_year = None
-with open(PAINTING_SAMPLES_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter=',')
-	next(r, None) # remove header
-	current_file = None
-	for _title,_artist,_position,_year,_file,_painting_width,_painting_height,_year_start_ms,_year_stop_ms,_hue,_saturation,_brightness,_x,_y,_width,_height in r:
-		_area = int(_width) * int(_height)
-		
-		# Calc min/max
-		min_year = int(_year) if min_year is None else min_year
-		max_year = int(_year) if max_year is None else max_year
-		min_year = min([min_year, int(_year)])
-		max_year = max([max_year, int(_year)])
-		
-		# Retrieve note
-		note = getNote(int(_hue), int(_saturation))
-		
-		# Init sample
-		sample = {
-			'hue': int(_hue),
-			'saturation': int(_saturation),
-			'brightness': int(_brightness),
-			'x': int(_x),
-			'y': int(_y),
-			'width': int(_width),
-			'height': int(_height),
-			'area': _area,
-			'note': note
-		}
+columns = table_cache.readColumns(PAINTING_SAMPLES_INPUT_FILE)
+current_file = None
+for _title,_artist,_position,_year,_file,_painting_width,_painting_height,_year_start_ms,_year_stop_ms,_hue,_saturation,_brightness,_x,_y,_width,_height in table_cache.getRows(columns, [('title', str), ('artist', str), ('position', int), ('year', int), ('file', str), ('painting_width', int), ('painting_height', int), ('year_start_ms', int), ('year_stop_ms', None), ('hue', int), ('saturation', int), ('brightness', int), ('x', int), ('y', int), ('width', int), ('height', int)]):
+	_area = _width * _height
+	
+	# Calc min/max
+	min_year = _year if min_year is None else min_year
+	max_year = _year if max_year is None else max_year
+	min_year = min([min_year, _year])
+	max_year = max([max_year, _year])
+	
+	# Retrieve note
+	note = getNote(_hue, _saturation)
+	
+	# Init sample
+	sample = {
+		'hue': _hue,
+		'saturation': _saturation,
+		'brightness': _brightness,
+		'x': _x,
+		'y': _y,
+		'width': _width,
+		'height': _height,
+		'area': _area,
+		'note': note
+	}
+	
+	# Add painting to list
+	if current_file != _file:
+		index = len(paintings)
+		duration = 1.0 * _painting_width / PX_PER_MS
+		paintings.append({
+			'index': index,
+			'title': _title,
+			'artist': _artist,
+			'position': _position,
+			'year': _year,
+			'file': _file,
+			'width': _painting_width,
+			'height': _painting_height,
+			'start_ms': _year_start_ms,
+			'stop_ms': _year_start_ms + duration,
+			'samples': [sample],
+			'notes': [
+				{'note': note, 'areas': [_area], 'brightnesses': [_brightness]}
+			]
+		})
+		current_file = _file
 		
-		# Add painting to list
-		if current_file != _file:
-			index = len(paintings)
-			duration = 1.0 * int(_painting_width) / PX_PER_MS
-			paintings.append({
-				'index': index,
-				'title': _title,
-				'artist': _artist,
-				'position': int(_position),
-				'year': int(_year),
-				'file': _file,
-				'width': int(_painting_width),
-				'height': int(_painting_height),
-				'start_ms': int(_year_start_ms),
-				'stop_ms': int(_year_start_ms) + duration,
-				'samples': [sample],
-				'notes': [
-					{'note': note, 'areas': [_area], 'brightnesses': [int(_brightness)]}
-				]
-			})
-			current_file = _file
-			
-		# Append sample to current painting
+	# Append sample to current painting
+	else:
+		paintings[-1]['samples'].append(sample)
+		note_i = findInList(paintings[-1]['notes'], 'note', note)
+		if note_i >= 0:
+			paintings[-1]['notes'][note_i]['areas'].append(_area)
+			paintings[-1]['notes'][note_i]['brightnesses'].append(_brightness)
 		else:
-			paintings[-1]['samples'].append(sample)
-			note_i = findInList(paintings[-1]['notes'], 'note', note)
-			if note_i >= 0:
-				paintings[-1]['notes'][note_i]['areas'].append(_area)
-				paintings[-1]['notes'][note_i]['brightnesses'].append(int(_brightness))
-			else:
-				paintings[-1]['notes'].append({'note': note, 'areas': [_area], 'brightnesses': [int(_brightness)]})
+			paintings[-1]['notes'].append({'note': note, 'areas': [_area], 'brightnesses': [_brightness]})
 
+tracing.phase('normalize')
+tracing.count(len(paintings))
 # Aggregate, normalize, sort data
 max_area_mean = None
 min_area_mean = None
@@ -321,127 +332,70 @@ total_seconds = int(1.0*total_ms/1000)
 print('Main sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds)) + ' (' + str(total_seconds) + 's)')
 print(str(PX_PER_BEAT)+'px per beat')
 
-# Multiplier based on sine curve
-def getMultiplier(percent_complete, rad=1.0):
-	radians = percent_complete * (math.pi * rad)
-	multiplier = math.sin(radians)
-	if multiplier < 0:
-		multiplier = 0.0
-	elif multiplier > 1:
-		multplier = 1.0
-	return multiplier
-
-# Retrieve gain based on current beat
-def getGain(instrument, percent_complete):
-	multiplier = getMultiplier(percent_complete)
-	from_gain = instrument['from_gain']
-	to_gain = instrument['to_gain']
-	min_gain = min(from_gain, to_gain)
-	gain = multiplier * (to_gain - from_gain) + from_gain
-	gain = max(min_gain, round(gain, 2))
-	return gain
-
-# Get beat duration in ms based on current point in time
-def getBeatMs(instrument, percent_complete, round_to):
-	multiplier = getMultiplier(percent_complete)
-	from_beat_ms = instrument['from_beat_ms']
-	to_beat_ms = instrument['to_beat_ms']	
-	ms = multiplier * (to_beat_ms - from_beat_ms) + from_beat_ms
-	ms = int(roundToNearest(ms, round_to))
-	return ms
-
-# Return if the instrument should be played in the given interval
-def isValidInterval(instrument, elapsed_ms):
-	interval_ms = instrument['interval_ms']
-	interval = instrument['interval']
-	interval_offset = instrument['interval_offset']	
-	return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
-
 # Add beats to sequence
 def addBeatsToSequence(instrument, duration, ms, round_to):
 	global sequence
-	global hindex
-	beat_ms = int(roundToNearest(instrument['beat_ms'], round_to))
+	global jitter_streams
+	beat_ms = int(sequencer.roundToNearest(instrument['beat_ms'], round_to))
 	offset_ms = int(instrument['tempo_offset'] * beat_ms)
-	ms += offset_ms	
-	previous_ms = int(ms)
-	from_beat_ms = instrument['from_beat_ms']
-	to_beat_ms = instrument['to_beat_ms']
-	min_ms = min(from_beat_ms, to_beat_ms)	
-	remaining_duration = int(duration)
-	elapsed_duration = offset_ms
-	while remaining_duration >= min_ms:
-		elapsed_ms = int(ms)
-		elapsed_beat = int((elapsed_ms-previous_ms) / beat_ms)
-		percent_complete = 1.0 * elapsed_duration / duration
-		this_beat_ms = getBeatMs(instrument, percent_complete, round_to)		
-		# add to sequence if in valid interval
-		if isValidInterval(instrument, elapsed_ms):
-			h = halton(hindex, 3)
-			variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-			sequence.append({
-				'instrument_index': instrument['index'],
-				'instrument': instrument,
-				'position': 0,
-				'rate': 1,
-				'gain': getGain(instrument, percent_complete),
-				'elapsed_ms': max([elapsed_ms + variance, 0])
-			})
-			hindex += 1
-		remaining_duration -= this_beat_ms
-		elapsed_duration += this_beat_ms
-		ms += this_beat_ms
-
+	beats = sequencer.getBeats(instrument, ms, duration, round_to, offset_ms=offset_ms)
+	count = len(beats['ms'])
+	indices = jitter.takeIndices(jitter_streams, jitter.getStream(JITTER_STREAMS, instrument['index']), count)
+	variance = jitter.getVariance(indices, VARIANCE_MS)
+	elapsed_ms = jitter.addVariance(beats['ms'], variance)
+	sequence.append(instrument['index'], elapsed_ms, beats['gain'])
+
+tracing.phase('match instruments')
 # Build sequence
-for instrument in instruments:
-	
-	ms = None
-	queue_duration = 0
-	
-	# Go through each painting
-	for painting in paintings:
-	
-		is_valid = (painting['artist']==instrument['artist'] or instrument['artist']=='any') and (instrument['note']==painting['primary_note']['note'] or instrument['note']=='any') and painting['mean_area_i'] >= instrument['size_min'] and painting['mean_area_i'] < instrument['size_max'] and painting['mean_brightness_i'] >= instrument['bri_min'] and painting['mean_brightness_i'] < instrument['bri_max'] and painting['variance_hue_i'] >= instrument['var_min'] and painting['variance_hue_i'] < instrument['var_max'] and painting['year'] >= instrument['year_min'] and painting['year'] <= instrument['year_max']
-		
-		# If note is valid, add it to sequence
-		if not is_valid and queue_duration > 0 and ms != None or is_valid and ms != None and painting['start_ms'] > (ms+queue_duration):
-			addBeatsToSequence(instrument.copy(), queue_duration, ms, ROUND_TO_NEAREST)
-			ms = None
-			queue_duration = 0
-			
-		if is_valid:			
-			if ms==None:
-				ms = painting['start_ms']	
-			queue_duration += (painting['stop_ms'] - painting['start_ms'])
-	
-	if queue_duration > 0 and ms != None:
-		addBeatsToSequence(instrument.copy(), queue_duration, ms, ROUND_TO_NEAREST)
-
+# Check which instruments are valid for each painting
+mins = activation.getColumns(instruments, ['size_min', 'bri_min', 'var_min', 'year_min'])
+maxs = activation.getColumns(instruments, ['size_max', 'bri_max', 'var_max', 'year_max'])
+features = activation.getColumns(paintings, ['mean_area_i', 'mean_brightness_i', 'variance_hue_i', 'year'])
+mask = activation.getMask(mins, maxs, features, inclusive_max=[3])
+mask &= activation.getMatches([instrument['artist'] for instrument in instruments], [painting['artist'] for painting in paintings])
+mask &= activation.getMatches([instrument['note'] for instrument in instruments], [painting['primary_note']['note'] for painting in paintings])
+start_ms = [painting['start_ms'] for painting in paintings]
+stop_ms = [painting['stop_ms'] for painting in paintings]
+tracing.phase('generate beats')
+for index, ms, queue_duration, stop in activation.getSpanSegments(mask, start_ms, stop_ms):
+	addBeatsToSequence(instruments[index], queue_duration, ms, ROUND_TO_NEAREST)
+tracing.count(len(sequence))
+
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for index, step in enumerate(sequence):
-	sequence[index]['milliseconds'] = step['elapsed_ms'] - elapsed
-	elapsed = step['elapsed_ms']
+sequence.sort()
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments to file
 if WRITE_SEQUENCE and len(instruments) > 0:
+	buffers = voices.getBufferCounts(sequence, instruments) if SIZE_BUFFERS else None
 	with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)	
 		for index, instrument in enumerate(instruments):
-			w.writerow([index])
+			w.writerow([index] if buffers is None else [index, buffers[index]])
 			w.writerow([instrument['file']])
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
+		if buffers is not None:
+			print('Sized instrument buffers: %s in all, at most %s for an instrument' % (sum(buffers), max(buffers)))
+	schedule = sample_schedule.getSchedule(sequence, instruments) if SCHEDULE_SAMPLES else None
+	sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
+
+# Write sequence report to file on another thread while the sequence is written
+reports = report.ReportWriter()
+if WRITE_REPORT and len(sequence) > 0:
+	reports.writeSequence(REPORT_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain'], sequence.merged(), instruments, ['gain'])
 
 # Write sequence to file
-if WRITE_SEQUENCE and len(sequence) > 0:
+if WRITE_SEQUENCE and len(sequence) > 0 and SEQUENCE_FORMAT == 'binary':
+	sequence_file.writeBinary(BINARY_SEQUENCE_OUTPUT_FILE, sequence)
+	print('Successfully wrote sequence to file: '+BINARY_SEQUENCE_OUTPUT_FILE)
+elif WRITE_SEQUENCE and len(sequence) > 0:
 	with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)	
-		for step in sequence:
+		for step in sequence.steps():
 			w.writerow([step['instrument_index']])
 			w.writerow([step['position']])
 			w.writerow([step['gain']])
@@ -450,75 +404,51 @@ if WRITE_SEQUENCE and len(sequence) > 0:
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+	# players prefer a binary sequence, so don't leave one from an earlier build
+	if os.path.exists(BINARY_SEQUENCE_OUTPUT_FILE):
+		os.remove(BINARY_SEQUENCE_OUTPUT_FILE)
 
 # Write summary files
 if WRITE_REPORT:
 
 	# Notes report
-	with open(REPORT_NOTES_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		header = ['Time', 'Title', 'File']
-		header.extend(notes)
-		w.writerow(header)
-		for painting in paintings:
-			elapsed = painting['start_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			row = [elapsed_f, painting['title'], painting['file']]
-			for note in notes:
-				note_i = findInList(painting['notes'], 'note', note)
-				if note_i >= 0:
-					# row.append(painting['notes'][note_i]['total_area'])
-					row.append(round(painting['notes'][note_i]['percent_total']*100, 10))
-				else:
-					row.append(0)
-			w.writerow(row)
-		print('Successfully wrote summary file: '+REPORT_NOTES_OUTPUT_FILE)
-	
+	header = ['Time', 'Title', 'File']
+	header.extend(notes)
+	rows = []
+	for elapsed_f, painting in zip(report.formatTimes([painting['start_ms'] for painting in paintings]), paintings):
+		row = [elapsed_f, painting['title'], painting['file']]
+		for note in notes:
+			note_i = findInList(painting['notes'], 'note', note)
+			if note_i >= 0:
+				# row.append(painting['notes'][note_i]['total_area'])
+				row.append(round(painting['notes'][note_i]['percent_total']*100, 10))
+			else:
+				row.append(0)
+		rows.append(row)
+	reports.write(REPORT_NOTES_OUTPUT_FILE, header, rows, 'Successfully wrote summary file: '+REPORT_NOTES_OUTPUT_FILE)
+
 	# Paintings report
-	with open(REPORT_SUMMARY_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		artists = set([p['artist'] for p in paintings])
-		years = set([p['year'] for p in paintings])
-		header = ['Time', 'Year']
+	artists = set([p['artist'] for p in paintings])
+	years = set([p['year'] for p in paintings])
+	header = ['Time', 'Year']
+	for artist in artists:
+		header.append(artist + ' Mean Brightness')
+		header.append(artist + ' Mean Area')
+		header.append(artist + ' Hue Variance')
+	y_paintings = [[p for p in paintings if p['year'] == year] for year in years]
+	rows = []
+	for elapsed_f, year, paintings_in_year in zip(report.formatTimes([ps[0]['start_ms'] for ps in y_paintings]), years, y_paintings):
+		row = [elapsed_f, year]
 		for artist in artists:
-			header.append(artist + ' Mean Brightness')
-			header.append(artist + ' Mean Area')
-			header.append(artist + ' Hue Variance')
-		w.writerow(header)
-		for year in years:
-			y_paintings = [p for p in paintings if p['year'] == year]		
-			elapsed = y_paintings[0]['start_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			row = [elapsed_f, year]
-			for artist in artists:
-				a_paintings = [p for p in y_paintings if p['artist'] == artist]
-				if len(a_paintings) > 0:
-					p = a_paintings[0]
-					row.extend([p['mean_brightness_i'], p['mean_area_i'], p['variance_hue_i']])
-				else:
-					row.extend(['','',''])
-			w.writerow(row)
-		print('Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
-
-# Write sequence report to file
-if WRITE_REPORT and len(sequence) > 0:
-	with open(REPORT_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		w.writerow(['Time', 'Instrument', 'Gain'])
-		for step in sequence:
-			instrument = instruments[step['instrument_index']]
-			elapsed = step['elapsed_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			w.writerow([elapsed_f, instrument['file'], step['gain']])
-		f.seek(-2, os.SEEK_END) # remove newline
-		f.truncate()
-		print('Successfully wrote sequence report to file: '+REPORT_SEQUENCE_OUTPUT_FILE)
+			a_paintings = [p for p in paintings_in_year if p['artist'] == artist]
+			if len(a_paintings) > 0:
+				p = a_paintings[0]
+				row.extend([p['mean_brightness_i'], p['mean_area_i'], p['variance_hue_i']])
+			else:
+				row.extend(['','',''])
+		rows.append(row)
+	reports.write(REPORT_SUMMARY_OUTPUT_FILE, header, rows, 'Successfully wrote summary file: '+REPORT_SUMMARY_OUTPUT_FILE)
+reports.close()
 
 # Write JSON data for the visualization
 if WRITE_JSON:
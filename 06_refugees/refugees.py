@@ -10,13 +10,31 @@
 import csv
 import json
 import math
+import numpy as np
 import os
+import sys
 import time
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import activation
+import jitter
+import report
+import sample_schedule
+import sequence_file
+import sequencer
+import table_cache
+import timeline
+import tracing
+import visualization_file
+import voices
+from sequence_buffer import SequenceBuffer
+
 # Config
 BPM = 75 # Beats per minute, e.g. 60, 75, 100, 120, 150
 DIVISIONS_PER_BEAT = 4 # e.g. 4 = quarter notes, 8 = eighth notes, etc
 VARIANCE_MS = 20 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER_STREAMS = 'global' # 'global' keeps the jitter of earlier builds, 'instrument' gives each instrument its own reproducible jitter stream
 GAIN = 1.0 # base gain
 TEMPO = 1.0 # base tempo
 MS_PER_YEAR = 4000
@@ -32,18 +50,26 @@ EVENTS_INPUT_FILE = 'data/events.csv'
 SUMMARY_OUTPUT_FILE = 'data/report_summary.csv'
 SUMMARY_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
+SCHEDULE_OUTPUT_FILE = 'data/ck_schedule.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+BINARY_SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.cks'
+TRACE_OUTPUT_FILE = 'data/trace.json'
 VISUALIZATION_OUTPUT_FILE = 'visualization/data/years_refugees.json'
 INSTRUMENTS_DIR = 'instruments/'
 
 # Output options
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'csv' # 'csv' or 'binary' (a compact .cks file that loads faster in ChucK)
+SIZE_BUFFERS = False # give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers
+SCHEDULE_SAMPLES = False # load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts
 WRITE_REPORT = True
 WRITE_VIS = False
+VISUALIZATION_FORMAT = 'json' # 'json' or 'chunked' (gzipped columns in windows of time with an index, so a visualization can load as it plays)
+WRITE_TRACE = False # write a Chrome trace of where the build's time and memory go (open it in chrome://tracing or ui.perfetto.dev)
 
 # Calculations
 BEAT_MS = round(60.0 / BPM * 1000)
-ROUND_TO_NEAREST = round(BEAT_MS/DIVISIONS_PER_BEAT)
+ROUND_TO_NEAREST = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # ms of a tick, the grid beats are laid out on
 BEATS_PER_YEAR = round(MS_PER_YEAR/BEAT_MS)
 
 countries = []
@@ -54,8 +80,8 @@ refugees = []
 years = []
 
 instruments = []
-sequence = []
-hindex = 0
+sequence = SequenceBuffer(['duration', 'year'])
+jitter_streams = {}
 
 # Mean of list
 def mean(data):
@@ -67,28 +93,16 @@ def mean(data):
 	else:
 		return sum(data)/n
 
-# For creating pseudo-random numbers
-def halton(index, base):
-	result = 0.0
-	f = 1.0 / base
-	i = 1.0 * index
-	while(i > 0):
-		result += f * (i % base)
-		i = math.floor(i / base)
-		f = f / base
-	return result
-
 # floor {n} to nearest {nearest}
 def floorToNearest(n, nearest):
 	return 1.0 * math.floor(1.0*n/nearest) * nearest
 
-# round {n} to nearest {nearest}
-def roundToNearest(n, nearest):
-	return 1.0 * round(1.0*n/nearest) * nearest
-
+if WRITE_TRACE:
+	tracing.start(TRACE_OUTPUT_FILE)
+tracing.phase('load')
 # Read instruments from file
 with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-	r = csv.reader(f, delimiter=',')
+	r = table_cache.reader(f, delimiter=',')
 	next(r, None) # remove header
 	for file,min_count,max_count,min_dist,max_dist,min_countries,max_countries,from_gain,to_gain,from_tempo,to_tempo,tempo_offset,interval_phase,interval,interval_offset,active in r:
 		if int(active):
@@ -129,29 +143,27 @@ with open(POPULATIONS_INPUT_FILE) as data_file:
 	world_populations = (p for p in populations if p['code'] == 'WLD').next()
 
 # Read refugees from file
-with open(REFUGEES_INPUT_FILE, 'rb') as f:
-	lines = csv.reader(f, delimiter=',')
-	next(lines, None) # remove header
-	for origin,count,angle,origin_y,origin_x,year,asylum_x,asylum_y,asylum,distance in lines:
-		year = int(year)
-		if year >= START_YEAR and year <= STOP_YEAR:
-			refugees.append({
-				'origin': origin,
-				'origin_name': (country['name'] for country in countries if country['code'] == origin).next(),
-				'asylum': asylum,
-				'count': int(count),
-				'year': year,
-				'origin_x': float(origin_x),
-				'origin_y': float(origin_y),
-				'asylum_x': float(asylum_x),
-				'asylum_y': float(asylum_y),
-				'distance': float(distance),
-				'angle': float(angle)
-			})
+columns = table_cache.readColumns(REFUGEES_INPUT_FILE)
+for origin,count,angle,origin_y,origin_x,year,asylum_x,asylum_y,asylum,distance in table_cache.getRows(columns, [('origin', str), ('count', int), ('angle', float), ('origin_y', float), ('origin_x', float), ('year', int), ('asylum_x', float), ('asylum_y', float), ('asylum', str), ('distance', float)]):
+	year = year
+	if year >= START_YEAR and year <= STOP_YEAR:
+		refugees.append({
+			'origin': origin,
+			'origin_name': (country['name'] for country in countries if country['code'] == origin).next(),
+			'asylum': asylum,
+			'count': count,
+			'year': year,
+			'origin_x': origin_x,
+			'origin_y': origin_y,
+			'asylum_x': asylum_x,
+			'asylum_y': asylum_y,
+			'distance': distance,
+			'angle': angle
+		})
 
 # Read events from file
 with open(EVENTS_INPUT_FILE, 'rb') as f:
-	lines = csv.reader(f, delimiter=',')
+	lines = table_cache.reader(f, delimiter=',')
 	next(lines, None) # remove header
 	for code,year,headline,states in lines:
 		events.append({
@@ -162,6 +174,8 @@ with open(EVENTS_INPUT_FILE, 'rb') as f:
 			'states': states
 		})
 
+tracing.phase('normalize')
+tracing.count(len(refugees))
 # Calc min/max
 min_refugees = min([r['count'] for r in refugees])
 max_refugees = max([r['count'] for r in refugees])
@@ -256,129 +270,71 @@ for i,y in enumerate(years):
 	for j,c in enumerate(y['countries']):
 		years[i]['countries'][j]['count_n'] = 1.0 * c['count'] / max_country_count
 
-# Multiplier based on sine curve
-def getMultiplier(percent_complete, rad=1.0):
-	radians = percent_complete * (math.pi * rad)
-	multiplier = math.sin(radians)
-	if multiplier < 0:
-		multiplier = 0.0
-	elif multiplier > 1:
-		multplier = 1.0
-	return multiplier
-
-# Retrieve gain based on current beat
-def getGain(instrument, percent_complete):
-	multiplier = getMultiplier(percent_complete)
-	from_gain = instrument['from_gain']
-	to_gain = instrument['to_gain']
-	min_gain = min(from_gain, to_gain)
-	gain = multiplier * (to_gain - from_gain) + from_gain
-	gain = max(min_gain, round(gain, 2))
-	return gain
-
-# Get beat duration in ms based on current point in time
-def getBeatMs(instrument, percent_complete, round_to):
-	multiplier = getMultiplier(percent_complete)
-	from_beat_ms = instrument['from_beat_ms']
-	to_beat_ms = instrument['to_beat_ms']
-	ms = multiplier * (to_beat_ms - from_beat_ms) + from_beat_ms
-	ms = int(roundToNearest(ms, round_to))
-	return ms
-
-# Return if the instrument should be played in the given interval
-def isValidInterval(instrument, elapsed_ms):
-	interval_ms = instrument['interval_ms']
-	interval = instrument['interval']
-	interval_offset = instrument['interval_offset']
-	return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
-
 # Add beats to sequence
 def addBeatsToSequence(instrument, duration, ms, round_to, year):
 	global sequence
-	global hindex
-	beat_ms = int(roundToNearest(instrument['beat_ms'], round_to))
+	global jitter_streams
+	beat_ms = int(sequencer.roundToNearest(instrument['beat_ms'], round_to))
 	offset_ms = int(instrument['tempo_offset'] * beat_ms)
-	ms += offset_ms
-	previous_ms = int(ms)
-	from_beat_ms = instrument['from_beat_ms']
-	to_beat_ms = instrument['to_beat_ms']
-	min_ms = min(from_beat_ms, to_beat_ms)
-	remaining_duration = int(duration)
-	elapsed_duration = offset_ms
-	while remaining_duration >= min_ms:
-		elapsed_ms = int(ms)
-		elapsed_beat = int((elapsed_ms-previous_ms) / beat_ms)
-		percent_complete = 1.0 * elapsed_duration / duration
-		this_beat_ms = getBeatMs(instrument, percent_complete, round_to)
-		# add to sequence if in valid interval
-		if isValidInterval(instrument, elapsed_ms):
-			h = halton(hindex, 3)
-			variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-			sequence.append({
-				'instrument_index': instrument['index'],
-				'instrument': instrument,
-				'position': 0,
-				'rate': 1,
-				'gain': getGain(instrument, percent_complete),
-				'elapsed_ms': max([elapsed_ms + variance, 0]),
-				'duration': min([this_beat_ms, MS_PER_YEAR]),
-				'year': year
-			})
-			hindex += 1
-		remaining_duration -= this_beat_ms
-		elapsed_duration += this_beat_ms
-		ms += this_beat_ms
-
+	beats = sequencer.getBeats(instrument, ms, duration, round_to, offset_ms=offset_ms)
+	count = len(beats['ms'])
+	indices = jitter.takeIndices(jitter_streams, jitter.getStream(JITTER_STREAMS, instrument['index']), count)
+	variance = jitter.getVariance(indices, VARIANCE_MS)
+	elapsed_ms = jitter.addVariance(beats['ms'], variance)
+	durations = np.minimum(beats['beat_ms'], MS_PER_YEAR)
+	sequence.append(instrument['index'], elapsed_ms, beats['gain'], duration=durations, year=year)
+
+tracing.phase('match instruments')
 # Build sequence
-for instrument in instruments:
-
-	ms = None
-	queue_duration = 0
-
-	# Go through each year
-	for year in years:
-
-		is_valid = year['count_n'] >= instrument['min_count'] and year['count_n'] < instrument['max_count'] and year['avg_distance_n'] >= instrument['min_dist'] and year['avg_distance_n'] < instrument['max_dist'] and year['countries_1000_n'] >= instrument['min_countries'] and year['countries_1000_n'] < instrument['max_countries']
-
-		# If note is valid, add it to sequence
-		if not is_valid and queue_duration > 0 and ms != None or is_valid and ms != None and year['start_ms'] > (ms+queue_duration):
-			addBeatsToSequence(instrument.copy(), queue_duration, ms, ROUND_TO_NEAREST, year['year'])
-			ms = None
-			queue_duration = 0
-
-		if is_valid:
-			if ms==None:
-				ms = year['start_ms']
-			queue_duration += (year['stop_ms'] - year['start_ms'])
-
-	if queue_duration > 0 and ms != None:
-		addBeatsToSequence(instrument.copy(), queue_duration, ms, ROUND_TO_NEAREST, years[-1]['year'])
-
+# Check which instruments are valid for each year
+mins = activation.getColumns(instruments, ['min_count', 'min_dist', 'min_countries'])
+maxs = activation.getColumns(instruments, ['max_count', 'max_dist', 'max_countries'])
+features = activation.getColumns(years, ['count_n', 'avg_distance_n', 'countries_1000_n'])
+mask = activation.getMask(mins, maxs, features)
+start_ms = [year['start_ms'] for year in years]
+stop_ms = [year['stop_ms'] for year in years]
+tracing.phase('generate beats')
+for index, ms, queue_duration, stop in activation.getSpanSegments(mask, start_ms, stop_ms):
+	# a segment is added by the year after it, or the last year
+	year = years[min(stop, len(years)-1)]
+	addBeatsToSequence(instruments[index], queue_duration, ms, ROUND_TO_NEAREST, year['year'])
+tracing.count(len(sequence))
+
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for i, step in enumerate(sequence):
-	sequence[i]['milliseconds'] = step['elapsed_ms'] - elapsed
-	elapsed = step['elapsed_ms']
+sequence.sort()
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments to file
 if WRITE_SEQUENCE and len(instruments) > 0:
+	buffers = voices.getBufferCounts(sequence, instruments) if SIZE_BUFFERS else None
 	with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)
 		for index, instrument in enumerate(instruments):
-			w.writerow([index])
+			w.writerow([index] if buffers is None else [index, buffers[index]])
 			w.writerow([instrument['file']])
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
+		if buffers is not None:
+			print('Sized instrument buffers: %s in all, at most %s for an instrument' % (sum(buffers), max(buffers)))
+	schedule = sample_schedule.getSchedule(sequence, instruments) if SCHEDULE_SAMPLES else None
+	sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
+
+# Write sequence report to file on another thread while the sequence is written
+reports = report.ReportWriter()
+if WRITE_REPORT and len(sequence) > 0:
+	reports.writeSequence(SUMMARY_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain'], sequence.merged(), instruments, ['gain'])
 
 # Write sequence to file
-if WRITE_SEQUENCE and len(sequence) > 0:
+if WRITE_SEQUENCE and len(sequence) > 0 and SEQUENCE_FORMAT == 'binary':
+	sequence_file.writeBinary(BINARY_SEQUENCE_OUTPUT_FILE, sequence)
+	print('Successfully wrote sequence to file: '+BINARY_SEQUENCE_OUTPUT_FILE)
+elif WRITE_SEQUENCE and len(sequence) > 0:
 	with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
 		w = csv.writer(f)
-		for step in sequence:
+		for step in sequence.steps():
 			w.writerow([step['instrument_index']])
 			w.writerow([step['position']])
 			w.writerow([step['gain']])
@@ -387,36 +343,16 @@ if WRITE_SEQUENCE and len(sequence) > 0:
 		f.seek(-2, os.SEEK_END) # remove newline
 		f.truncate()
 		print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+	# players prefer a binary sequence, so don't leave one from an earlier build
+	if os.path.exists(BINARY_SEQUENCE_OUTPUT_FILE):
+		os.remove(BINARY_SEQUENCE_OUTPUT_FILE)
 
 # Write summary files
 if WRITE_REPORT:
-	with open(SUMMARY_OUTPUT_FILE, 'wb') as f:
-		w = csv.writer(f)
-		header = ['Time', 'Year', 'Count', 'Distance', 'Countries']
-		w.writerow(header)
-		for y in years:
-			elapsed = y['start_ms']
-			elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-			ms = int(elapsed % 1000)
-			elapsed_f += '.' + str(ms)
-			row = [elapsed_f, y['year'], y['count_n'], y['avg_distance_n'], y['countries_1000_n']]
-			w.writerow(row)
-		print('Successfully wrote summary file: '+SUMMARY_OUTPUT_FILE)
-
-	if len(sequence) > 0:
-		with open(SUMMARY_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-			w = csv.writer(f)
-			w.writerow(['Time', 'Instrument', 'Gain'])
-			for step in sequence:
-				instrument = instruments[step['instrument_index']]
-				elapsed = step['elapsed_ms']
-				elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-				ms = int(elapsed % 1000)
-				elapsed_f += '.' + str(ms)
-				w.writerow([elapsed_f, instrument['file'], step['gain']])
-			f.seek(-2, os.SEEK_END) # remove newline
-			f.truncate()
-			print('Successfully wrote sequence report to file: '+SUMMARY_SEQUENCE_OUTPUT_FILE)
+	times = report.formatTimes([y['start_ms'] for y in years])
+	rows = [[elapsed_f, y['year'], y['count_n'], y['avg_distance_n'], y['countries_1000_n']] for elapsed_f, y in zip(times, years)]
+	reports.write(SUMMARY_OUTPUT_FILE, ['Time', 'Year', 'Count', 'Distance', 'Countries'], rows, 'Successfully wrote summary file: '+SUMMARY_OUTPUT_FILE)
+reports.close()
 
 # Build visualization data
 vis_data = []
@@ -448,7 +384,8 @@ for y in years:
 			'cc': e['code'],
 			'h': e['headline']
 		})
-	year_instruments = [step for step in sequence if step['elapsed_ms']>=y['start_ms'] and step['elapsed_ms']<y['stop_ms']]
+	sequence_ms = sequence.column('elapsed_ms')
+	year_instruments = list(sequence.steps(np.flatnonzero((sequence_ms>=y['start_ms']) & (sequence_ms<y['stop_ms']))))
 	year_instruments = sorted(year_instruments[:], key=lambda k: k['duration'])
 	year_refugees = sorted(y['refugees'], key=lambda k: k['distance'])
 	refugees_per_instrument = math.floor(1.0 * y['count'] / len(year_instruments))
@@ -482,7 +419,10 @@ for y in years:
 	year['rms1'] = max([r['ms1'] for r in year['r']])
 	vis_data.append(year)
 
-if WRITE_VIS and len(vis_data)>0:
+if WRITE_VIS and len(vis_data)>0 and VISUALIZATION_FORMAT == 'chunked':
+	visualization_file.write(VISUALIZATION_OUTPUT_FILE, vis_data, times='ms0')
+	print('Successfully wrote chunked visualization file: '+visualization_file.getIndexFile(VISUALIZATION_OUTPUT_FILE))
+elif WRITE_VIS and len(vis_data)>0:
 	with open(VISUALIZATION_OUTPUT_FILE, 'w') as outfile:
 		json.dump(vis_data, outfile)
 	print('Successfully wrote to JSON file: '+VISUALIZATION_OUTPUT_FILE)
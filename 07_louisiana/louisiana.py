@@ -10,14 +10,31 @@
 import csv
 import json
 import math
+import numpy as np
 import os
 import pprint
+import sys
 import time
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import activation
+import jitter
+import report
+import sample_schedule
+import sequence_file
+import sequencer
+import table_cache
+import timeline
+import tracing
+import voices
+from sequence_buffer import SequenceBuffer
+
 # Config
 BPM = 100 # Beats per minute, e.g. 60, 75, 100, 120, 150
 DIVISIONS_PER_BEAT = 4 # e.g. 4 = quarter notes, 8 = eighth notes, etc
 VARIANCE_MS = 20 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER_STREAMS = 'global' # 'global' keeps the jitter of earlier builds, 'instrument' gives each instrument its own reproducible jitter stream
 GAIN = 0.4 # base gain
 TEMPO = 1.0 # base tempo
 MS_PER_YEAR = 7200
@@ -28,16 +45,23 @@ LAND_LOSS_INPUT_FILE = 'data/land_loss.json'
 SUMMARY_OUTPUT_FILE = 'data/report_summary.csv'
 SUMMARY_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
+SCHEDULE_OUTPUT_FILE = 'data/ck_schedule.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+BINARY_SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.cks'
+TRACE_OUTPUT_FILE = 'data/trace.json'
 INSTRUMENTS_DIR = 'instruments/'
 
 # Output options
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'csv' # 'csv' or 'binary' (a compact .cks file that loads faster in ChucK)
+SIZE_BUFFERS = False # give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers
+SCHEDULE_SAMPLES = False # load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts
 WRITE_REPORT = True
+WRITE_TRACE = False # write a Chrome trace of where the build's time and memory go (open it in chrome://tracing or ui.perfetto.dev)
 
 # Calculations
 BEAT_MS = round(60.0 / BPM * 1000)
-ROUND_TO_NEAREST = round(BEAT_MS / DIVISIONS_PER_BEAT)
+ROUND_TO_NEAREST = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # ms of a tick, the grid beats are laid out on
 BEATS_PER_YEAR = round(MS_PER_YEAR / BEAT_MS)
 GROUPS_PER_YEAR = int(BEATS_PER_YEAR)
 GROUP_MS = MS_PER_YEAR / GROUPS_PER_YEAR
@@ -45,31 +69,19 @@ GROUP_MS = MS_PER_YEAR / GROUPS_PER_YEAR
 # Init
 years = []
 instruments = []
-sequence = []
-hindex = 0
-
-# For creating pseudo-random numbers
-def halton(index, base):
-    result = 0.0
-    f = 1.0 / base
-    i = 1.0 * index
-    while(i > 0):
-        result += f * (i % base)
-        i = math.floor(i / base)
-        f = f / base
-    return result
+sequence = SequenceBuffer(['duration'])
+jitter_streams = {}
 
 # floor {n} to nearest {nearest}
 def floorToNearest(n, nearest):
     return 1.0 * math.floor(1.0*n/nearest) * nearest
 
-# round {n} to nearest {nearest}
-def roundToNearest(n, nearest):
-    return 1.0 * round(1.0*n/nearest) * nearest
-
+if WRITE_TRACE:
+    tracing.start(TRACE_OUTPUT_FILE)
+tracing.phase('load')
 # Read instruments from file
 with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-    r = csv.reader(f, delimiter=',')
+    r = table_cache.reader(f, delimiter=',')
     next(r, None) # remove header
     for file,min_loss,max_loss,min_c_loss,max_c_loss,from_gain,to_gain,from_tempo,to_tempo,tempo_offset,interval_phase,interval,interval_offset,active in r:
         if int(active):
@@ -100,8 +112,10 @@ with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
 
 # Read countries from file
 with open(LAND_LOSS_INPUT_FILE) as data_file:
-    years = json.load(data_file)
+    years = table_cache.loadJson(data_file)
 
+tracing.phase('normalize')
+tracing.count(len(years))
 # Break years up into groups
 for i, year in enumerate(years):
     total_loss = len(year['losses'])
@@ -123,135 +137,77 @@ print('Main sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds))
 print('Ms per beat: ' + str(BEAT_MS))
 print('Beats per year: ' + str(BEATS_PER_YEAR))
 
-# Multiplier based on sine curve
-def getMultiplier(percent_complete, rad=1.0):
-    radians = percent_complete * (math.pi * rad)
-    multiplier = math.sin(radians)
-    if multiplier < 0:
-        multiplier = 0.0
-    elif multiplier > 1:
-        multplier = 1.0
-    return multiplier
-
-# Retrieve gain based on current beat
-def getGain(instrument, percent_complete):
-    multiplier = getMultiplier(percent_complete)
-    from_gain = instrument['from_gain']
-    to_gain = instrument['to_gain']
-    min_gain = min(from_gain, to_gain)
-    gain = multiplier * (to_gain - from_gain) + from_gain
-    gain = max(min_gain, round(gain, 2))
-    return gain
-
-# Get beat duration in ms based on current point in time
-def getBeatMs(instrument, percent_complete, round_to):
-    multiplier = getMultiplier(percent_complete)
-    from_beat_ms = instrument['from_beat_ms']
-    to_beat_ms = instrument['to_beat_ms']
-    ms = multiplier * (to_beat_ms - from_beat_ms) + from_beat_ms
-    ms = int(roundToNearest(ms, round_to))
-    return ms
-
-# Return if the instrument should be played in the given interval
-def isValidInterval(instrument, elapsed_ms):
-    interval_ms = instrument['interval_ms']
-    interval = instrument['interval']
-    interval_offset = instrument['interval_offset']
-    return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
-
 # Add beats to sequence
 def addBeatsToSequence(instrument, duration, ms, round_to):
     global sequence
-    global hindex
-    beat_ms = int(roundToNearest(instrument['beat_ms'], round_to))
+    global jitter_streams
     offset_ms = int(instrument['tempo_offset'] * instrument['from_beat_ms'])
-    ms += offset_ms
-    previous_ms = int(ms)
-    from_beat_ms = instrument['from_beat_ms']
-    to_beat_ms = instrument['to_beat_ms']
-    min_ms = min(from_beat_ms, to_beat_ms)
-    remaining_duration = int(duration)
-    elapsed_duration = offset_ms
-    while remaining_duration >= min_ms:
-        elapsed_ms = int(ms)
-        elapsed_beat = int((elapsed_ms-previous_ms) / beat_ms)
-        percent_complete = 1.0 * elapsed_duration / duration
-        this_beat_ms = getBeatMs(instrument, percent_complete, round_to)
-        # add to sequence if in valid interval
-        if isValidInterval(instrument, elapsed_ms):
-            h = halton(hindex, 3)
-            variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-            sequence.append({
-                'instrument_index': instrument['index'],
-                'instrument': instrument,
-                'position': 0,
-                'rate': 1,
-                'gain': getGain(instrument, percent_complete),
-                'elapsed_ms': max([elapsed_ms + variance, 0]),
-                'duration': min([this_beat_ms, MS_PER_YEAR])
-            })
-            hindex += 1
-        remaining_duration -= this_beat_ms
-        elapsed_duration += this_beat_ms
-        ms += this_beat_ms
-
+    beats = sequencer.getBeats(instrument, ms, duration, round_to, offset_ms=offset_ms)
+    count = len(beats['ms'])
+    indices = jitter.takeIndices(jitter_streams, jitter.getStream(JITTER_STREAMS, instrument['index']), count)
+    variance = jitter.getVariance(indices, VARIANCE_MS)
+    elapsed_ms = jitter.addVariance(beats['ms'], variance)
+    durations = np.minimum(beats['beat_ms'], MS_PER_YEAR)
+    sequence.append(instrument['index'], elapsed_ms, beats['gain'], duration=durations)
+
+tracing.phase('match instruments')
 # Build sequence
-for instrument in instruments:
-    ms = None
-    queue_duration = 0
-    c_loss = 0
-    current_ms = 0
-
-    # Go through each year
-    for year in years:
-
-        for g in range(GROUPS_PER_YEAR):
-            c_loss += year['loss_per_group_n']
-            is_valid = year['group_loss'] >= instrument['min_loss'] and year['group_loss'] < instrument['max_loss'] and c_loss >= instrument['min_c_loss'] and c_loss < instrument['max_c_loss']
-
-            # If not valid, add it queue to sequence
-            if not is_valid and queue_duration > 0 and ms != None or is_valid and ms != None and current_ms > (ms+queue_duration):
-                addBeatsToSequence(instrument.copy(), queue_duration, ms, ROUND_TO_NEAREST)
-                ms = None
-                queue_duration = 0
-
-            # If valid, add time to queue
-            if is_valid:
-                if ms==None:
-                    ms = current_ms
-                queue_duration += GROUP_MS
-
-            current_ms += GROUP_MS
-
-        # Add remaining queue to sequence
-        if queue_duration > 0 and ms != None:
-            addBeatsToSequence(instrument.copy(), queue_duration, ms, ROUND_TO_NEAREST)
-
+# Check which instruments are valid for each group of each year
+groups = []
+for year in years:
+    groups.extend([year] * GROUPS_PER_YEAR)
+c_loss = np.cumsum([year['loss_per_group_n'] for year in groups])
+mins = activation.getColumns(instruments, ['min_loss', 'min_c_loss'])
+maxs = activation.getColumns(instruments, ['max_loss', 'max_c_loss'])
+features = np.column_stack(([year['group_loss'] for year in groups], c_loss))
+mask = activation.getMask(mins, maxs, features)
+tracing.phase('generate beats')
+for index, start, stop in zip(*activation.getRuns(mask)):
+    instrument = instruments[index]
+    ms = start * GROUP_MS
+    # the queue is added at the end of every year it's in
+    for year_stop in range((start // GROUPS_PER_YEAR + 1) * GROUPS_PER_YEAR, stop + 1, GROUPS_PER_YEAR):
+        addBeatsToSequence(instrument, (year_stop - start) * GROUP_MS, ms, ROUND_TO_NEAREST)
+    # and when it's no longer valid
+    if stop < len(groups):
+        addBeatsToSequence(instrument, (stop - start) * GROUP_MS, ms, ROUND_TO_NEAREST)
+tracing.count(len(sequence))
+
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for i, step in enumerate(sequence):
-    sequence[i]['milliseconds'] = step['elapsed_ms'] - elapsed
-    elapsed = step['elapsed_ms']
+sequence.sort()
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments to file
 if WRITE_SEQUENCE and len(instruments) > 0:
+    buffers = voices.getBufferCounts(sequence, instruments) if SIZE_BUFFERS else None
     with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
         w = csv.writer(f)
         for index, instrument in enumerate(instruments):
-            w.writerow([index])
+            w.writerow([index] if buffers is None else [index, buffers[index]])
             w.writerow([instrument['file']])
         f.seek(-2, os.SEEK_END) # remove newline
         f.truncate()
         print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
+        if buffers is not None:
+            print('Sized instrument buffers: %s in all, at most %s for an instrument' % (sum(buffers), max(buffers)))
+    schedule = sample_schedule.getSchedule(sequence, instruments) if SCHEDULE_SAMPLES else None
+    sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
+
+# Write sequence report to file on another thread while the sequence is written
+reports = report.ReportWriter()
+if WRITE_REPORT and len(sequence) > 0:
+    reports.writeSequence(SUMMARY_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain'], sequence.merged(), instruments, ['gain'])
 
 # Write sequence to file
-if WRITE_SEQUENCE and len(sequence) > 0:
+if WRITE_SEQUENCE and len(sequence) > 0 and SEQUENCE_FORMAT == 'binary':
+    sequence_file.writeBinary(BINARY_SEQUENCE_OUTPUT_FILE, sequence)
+    print('Successfully wrote sequence to file: '+BINARY_SEQUENCE_OUTPUT_FILE)
+elif WRITE_SEQUENCE and len(sequence) > 0:
     with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
         w = csv.writer(f)
-        for step in sequence:
+        for step in sequence.steps():
             w.writerow([step['instrument_index']])
             w.writerow([step['position']])
             w.writerow([step['gain']])
@@ -260,39 +216,23 @@ if WRITE_SEQUENCE and len(sequence) > 0:
         f.seek(-2, os.SEEK_END) # remove newline
         f.truncate()
         print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+    # players prefer a binary sequence, so don't leave one from an earlier build
+    if os.path.exists(BINARY_SEQUENCE_OUTPUT_FILE):
+        os.remove(BINARY_SEQUENCE_OUTPUT_FILE)
 
 # Write summary files
 if WRITE_REPORT:
-    with open(SUMMARY_OUTPUT_FILE, 'wb') as f:
-        w = csv.writer(f)
-        header = ['Time', 'Year Start', 'Year End', 'Group', 'Loss', 'Loss Cum']
-        w.writerow(header)
-        start_ms = 0
-        cumulative_loss = 0
-        for y in years:
-            # cumulative_loss += y['loss']
-            for g in range(GROUPS_PER_YEAR):
-                cumulative_loss += y['loss_per_group_n']
-                elapsed = start_ms
-                elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-                ms = int(elapsed % 1000)
-                elapsed_f += '.' + str(ms)
-                row = [elapsed_f, y['year_start'], y['year_end'], g, y['group_loss'], cumulative_loss]
-                w.writerow(row)
-                start_ms += GROUP_MS
-        print('Successfully wrote summary file: '+SUMMARY_OUTPUT_FILE)
-
-    if len(sequence) > 0:
-        with open(SUMMARY_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-            w = csv.writer(f)
-            w.writerow(['Time', 'Instrument', 'Gain'])
-            for step in sequence:
-                instrument = instruments[step['instrument_index']]
-                elapsed = step['elapsed_ms']
-                elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-                ms = int(elapsed % 1000)
-                elapsed_f += '.' + str(ms)
-                w.writerow([elapsed_f, instrument['file'], step['gain']])
-            f.seek(-2, os.SEEK_END) # remove newline
-            f.truncate()
-            print('Successfully wrote sequence report to file: '+SUMMARY_SEQUENCE_OUTPUT_FILE)
+    elapsed = []
+    rows = []
+    start_ms = 0
+    cumulative_loss = 0
+    for y in years:
+        # cumulative_loss += y['loss']
+        for g in range(GROUPS_PER_YEAR):
+            cumulative_loss += y['loss_per_group_n']
+            elapsed.append(start_ms)
+            rows.append([y['year_start'], y['year_end'], g, y['group_loss'], cumulative_loss])
+            start_ms += GROUP_MS
+    rows = [[elapsed_f] + row for elapsed_f, row in zip(report.formatTimes(elapsed), rows)]
+    reports.write(SUMMARY_OUTPUT_FILE, ['Time', 'Year Start', 'Year End', 'Group', 'Loss', 'Loss Cum'], rows, 'Successfully wrote summary file: '+SUMMARY_OUTPUT_FILE)
+reports.close()
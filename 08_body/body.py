@@ -10,15 +10,32 @@
 import csv
 import json
 import math
+import numpy as np
 import os
 from pprint import pprint
 import sys
 import time
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import jitter
+import report
+import sample_schedule
+import sequence_file
+import sequence_patch
+import sequencer
+import table_cache
+import timeline
+import tracing
+import visualization_file
+import voices
+from sequence_buffer import SequenceBuffer
+
 # Config
 BPM = 100 # Beats per minute, e.g. 60, 75, 100, 120, 150
 DIVISIONS_PER_BEAT = 8 # e.g. 4 = quarter notes, 8 = eighth notes, etc
 VARIANCE_MS = 20 # +/- milliseconds an instrument note should be off by to give it a little more "natural" feel
+JITTER_STREAMS = 'global' # 'global' keeps the jitter of earlier builds, 'instrument' gives each instrument its own reproducible jitter stream
 GAIN = 0.4 # base gain
 TEMPO = 1.0 # base tempo
 MS_PER_ARTIST = 12000
@@ -32,50 +49,47 @@ ANALYSIS_INPUT_FILE = 'data/analysis.json'
 SUMMARY_OUTPUT_FILE = 'data/report_summary.csv'
 SUMMARY_SEQUENCE_OUTPUT_FILE = 'data/report_sequence.csv'
 INSTRUMENTS_OUTPUT_FILE = 'data/ck_instruments.csv'
+SCHEDULE_OUTPUT_FILE = 'data/ck_schedule.csv'
 SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.csv'
+BINARY_SEQUENCE_OUTPUT_FILE = 'data/ck_sequence.cks'
+TRACE_OUTPUT_FILE = 'data/trace.json'
 VIZ_OUTPUT_FILE = 'visualization/data/visualization.json'
 INSTRUMENTS_DIR = 'instruments/'
 
 # Output options
 WRITE_SEQUENCE = True
+SEQUENCE_FORMAT = 'csv' # 'csv' or 'binary' (a compact .cks file that loads faster in ChucK)
+SIZE_BUFFERS = False # give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers
+SCHEDULE_SAMPLES = False # load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts
 WRITE_REPORT = True
 WRITE_VIZ = True
+VISUALIZATION_FORMAT = 'json' # 'json' or 'chunked' (gzipped columns in windows of time with an index, so a visualization can load as it plays)
+PATCH_INSTRUMENTS = False # only generate the notes of instruments that changed since the last build, keeping the rest (see util/sequence_patch.py)
+WRITE_TRACE = False # write a Chrome trace of where the build's time and memory go (open it in chrome://tracing or ui.perfetto.dev)
 
 # Calculations
 BEAT_MS = round(60.0 / BPM * 1000)
-ROUND_TO_NEAREST = round(BEAT_MS / DIVISIONS_PER_BEAT)
+ROUND_TO_NEAREST = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # ms of a tick, the grid beats are laid out on
 BEATS_PER_ARTIST = round(MS_PER_ARTIST / BEAT_MS)
 
 # Init
 artist_sequence = []
 artists = []
 instruments = []
-sequence = []
-hindex = 0
+sequence = SequenceBuffer(['duration'])
+jitter_streams = {}
 hindex_instrument = 0
 
-# For creating pseudo-random numbers
-def halton(index, base):
-    result = 0.0
-    f = 1.0 / base
-    i = 1.0 * index
-    while(i > 0):
-        result += f * (i % base)
-        i = math.floor(i / base)
-        f = f / base
-    return result
-
 # floor {n} to nearest {nearest}
 def floorToNearest(n, nearest):
     return 1.0 * math.floor(1.0*n/nearest) * nearest
 
-# round {n} to nearest {nearest}
-def roundToNearest(n, nearest):
-    return 1.0 * round(1.0*n/nearest) * nearest
-
+if WRITE_TRACE:
+    tracing.start(TRACE_OUTPUT_FILE)
+tracing.phase('load')
 # Read instruments from file
 with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
-    r = csv.reader(f, delimiter=',')
+    r = table_cache.reader(f, delimiter=',')
     next(r, None) # remove header
     for file, artist, region, gender, from_gain, to_gain, from_tempo, to_tempo, tempo_offset, interval_phase, interval, interval_offset, active in r:
         if int(active):
@@ -125,88 +139,37 @@ print('Main sequence time: '+time.strftime('%M:%S', time.gmtime(total_seconds))
 print('Ms per beat: ' + str(BEAT_MS))
 print('Beats per artist: ' + str(BEATS_PER_ARTIST))
 
-# Multiplier based on sine curve
-def getMultiplier(percent_complete, rad=1.0):
-    radians = percent_complete * (math.pi * rad)
-    multiplier = math.sin(radians)
-    if multiplier < 0:
-        multiplier = 0.0
-    elif multiplier > 1:
-        multplier = 1.0
-    return multiplier
-
-# Retrieve gain based on current beat
-def getGain(instrument, percent_complete):
-    multiplier = getMultiplier(percent_complete)
-    from_gain = instrument['from_gain']
-    to_gain = instrument['to_gain']
-    min_gain = min(from_gain, to_gain)
-    gain = multiplier * (to_gain - from_gain) + from_gain
-    gain = max(min_gain, round(gain, 2))
-    return gain
-
-# Get beat duration in ms based on current point in time
-def getBeatMs(instrument, percent_complete, round_to):
-    multiplier = getMultiplier(percent_complete)
-    from_beat_ms = instrument['from_beat_ms']
-    to_beat_ms = instrument['to_beat_ms']
-    ms = multiplier * (to_beat_ms - from_beat_ms) + from_beat_ms
-    ms = int(roundToNearest(ms, round_to))
-    return ms
-
-# Return if the instrument should be played in the given interval
-def isValidInterval(instrument, elapsed_ms):
-    interval_ms = instrument['interval_ms']
-    interval = instrument['interval']
-    interval_offset = instrument['interval_offset']
-    return int(math.floor(1.0*elapsed_ms/interval_ms)) % interval == interval_offset
-
 # Add beats to sequence
 def addBeatsToSequence(region, instrument, duration, ms, round_to):
     global sequence
-    global hindex
+    global jitter_streams
     global hindex_instrument
 
-    beat_ms = int(roundToNearest(instrument['beat_ms'], round_to))
     offset_ms = int(instrument['tempo_offset'] * instrument['from_beat_ms'])
-    ms += offset_ms
-    previous_ms = int(ms)
-    from_beat_ms = instrument['from_beat_ms']
-    to_beat_ms = instrument['to_beat_ms']
-    min_ms = min(from_beat_ms, to_beat_ms)
-    remaining_duration = int(duration)
-    elapsed_duration = offset_ms
-    while remaining_duration >= min_ms:
-        elapsed_ms = int(ms)
-        elapsed_beat = int((elapsed_ms-previous_ms) / beat_ms)
-        percent_complete = 1.0 * elapsed_duration / duration
-        this_beat_ms = getBeatMs(instrument, percent_complete, round_to)
-        # add to sequence if in valid interval
-        if isValidInterval(instrument, elapsed_ms):
-            if instrument['region'] == 'all':
-                h_i = -1
-            else:
-                h_i = halton(hindex_instrument, 5)
-                hindex_instrument += 1
-            if h_i < region['value_n'] * PROBABILITY_MULITPLIER:
-                h = halton(hindex, 3)
-                variance = int(h * VARIANCE_MS * 2 - VARIANCE_MS)
-                sequence.append({
-                    'instrument_index': instrument['index'],
-                    'instrument': instrument,
-                    'position': 0,
-                    'rate': 1,
-                    'gain': getGain(instrument, percent_complete),
-                    'elapsed_ms': max([elapsed_ms + variance, 0]),
-                    'duration': min([this_beat_ms, MS_PER_ARTIST])
-                })
-                hindex += 1
-        remaining_duration -= this_beat_ms
-        elapsed_duration += this_beat_ms
-        ms += this_beat_ms
-
+    beats = sequencer.getBeats(instrument, ms, duration, round_to, offset_ms=offset_ms)
+    count = len(beats['ms'])
+    # only say a body part as often as its region is mentioned
+    if instrument['region'] == 'all':
+        h_i = np.full(count, -1.0)
+    else:
+        h_i = jitter.halton(hindex_instrument, count, 5)
+        hindex_instrument += count
+    said = h_i < region['value_n'] * PROBABILITY_MULITPLIER
+    said_count = int(np.sum(said))
+    indices = jitter.takeIndices(jitter_streams, jitter.getStream(JITTER_STREAMS, instrument['index']), said_count)
+    variance = jitter.getVariance(indices, VARIANCE_MS)
+    elapsed_ms = jitter.addVariance(beats['ms'][said], variance)
+    durations = np.minimum(beats['beat_ms'][said], MS_PER_ARTIST)
+    sequence.append(instrument['index'], elapsed_ms, beats['gain'][said], duration=durations)
+
+tracing.phase('generate beats')
+patches = None
+if PATCH_INSTRUMENTS:
+    patches = sequence_patch.SequencePatch(__file__, instruments, jitter_streams, JITTER_STREAMS, [ARTISTS_INPUT_FILE, ANALYSIS_INPUT_FILE], globals())
 # Build sequence
 for i in instruments:
+    if patches is not None and not patches.begin(i):
+        continue
     ms = 0
     hindex_instrument = 0
 
@@ -218,35 +181,48 @@ for i in instruments:
         for r in regions:
 
             if a['artist']==i['artist'] and (r['name']==i['region'] or i['region']=='all'):
-                addBeatsToSequence(r.copy(), i.copy(), MS_PER_ARTIST, ms, ROUND_TO_NEAREST)
+                addBeatsToSequence(r, i, MS_PER_ARTIST, ms, ROUND_TO_NEAREST)
 
         ms += MS_PER_ARTIST
+if patches is not None:
+    sequence = patches.splice(sequence)
+tracing.count(len(sequence))
 
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for i, step in enumerate(sequence):
-    sequence[i]['milliseconds'] = step['elapsed_ms'] - elapsed
-    elapsed = step['elapsed_ms']
+sequence.sort()
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments to file
 if WRITE_SEQUENCE and len(instruments) > 0:
+    buffers = voices.getBufferCounts(sequence, instruments) if SIZE_BUFFERS else None
     with open(INSTRUMENTS_OUTPUT_FILE, 'wb') as f:
         w = csv.writer(f)
         for index, instrument in enumerate(instruments):
-            w.writerow([index])
+            w.writerow([index] if buffers is None else [index, buffers[index]])
             w.writerow([instrument['file']])
         f.seek(-2, os.SEEK_END) # remove newline
         f.truncate()
         print('Successfully wrote instruments to file: '+INSTRUMENTS_OUTPUT_FILE)
+        if buffers is not None:
+            print('Sized instrument buffers: %s in all, at most %s for an instrument' % (sum(buffers), max(buffers)))
+    schedule = sample_schedule.getSchedule(sequence, instruments) if SCHEDULE_SAMPLES else None
+    sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
+
+# Write sequence report to file on another thread while the sequence is written
+reports = report.ReportWriter()
+if WRITE_REPORT and len(sequence) > 0:
+    reports.writeSequence(SUMMARY_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain'], sequence.merged(), instruments, ['gain'])
 
 # Write sequence to file
-if WRITE_SEQUENCE and len(sequence) > 0:
+if WRITE_SEQUENCE and len(sequence) > 0 and SEQUENCE_FORMAT == 'binary':
+    sequence_file.writeBinary(BINARY_SEQUENCE_OUTPUT_FILE, sequence)
+    print('Successfully wrote sequence to file: '+BINARY_SEQUENCE_OUTPUT_FILE)
+elif WRITE_SEQUENCE and len(sequence) > 0:
     with open(SEQUENCE_OUTPUT_FILE, 'wb') as f:
         w = csv.writer(f)
-        for step in sequence:
+        for step in sequence.steps():
             w.writerow([step['instrument_index']])
             w.writerow([step['position']])
             w.writerow([step['gain']])
@@ -255,38 +231,26 @@ if WRITE_SEQUENCE and len(sequence) > 0:
         f.seek(-2, os.SEEK_END) # remove newline
         f.truncate()
         print('Successfully wrote sequence to file: '+SEQUENCE_OUTPUT_FILE)
+    # players prefer a binary sequence, so don't leave one from an earlier build
+    if os.path.exists(BINARY_SEQUENCE_OUTPUT_FILE):
+        os.remove(BINARY_SEQUENCE_OUTPUT_FILE)
 
 # Write summary files
 if WRITE_REPORT and len(sequence) > 0:
 
-    with open(SUMMARY_OUTPUT_FILE, 'wb') as f:
-        w = csv.writer(f)
-        w.writerow(['Artist', 'Region', 'Percent'])
-        valid_regions = ['eye','face','hand','heart','mouth','foot','arm','butt','groin']
-        for a in artists:
-            for r in valid_regions:
-                region = next(iter([_r for _r in a['regions_agnostic'] if _r['name']==r]), None)
-                if region is None:
-                    w.writerow([a['artist'].encode('utf-8'), r, 0])
-                else:
-                    w.writerow([a['artist'].encode('utf-8'), r, 1.0 * region['value'] / a['value_count']])
-            others = sum([r['value'] for r in a['regions_agnostic'] if r['name'] not in valid_regions])
-            w.writerow([a['artist'].encode('utf-8'), 'other', 1.0 * others / a['value_count']])
-        print('Successfully wrote report to file: '+SUMMARY_OUTPUT_FILE)
-
-    with open(SUMMARY_SEQUENCE_OUTPUT_FILE, 'wb') as f:
-        w = csv.writer(f)
-        w.writerow(['Time', 'Instrument', 'Gain'])
-        for step in sequence:
-            instrument = instruments[step['instrument_index']]
-            elapsed = step['elapsed_ms']
-            elapsed_f = time.strftime('%M:%S', time.gmtime(int(elapsed/1000)))
-            ms = int(elapsed % 1000)
-            elapsed_f += '.' + str(ms)
-            w.writerow([elapsed_f, instrument['file'], step['gain']])
-        f.seek(-2, os.SEEK_END) # remove newline
-        f.truncate()
-        print('Successfully wrote sequence report to file: '+SUMMARY_SEQUENCE_OUTPUT_FILE)
+    rows = []
+    valid_regions = ['eye','face','hand','heart','mouth','foot','arm','butt','groin']
+    for a in artists:
+        for r in valid_regions:
+            region = next(iter([_r for _r in a['regions_agnostic'] if _r['name']==r]), None)
+            if region is None:
+                rows.append([a['artist'].encode('utf-8'), r, 0])
+            else:
+                rows.append([a['artist'].encode('utf-8'), r, 1.0 * region['value'] / a['value_count']])
+        others = sum([r['value'] for r in a['regions_agnostic'] if r['name'] not in valid_regions])
+        rows.append([a['artist'].encode('utf-8'), 'other', 1.0 * others / a['value_count']])
+    reports.write(SUMMARY_OUTPUT_FILE, ['Artist', 'Region', 'Percent'], rows, 'Successfully wrote report to file: '+SUMMARY_OUTPUT_FILE)
+reports.close()
 
 def getDuration(wav_file):
     duration = 0
@@ -329,9 +293,9 @@ if WRITE_VIZ and len(sequence) > 0:
         ms += MS_PER_ARTIST
 
     # build instrument sequence
-    for step in sequence:
+    for step in sequence.steps():
 
-        i = step['instrument']
+        i = instruments[step['instrument_index']]
         if i['file'] not in file_durations:
             continue
         duration = file_durations[i['file']]
@@ -354,6 +318,10 @@ if WRITE_VIZ and len(sequence) > 0:
                 'end_ms': step['elapsed_ms'] + duration
             })
 
-    with open(VIZ_OUTPUT_FILE, 'w') as outfile:
-        json.dump(artists, outfile)
-        print('Successfully wrote viz data to file: '+VIZ_OUTPUT_FILE)
+    if VISUALIZATION_FORMAT == 'chunked':
+        visualization_file.write(VIZ_OUTPUT_FILE, artists, times='start_ms')
+        print('Successfully wrote chunked viz data to file: '+visualization_file.getIndexFile(VIZ_OUTPUT_FILE))
+    else:
+        with open(VIZ_OUTPUT_FILE, 'w') as outfile:
+            json.dump(artists, outfile)
+            print('Successfully wrote viz data to file: '+VIZ_OUTPUT_FILE)
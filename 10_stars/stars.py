@@ -11,15 +11,29 @@ import math
 import os
 import sys
 
+# Shared modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+import sample_schedule
+import sequence_file
+import tracing
+import voices
+from sequence_buffer import SequenceBuffer
+
 # Input
 parser = argparse.ArgumentParser()
 parser.add_argument('-in', dest="INPUT_FILE", default="data/sequence.json", help="Path to input json file")
 parser.add_argument('-ins', dest="INSTRUMENT_FILE", default="data/ck_instruments.csv", help="Path to output instrument csv file")
+parser.add_argument('-sched', dest="SCHEDULE_FILE", default="data/ck_schedule.csv", help="Path to output sample schedule csv file")
 parser.add_argument('-seq', dest="SEQUENCE_FILE", default="data/ck_sequence.csv", help="Path to output sequence csv file")
+parser.add_argument('-bseq', dest="BINARY_SEQUENCE_FILE", default="data/ck_sequence.cks", help="Path to output binary sequence file")
+parser.add_argument('-fmt', dest="SEQUENCE_FORMAT", default="csv", choices=["csv", "binary"], help="Sequence format; binary writes a compact .cks file that loads faster in ChucK")
 parser.add_argument('-dur', dest="DURATION", default="360000", type=int, help="Duration of song")
 parser.add_argument('-g0', dest="MIN_GAIN", default="0.5", type=float, help="Min gain")
 parser.add_argument('-g1', dest="MAX_GAIN", default="1.2", type=float, help="Min gain")
 parser.add_argument('-hnd', dest="HARMONY_NOTE_DURATION", default="16000", type=int, help="Duration of song")
+parser.add_argument('-buffers', dest="SIZE_BUFFERS", action="store_true", help="Give each instrument as many SndBufs as its notes overlap (see util/voices.py), instead of the player's instrument_buffers")
+parser.add_argument('-schedule', dest="SCHEDULE_SAMPLES", action="store_true", help="Load each instrument's sample just ahead of its first note and release it after its last (see util/sample_schedule.py), instead of every sample before the track starts")
+parser.add_argument('-trace', dest="TRACE_FILE", default="", help="Path to output Chrome trace file of where the build's time and memory go")
 
 # Init input
 args = parser.parse_args()
@@ -54,24 +68,22 @@ for i,instrument in enumerate(instruments):
 notes = [i for i in instruments if i["type"]=="note"]
 harmonyNotes = [i for i in instruments if i["type"]=="harmony"]
 
+if args.TRACE_FILE:
+    tracing.start(args.TRACE_FILE)
+tracing.phase('load')
 # Read json file
 rows = []
 with open(args.INPUT_FILE) as f:
     rows = json.load(f)
 
+tracing.phase('generate beats')
 # Build notes sequence
-sequence = []
+sequence = SequenceBuffer()
 for row in rows:
     t = row[0]
     y = row[2]
     mag = row[3]
-    sequence.append({
-        "instrument_index": notes[int(y * len(notes))]["index"],
-        "position": 0,
-        "rate": 1,
-        "gain": round(lerp(args.MIN_GAIN, args.MAX_GAIN, mag), 3),
-        "elapsed_ms": int(round(t * DURATION))
-    })
+    sequence.append(notes[int(y * len(notes))]["index"], int(round(t * DURATION)), round(lerp(args.MIN_GAIN, args.MAX_GAIN, mag), 3))
 
 # Add harmony to sequence
 dur = args.HARMONY_NOTE_DURATION
@@ -79,43 +91,47 @@ ms = 0
 while ms < args.DURATION:
     percent = 1.0 * ms / DURATION
     multiplier = math.sin(percent * math.pi)
-    sequence.append({
-        "instrument_index": harmonyNotes[int(multiplier * len(harmonyNotes))]["index"],
-        "position": 0,
-        "rate": 1,
-        "gain": 3.6,
-        "elapsed_ms": ms
-    })
+    sequence.append(harmonyNotes[int(multiplier * len(harmonyNotes))]["index"], ms, 3.6)
     ms += dur
+tracing.count(len(sequence))
 
+tracing.phase('sort')
 # Sort sequence
-sequence = sorted(sequence, key=lambda k: k['elapsed_ms'])
-
-# Add milliseconds to sequence
-elapsed = 0
-for i, step in enumerate(sequence):
-    sequence[i]['milliseconds'] = step['elapsed_ms'] - elapsed
-    elapsed = step['elapsed_ms']
+sequence.sort()
 
+tracing.phase('write outputs')
+tracing.count(len(sequence))
 # Write instruments
+buffers = voices.getBufferCounts(sequence, instruments) if args.SIZE_BUFFERS else None
 with open(args.INSTRUMENT_FILE, 'wb') as f:
     w = csv.writer(f)
     for index, instrument in enumerate(instruments):
-        w.writerow([index])
+        w.writerow([index] if buffers is None else [index, buffers[index]])
         w.writerow([instrument['file']])
     f.seek(-2, os.SEEK_END) # remove newline
     f.truncate()
     print "Successfully wrote instrument to file:  %s" % args.INSTRUMENT_FILE
+    if buffers is not None:
+        print "Sized instrument buffers: %s in all, at most %s for an instrument" % (sum(buffers), max(buffers))
+schedule = sample_schedule.getSchedule(sequence, instruments) if args.SCHEDULE_SAMPLES else None
+sample_schedule.writeSchedule(args.SCHEDULE_FILE, schedule)
 
 # Write sequence
-with open(args.SEQUENCE_FILE, 'wb') as f:
-    w = csv.writer(f)
-    for step in sequence:
-        w.writerow([step['instrument_index']])
-        w.writerow([step['position']])
-        w.writerow([step['gain']])
-        w.writerow([step['rate']])
-        w.writerow([step['milliseconds']])
-    f.seek(-2, os.SEEK_END) # remove newline
-    f.truncate()
-    print "Successfully wrote sequence to file:  %s" % args.SEQUENCE_FILE
+if args.SEQUENCE_FORMAT == "binary":
+    sequence_file.writeBinary(args.BINARY_SEQUENCE_FILE, sequence)
+    print "Successfully wrote sequence to file:  %s" % args.BINARY_SEQUENCE_FILE
+else:
+    with open(args.SEQUENCE_FILE, 'wb') as f:
+        w = csv.writer(f)
+        for step in sequence.steps():
+            w.writerow([step['instrument_index']])
+            w.writerow([step['position']])
+            w.writerow([step['gain']])
+            w.writerow([step['rate']])
+            w.writerow([step['milliseconds']])
+        f.seek(-2, os.SEEK_END) # remove newline
+        f.truncate()
+        print "Successfully wrote sequence to file:  %s" % args.SEQUENCE_FILE
+    # players prefer a binary sequence, so don't leave one from an earlier build
+    if os.path.exists(args.BINARY_SEQUENCE_FILE):
+        os.remove(args.BINARY_SEQUENCE_FILE)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+##
+# Activation masks for the track scripts
+# Decides which instruments play over which datapoints (stations, readings, pairs, years...) from the
+# instruments' min/max columns and the datapoints' feature columns in one broadcast, giving an
+# instruments x datapoints boolean mask. Each instrument's row is then turned into contiguous segments
+# of time (start ms, duration) to generate beats over, with the same bookkeeping the scripts have always used.
+# Usage (from a track directory):
+#   mins = activation.getColumns(instruments, ['min_count', 'min_dist'])
+#   maxs = activation.getColumns(instruments, ['max_count', 'max_dist'])
+#   features = activation.getColumns(years, ['count_n', 'avg_distance_n'])
+#   mask = activation.getMask(mins, maxs, features)
+#   for index, ms, duration, stop in activation.getSpanSegments(mask, start_ms, stop_ms):
+#       addBeatsToSequence(instruments[index], duration, ms, ROUND_TO_NEAREST)
+##
+
+import numpy as np
+
+import tracing
+
+# Retrieve the values of {keys} from a list of dicts as a 2d array, one row per dict
+def getColumns(items, keys, dtype=np.float64):
+    return np.array([[item[key] for key in keys] for item in items], dtype=dtype).reshape(len(items), len(keys))
+
+# Instruments x datapoints mask, true where min <= feature < max for every feature
+#   mins, maxs: (instruments, features) arrays; features: (datapoints, features) array
+#   inclusive_max: features (by column index) that are valid up to and including their max
+@tracing.traced()
+def getMask(mins, maxs, features, inclusive_max=[]):
+    mins = np.asarray(mins, dtype=np.float64)
+    maxs = np.asarray(maxs, dtype=np.float64)
+    features = np.asarray(features, dtype=np.float64)
+    mask = np.ones((mins.shape[0], features.shape[0]), dtype=bool)
+    for f in range(features.shape[1]):
+        values = features[:, f][np.newaxis, :]
+        mask &= values >= mins[:, f][:, np.newaxis]
+        if f in inclusive_max:
+            mask &= values <= maxs[:, f][:, np.newaxis]
+        else:
+            mask &= values < maxs[:, f][:, np.newaxis]
+    return mask
+
+# Instruments x datapoints mask, true where the instrument's value matches the datapoint's (or is {any_value})
+@tracing.traced()
+def getMatches(instrument_values, datapoint_values, any_value='any'):
+    instrument_values = np.asarray(instrument_values, dtype=object)[:, np.newaxis]
+    datapoint_values = np.asarray(datapoint_values, dtype=object)[np.newaxis, :]
+    return (instrument_values == datapoint_values) | (instrument_values == any_value)
+
+# Contiguous runs of true values in each row of the mask
+# Returns arrays of each run's instrument, first datapoint and the datapoint after its last, in row order
+def getRuns(mask):
+    mask = np.asarray(mask, dtype=bool)
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    changes = np.diff(padded, axis=1)
+    instruments, starts = np.nonzero(changes > 0)
+    stops = np.nonzero(changes < 0)[1]
+    return (instruments, starts, stops)
+
+# Segments of back-to-back datapoints of {durations} ms each, queued the way the scripts do:
+# ms keeps counting through every inactive datapoint, and a segment's duration is the sum of its datapoints
+# Returns (instrument, start ms, duration, datapoint after the segment) in order of instrument, then time
+def getQueueSegments(mask, durations):
+    mask = np.asarray(mask, dtype=bool)
+    count = mask.shape[1]
+    durations = np.broadcast_to(np.asarray(durations, dtype=np.float64), (count,))
+    instruments, starts, stops = getRuns(mask)
+
+    # add the durations in order, so float durations add up to exactly what the scripts' loops did
+    queues = [float(np.cumsum(durations[start:stop])[-1]) for start, stop in zip(starts.tolist(), stops.tolist())]
+
+    # ms advances by every inactive datapoint, and by a segment's duration when it ends
+    increments = np.where(mask, 0.0, durations[np.newaxis, :])
+    for i, start, stop, queue in zip(instruments.tolist(), starts.tolist(), stops.tolist(), queues):
+        if stop < count:
+            increments[i, stop] = queue + durations[stop]
+    elapsed = np.cumsum(increments, axis=1)
+
+    segments = []
+    for i, start, stop, queue in zip(instruments.tolist(), starts.tolist(), stops.tolist(), queues):
+        if queue <= 0:
+            continue
+        ms = float(elapsed[i, start-1]) if start > 0 else 0.0
+        segments.append((i, ms, queue, stop))
+    return segments
+
+# Segments of datapoints that each span [start ms, stop ms), queued the way the scripts do:
+# a segment starts at its first datapoint and also ends where the next datapoint starts after it
+# Returns (instrument, start ms, duration, datapoint after the segment) in order of instrument, then time
+def getSpanSegments(mask, start_ms, stop_ms):
+    start_ms = np.asarray(start_ms, dtype=np.float64)
+    durations = np.asarray(stop_ms, dtype=np.float64) - start_ms
+    elapsed = np.concatenate(([0.0], np.cumsum(durations)))
+    instruments, starts, stops = getRuns(mask)
+
+    segments = []
+    for i, start, stop in zip(instruments.tolist(), starts.tolist(), stops.tolist()):
+        # a datapoint starting after the end of the queue so far breaks the segment
+        gaps = start_ms[start:stop] - elapsed[start:stop]
+        breaks = np.flatnonzero(gaps[1:] > np.maximum.accumulate(gaps)[:-1]) + 1
+        bounds = [0] + breaks.tolist() + [stop - start]
+        for j in range(len(bounds) - 1):
+            first = start + bounds[j]
+            last = start + bounds[j+1]
+            duration = float(elapsed[last] - elapsed[first])
+            if duration > 0:
+                segments.append((i, float(start_ms[first]), duration, last))
+    return segments
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+##
+# Benchmarks how the build stages (see build.py) scale with the size of their data.
+# For each stage, synthetic inputs that follow the schema of the track's real data (stations, raw and processed eeg,
+# raw and daily pm2.5 readings, pairs, painting samples, refugees, land loss, lyrics, artists' body words, movies,
+# stars) are generated at increasing sizes, the stage
+# is run on them in a scratch copy of the tracks and its wall time and peak memory are recorded.
+# Time and memory are fitted to size^k between the two largest sizes; a stage whose k is over
+# {SUPERLINEAR_EXPONENT} (or that times out) is flagged as growing super-linearly.
+# Usage: python benchmark.py [stages, e.g. 06_refugees/preprocess_data 01_subway] [-scales 1 10 100] [-timeout 300] [-o results.json]
+##
+
+import argparse
+import csv
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import build
+
+ROOT_DIR = build.ROOT_DIR
+SCALES = [1, 10, 100, 1000] # multiples of each stage's base size
+TIMEOUT = 600 # seconds a stage may run before it's stopped (and larger sizes skipped)
+SUPERLINEAR_EXPONENT = 1.3 # flag stages whose time or memory grows faster than size^this
+SEED = 7
+
+# Stations walk along a line like a subway line does, a few blocks at a time
+def writeStations(filename, n, rnd):
+    boroughs = ['Manhattan', 'Brooklyn', 'Queens', 'Bronx']
+    lat = 40.63275
+    lng = -73.947375
+    with open(filename, 'wb') as f:
+        w = csv.writer(f, delimiter='\t')
+        w.writerow(['Station Name', 'Median Income 2011', 'Month Income', 'Latitude', 'Longitude', 'Borough'])
+        for i in range(n):
+            income = rnd.uniform(15000, 250000)
+            w.writerow(['Station %s' % i, '${:,.2f}'.format(income), '${:,.2f}'.format(income / 12), round(lat, 6), round(lng, 6), boroughs[i * len(boroughs) // n]])
+            lat += rnd.uniform(0.002, 0.012)
+            lng += rnd.uniform(-0.004, 0.004)
+
+# Raw EEG readings of 23 channels (like the CHB-MIT recording), {n} of them spread over the part of the recording
+# preprocess_data.py makes the song of (its SONG_START to SONG_END, in seconds)
+def writeEegRaw(filename, n, rnd):
+    song_start = 1640
+    song_end = 1864
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['Time'] + ['S%s' % c for c in range(1, 24)])
+        for i in range(n):
+            t = song_start + 1.0 * (song_end - song_start) * i / n
+            w.writerow(['%.6f' % t] + [round(math.sin(t * 100 / (37.0 + c)) * 100 + rnd.uniform(-20, 20), 3) for c in range(23)])
+
+# EEG readings every 10ms of 23 channels, after min and max rows (like preprocess_data.py writes)
+def writeEeg(filename, n, rnd):
+    rows = []
+    for i in range(n):
+        t = i * 10
+        rows.append([t] + [round(math.sin(t / (37.0 + c)) * 100 + rnd.uniform(-20, 20), 3) for c in range(23)])
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['Time'] + ['S%s' % c for c in range(1, 24)])
+        w.writerow([-2] + [min([row[c] for row in rows]) for c in range(1, 24)])
+        w.writerow([-1] + [max([row[c] for row in rows]) for c in range(1, 24)])
+        for row in rows:
+            w.writerow(row)
+
+# Hourly PM2.5 readings in a file per year (like the State Air files, after their intro lines and header), with
+# missing hours as -999; the real files in the {directory} are replaced
+def writePm25Raw(directory, n, rnd):
+    for filename in os.listdir(directory):
+        os.remove(os.path.join(directory, filename))
+    start = datetime.datetime(2012, 1, 1)
+    f = None
+    year = None
+    for i in range(n):
+        date = start + datetime.timedelta(hours=i)
+        if date.year != year:
+            if f is not None:
+                f.close()
+            year = date.year
+            f = open(os.path.join(directory, 'Beijing_%s_HourlyPM2.5.csv' % year), 'wb')
+            f.write('A fact sheet with definitions and metadata for this dataset.\r\nData Use Statement.\r\n\r\n')
+            w = csv.writer(f)
+            w.writerow(['Site', 'Parameter', 'Date (LST)', 'Year', 'Month', 'Day', 'Hour', 'Value', 'Unit', 'Duration', 'QC Name'])
+        value = -999 if rnd.random() < 0.02 else int(max(2, rnd.gauss(100, 80)))
+        w.writerow(['Beijing', 'PM2.5', date.strftime('%Y-%m-%d %H:%M'), date.year, date.month, date.day, date.hour, value, 'ug/m3', '1 Hr', 'Valid' if value >= 0 else 'Missing'])
+    if f is not None:
+        f.close()
+
+# Daily PM2.5 readings, after min, max and count rows (like preprocess_data.py writes)
+def writePm25(filename, n, rnd):
+    values = [int(max(2, rnd.gauss(100, 80))) for i in range(n)]
+    start = time.mktime((2012, 1, 1, 12, 0, 0, 0, 0, -1))
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['Date', 'PM2.5 Value'])
+        w.writerow(['Min', min(values)])
+        w.writerow(['Max', max(values)])
+        w.writerow(['Count', n])
+        for i, value in enumerate(values):
+            w.writerow([time.strftime('%Y-%m-%d', time.localtime(start + i * 86400)), value])
+
+# Pairs of races, a year at a time
+def writePairs(filename, n, rnd):
+    races = ['White', 'Black', 'Asian', 'Latino']
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['Order', 'Female Race', 'Male Race', 'Female Attraction', 'Male Attraction', 'Diff', 'Total', 'Year'])
+        for i in range(n):
+            f_percent = rnd.randint(0, 40)
+            m_percent = rnd.randint(0, 40)
+            w.writerow([i + 1, races[(i // 4) % len(races)], races[i % len(races)], f_percent, m_percent, abs(f_percent - m_percent), f_percent + m_percent, 2009 + i // 16])
+
+# Samples of paintings, 25 per painting
+def writePaintingSamples(filename, n, rnd):
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['title', 'artist', 'position', 'year', 'file', 'painting_width', 'painting_height', 'year_start_ms', 'year_stop_ms', 'hue', 'saturation', 'brightness', 'x', 'y', 'width', 'height'])
+        for p in range(max(1, n // 25)):
+            artist = ['Lee Krasner', 'Jackson Pollock'][p % 2]
+            for s in range(25):
+                w.writerow(['T%s' % p, artist, p % 2, 1930 + p // 2, 'f%s.jpg' % p, 400 + p % 40 * 10, 300, p * 4000, p * 4000 + 4000, rnd.randint(0, 359), rnd.randint(0, 100), rnd.randint(0, 100), s, s, rnd.randint(1, 30), rnd.randint(1, 30)])
+
+# Codes of the countries refugees can come from and go to
+def getCountryCodes():
+    with open(os.path.join(ROOT_DIR, '06_refugees', 'data', 'countries.csv.sample'), 'rb') as f:
+        r = csv.reader(f)
+        next(r, None)
+        return [row[0] for row in r]
+
+# Refugees from one country to another in a year (like the UNHCR data, each pair of countries once a year)
+def writeRefugees(filename, n, rnd):
+    codes = getCountryCodes()
+    pairs = [(origin, asylum) for origin in codes for asylum in codes if origin != asylum]
+    rnd.shuffle(pairs)
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['origin', 'asylum', 'refugees', 'year'])
+        for i in range(n):
+            origin, asylum = pairs[i % len(pairs)]
+            w.writerow([origin, asylum, rnd.randint(1, 100000), 1975 + i * 38 // n])
+
+# Refugee groups (like preprocess_data.py writes)
+def writeRefugeesProcessed(filename, n, rnd):
+    codes = getCountryCodes()
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['origin', 'count', 'angle', 'origin_y', 'origin_x', 'year', 'asylum_x', 'asylum_y', 'asylum', 'distance'])
+        for i in range(n):
+            origin, asylum = rnd.sample(codes, 2)
+            w.writerow([origin, rnd.randint(1, 100000), rnd.uniform(-180, 180), rnd.uniform(0, 600), rnd.uniform(0, 1000), 1975 + i * 38 // n, rnd.uniform(0, 1000), rnd.uniform(0, 600), asylum, rnd.uniform(1, 900)])
+
+# Land lost in each 3-year period
+def writeLandLoss(filename, n, rnd):
+    years = [{'year_start': 1932 + i * 3, 'year_end': 1935 + i * 3, 'losses': [0] * rnd.randint(5, 200)} for i in range(n)]
+    with open(filename, 'w') as f:
+        json.dump(years, f)
+
+# Songs of 10 artists each, with lyrics of common words and words for body parts
+def writeLyrics(filename, n, rnd):
+    with open(os.path.join(ROOT_DIR, '08_body', 'data', 'words.csv'), 'rb') as f:
+        body_words = [row['word'] for row in csv.DictReader(f)]
+    common_words = ['the', 'and', 'i', 'you', 'my', 'your', 'his', 'her', 'she', 'he', 'love', 'baby', 'night', 'all', 'me', 'we']
+    songs = []
+    for i in range(n):
+        lyrics = [rnd.choice(body_words) if rnd.random() < 0.05 else rnd.choice(common_words) for j in range(rnd.randint(150, 400))]
+        songs.append({'artist': 'Artist %s' % (i // 10), 'gender': ['male', 'female'][i // 10 % 2], 'song': 'Song %s' % i, 'album': 'Album %s' % (i // 5), 'url': 'http://example.com/%s' % i, 'lyrics': ' '.join(lyrics)})
+    with open(filename, 'w') as f:
+        json.dump(songs, f)
+
+# The real artists of the body track in the order they play: a list of (name, gender)
+def getBodyArtists():
+    with open(os.path.join(ROOT_DIR, '08_body', 'data', 'artists.csv'), 'rb') as f:
+        return [(row['name'], row['gender']) for row in csv.DictReader(f)]
+
+# Artists in the order they play: the real ones repeated under new names, like writeLyrics names them
+def writeBodyArtists(filename, n, rnd):
+    artists = getBodyArtists()
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['name', 'gender'])
+        for i in range(n):
+            w.writerow(['Artist %s' % i, artists[i % len(artists)][1]])
+
+# Analysis of each artist's body words (like analyze_lyrics.py writes), the real ones repeated under new names
+def writeAnalysis(filename, n, rnd):
+    artists = getBodyArtists()
+    with open(os.path.join(ROOT_DIR, '08_body', 'data', 'analysis.json')) as f:
+        real = dict([(a['artist'].encode('utf-8'), a) for a in json.load(f)])
+    analysis = []
+    for i in range(n):
+        a = json.loads(json.dumps(real[artists[i % len(artists)][0]]))
+        a['index'] = i
+        a['artist'] = 'Artist %s' % i
+        for song in a['top_songs']:
+            song['artist'] = a['artist']
+        analysis.append(a)
+    with open(filename, 'w') as f:
+        json.dump(analysis, f)
+
+# Instruments of each artist, the real artist's instruments repeated under new names
+def writeBodyInstruments(filename, n, rnd):
+    artists = getBodyArtists()
+    with open(os.path.join(ROOT_DIR, '08_body', 'data', 'instruments.csv'), 'rb') as f:
+        r = csv.reader(f)
+        header = next(r)
+        real = list(r)
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        for i in range(n):
+            for row in real:
+                if row[1] == artists[i % len(artists)][0]:
+                    w.writerow(row[:1] + ['Artist %s' % i] + row[2:])
+
+# Movies like the real ones, repeated with new names and ids
+def writeMovies(filename, n, rnd):
+    with open(os.path.join(ROOT_DIR, '09_hollywood', 'data', 'top_10_movies_2006-2015.json')) as f:
+        real = json.load(f)
+    movies = []
+    for i in range(n):
+        movie = json.loads(json.dumps(real[i % len(real)]))
+        movie['name'] = '%s %s' % (movie['name'], i // len(real) + 1)
+        movie['imdb_id'] = str(i)
+        movies.append(movie)
+    with open(filename, 'w') as f:
+        json.dump(movies, f)
+
+# Stars: time (0-1), id, y (0-1) and magnitude (0-1), in order of time
+def writeStars(filename, n, rnd):
+    rows = sorted([[rnd.random(), rnd.randint(1, 5000), rnd.random(), rnd.random()] for i in range(n)])
+    with open(filename, 'w') as f:
+        json.dump(rows, f)
+
+# Stages to benchmark: generators of their data files => base number of rows (scaled by each of {SCALES})
+BENCHMARKS = [
+    {'stage': '01_subway/subway', 'inputs': {'data/stations.csv': writeStations}, 'rows': 50},
+    {'stage': '02_brain/preprocess_data', 'inputs': {'data/chb01_15_data.txt': writeEegRaw}, 'rows': 1000},
+    {'stage': '02_brain/brain', 'inputs': {'data/eeg.csv': writeEeg}, 'rows': 1000},
+    {'stage': '03_smog/preprocess_data', 'inputs': {'data/raw': writePm25Raw}, 'rows': 2400},
+    {'stage': '03_smog/smog', 'inputs': {'data/pm25_readings.csv': writePm25}, 'rows': 100},
+    {'stage': '04_dating/dating', 'inputs': {'data/pairs.csv': writePairs}, 'rows': 100},
+    {'stage': '05_painters/painters', 'inputs': {'data/painting_samples.csv': writePaintingSamples}, 'rows': 250},
+    {'stage': '06_refugees/preprocess_data', 'inputs': {'data/refugees.csv': writeRefugees}, 'rows': 500},
+    {'stage': '06_refugees/refugees', 'inputs': {'data/refugees_processed.csv': writeRefugeesProcessed}, 'rows': 500},
+    {'stage': '07_louisiana/louisiana', 'inputs': {'data/land_loss.json': writeLandLoss}, 'rows': 12},
+    {'stage': '08_body/analyze_lyrics', 'inputs': {'data/lyrics.json': writeLyrics}, 'rows': 50},
+    {'stage': '08_body/body', 'inputs': {'data/instruments.csv': writeBodyInstruments, 'data/artists.csv': writeBodyArtists, 'data/analysis.json': writeAnalysis}, 'rows': 11},
+    {'stage': '09_hollywood/hollywood', 'inputs': {'data/top_10_movies_2006-2015.json': writeMovies}, 'rows': 100},
+    {'stage': '09_hollywood/hollywood_census', 'inputs': {'data/top_10_movies_2006-2015.json': writeMovies}, 'rows': 100},
+    {'stage': '10_stars/stars', 'inputs': {'data/sequence.json': writeStars}, 'rows': 1000}
+]
+
+# Copy a track to the scratch directory: its scripts and data (using .sample files where there's no real file),
+# with the directories its stages write to, and its (large) instruments directory linked rather than copied
+def copyTrack(track, scratch_dir, root_dir=ROOT_DIR):
+    source = os.path.join(root_dir, track)
+    target = os.path.join(scratch_dir, track)
+    if os.path.exists(target):
+        return target
+    shutil.copytree(source, target, ignore=shutil.ignore_patterns('instruments', '*.pyc'))
+    if os.path.isdir(os.path.join(source, 'instruments')):
+        os.symlink(os.path.abspath(os.path.join(source, 'instruments')), os.path.join(target, 'instruments'))
+    data_dir = os.path.join(target, 'data')
+    for filename in os.listdir(data_dir):
+        name, ext = os.path.splitext(filename)
+        if ext == '.sample' and not os.path.exists(os.path.join(data_dir, name)):
+            shutil.copyfile(os.path.join(data_dir, filename), os.path.join(data_dir, name))
+    for stage in build.STAGES:
+        if stage['track'] != track:
+            continue
+        for output in stage['outputs']:
+            directory = os.path.dirname(os.path.join(target, output))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+    return target
+
+# Run a stage's script in its track directory, returning (return code, seconds, peak memory in MB)
+# The script is stopped if it's still running after {timeout} seconds, with return code None
+def runStage(stage, track_dir, log, timeout=TIMEOUT):
+    started = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os.chdir(track_dir)
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            os.execv(sys.executable, [sys.executable, stage['script']] + stage['args'])
+        finally:
+            os._exit(127)
+    while True:
+        # wait4 gives the peak memory of this child alone
+        waited, status, usage = os.wait4(pid, os.WNOHANG)
+        if waited == pid:
+            break
+        if time.time() - started > timeout:
+            os.kill(pid, signal.SIGKILL)
+            os.wait4(pid, 0)
+            return (None, time.time() - started, None)
+        time.sleep(0.01)
+    seconds = time.time() - started
+    code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak_mb = usage.ru_maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else usage.ru_maxrss / 1024.0
+    return (code, seconds, peak_mb)
+
+# Seconds to start Python and import numpy, which every stage pays whatever its size
+def getStartupSeconds():
+    started = time.time()
+    os.spawnv(os.P_WAIT, sys.executable, [sys.executable, '-c', 'import numpy'])
+    return time.time() - started
+
+# Exponent k of growth like size^k between two measurements
+def getExponent(size1, value1, size2, value2):
+    if size1 == size2 or value1 <= 0 or value2 <= 0:
+        return None
+    return math.log(1.0 * value2 / value1) / math.log(1.0 * size2 / size1)
+
+# Growth of a benchmark's time and memory between its two largest sizes that finished
+# Returns (time exponent, memory exponent, flagged)
+def getGrowth(runs, startup_seconds=0.0):
+    finished = [run for run in runs if run['status'] == 'ok']
+    timed_out = len([run for run in runs if run['status'] == 'timeout']) > 0
+    if len(finished) < 2:
+        return (None, None, timed_out)
+    a, b = finished[-2], finished[-1]
+    # fixed costs hide growth at small sizes, so time is measured past startup
+    time_exponent = getExponent(a['rows'], max(a['seconds'] - startup_seconds, 0.001), b['rows'], max(b['seconds'] - startup_seconds, 0.001))
+    memory_exponent = getExponent(a['rows'], a['peak_mb'], b['rows'], b['peak_mb'])
+    flagged = timed_out or any([k is not None and k > SUPERLINEAR_EXPONENT for k in [time_exponent, memory_exponent]])
+    return (time_exponent, memory_exponent, flagged)
+
+# Run a benchmark at each scale, stopping at the first size that fails or times out
+def runBenchmark(benchmark, scratch_dir, scales=SCALES, timeout=TIMEOUT, log=sys.stdout, root_dir=ROOT_DIR):
+    stage = [s for s in build.STAGES if build.getName(s) == benchmark['stage']][0]
+    track_dir = copyTrack(stage['track'], scratch_dir, root_dir)
+    runs = []
+    for scale in scales:
+        rows = benchmark['rows'] * scale
+        for filename, generate in sorted(benchmark['inputs'].items()):
+            generate(os.path.join(track_dir, filename), rows, random.Random(SEED))
+        with open(os.path.join(scratch_dir, 'benchmark.log'), 'ab') as stage_log:
+            stage_log.write('=== %s x%s\n' % (benchmark['stage'], scale))
+            stage_log.flush()
+            code, seconds, peak_mb = runStage(stage, track_dir, stage_log, timeout)
+        status = 'ok' if code == 0 else ('timeout' if code is None else 'failed')
+        runs.append({'scale': scale, 'rows': rows, 'status': status, 'seconds': round(seconds, 3), 'peak_mb': round(peak_mb, 1) if peak_mb is not None else None})
+        log.write('%-30s x%-5s %9s rows %9.2fs %8s MB %s\n' % (benchmark['stage'], scale, rows, seconds, '%.1f' % peak_mb if peak_mb is not None else '-', '' if status == 'ok' else status.upper()))
+        log.flush()
+        if status != 'ok':
+            break
+    return runs
+
+# Benchmark stages (all by default); returns a list of results, one per stage
+def benchmark(names=None, scales=SCALES, timeout=TIMEOUT, log=sys.stdout, root_dir=ROOT_DIR, keep=False):
+    benchmarks = [b for b in BENCHMARKS if not names or b['stage'] in names or b['stage'].split('/')[0] in names]
+    scratch_dir = tempfile.mkdtemp(prefix='benchmark_')
+    # scripts import util from their parent directory; caches start empty so every size is built from its text
+    shutil.copytree(os.path.dirname(os.path.abspath(__file__)), os.path.join(scratch_dir, 'util'), ignore=shutil.ignore_patterns('cache', '*.pyc'))
+    startup_seconds = getStartupSeconds()
+    results = []
+    try:
+        for b in benchmarks:
+            runs = runBenchmark(b, scratch_dir, scales, timeout, log, root_dir)
+            time_exponent, memory_exponent, flagged = getGrowth(runs, startup_seconds)
+            results.append({'stage': b['stage'], 'runs': runs, 'time_exponent': time_exponent, 'memory_exponent': memory_exponent, 'superlinear': flagged})
+    finally:
+        if keep:
+            log.write('Kept scratch directory: %s\n' % scratch_dir)
+        else:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    return results
+
+# Format an exponent for the summary
+def formatExponent(k):
+    return 'n^%.2f' % k if k is not None else '-'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('STAGES', nargs='*', help="Stages or tracks to benchmark, e.g. 06_refugees/preprocess_data 01_subway (default: all)")
+    parser.add_argument('-scales', dest="SCALES", nargs='+', type=int, default=SCALES, help="Multiples of each stage's base data size")
+    parser.add_argument('-timeout', dest="TIMEOUT", type=int, default=TIMEOUT, help="Seconds a stage may run at one size")
+    parser.add_argument('-o', dest="OUTPUT_FILE", default="", help="Write results to this JSON file")
+    parser.add_argument('-keep', dest="KEEP", action="store_true", help="Keep the scratch directory (generated data and stage output)")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.STAGES if name not in [b['stage'] for b in BENCHMARKS] and name not in [b['stage'].split('/')[0] for b in BENCHMARKS]]
+    if len(unknown) > 0:
+        print('No benchmark for: %s' % ', '.join(unknown))
+        sys.exit(1)
+
+    results = benchmark(args.STAGES, sorted(args.SCALES), args.TIMEOUT, keep=args.KEEP)
+
+    print('')
+    for result in results:
+        print('%-30s time %-8s memory %-8s %s' % (result['stage'], formatExponent(result['time_exponent']), formatExponent(result['memory_exponent']), 'SUPER-LINEAR' if result['superlinear'] else ''))
+    if args.OUTPUT_FILE:
+        with open(args.OUTPUT_FILE, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Wrote results to %s' % args.OUTPUT_FILE)
+    if any([r['status'] == 'failed' for result in results for r in result['runs']]):
+        sys.exit(1)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+##
+# Builds every track (or the tracks given) from its data: runs each track's stages (preprocess_data.py,
+# csv_to_json.py, analyze_lyrics.py, the track script...) in its directory, several at a time.
+# A stage depends on the stages that write its input files, so stages form a graph and each one starts as soon
+# as the stages it depends on are done; a full build takes as long as the slowest chain of stages rather than
+# the sum of them. A stage that fails, or is missing an input nothing builds (unless its outputs are already there),
+# skips the stages that depend on it.
+# Stages whose inputs, code and config haven't changed since they were last built aren't run again (see build_cache.py).
+# With -trace, every stage's script records where its time and memory go (see tracing.py) into one Chrome trace.
+# Usage: python build.py [tracks, e.g. 02_brain 03_smog] [-p 4] [-n] [-f] [-trace build_trace.json]
+##
+
+import argparse
+import glob
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from build_cache import BuildCache
+import tracing
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Stages of each track, in the order they'd be run by hand; files are relative to the track's directory
+STAGES = [
+    {'track': '01_subway', 'script': 'subway.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/stations.csv'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_sequence.csv', 'visualization/stations/data/stations.json', 'visualization/map/data/stations.json']},
+    {'track': '02_brain', 'script': 'preprocess_data.py', 'args': [],
+        'inputs': ['data/chb01_15_data.txt'],
+        'outputs': ['data/eeg.csv', 'visualization/data/eeg_events.json']},
+    {'track': '02_brain', 'script': 'brain.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/eeg.csv'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_channel_summary.csv', 'data/report_sequence.csv']},
+    {'track': '03_smog', 'script': 'preprocess_data.py', 'args': [],
+        'inputs': ['data/raw'],
+        'outputs': ['data/pm25_readings.csv']},
+    {'track': '03_smog', 'script': 'smog.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/pm25_readings.csv'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_sequence.csv', 'visualization/data/pm25_data.json']},
+    {'track': '04_dating', 'script': 'dating.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/pairs.csv'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_sequence.csv', 'visualization/data/pairs.json']},
+    {'track': '05_painters', 'script': 'painters.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/synesthesia.csv', 'data/painting_samples.csv'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_summary_notes.csv', 'data/report_sequence.csv', 'visualization/data/paintings.json']},
+    {'track': '06_refugees', 'script': 'preprocess_data.py', 'args': [],
+        'inputs': ['data/countries.csv', 'data/refugees.csv'],
+        'outputs': ['data/refugees_processed.csv']},
+    {'track': '06_refugees', 'script': 'refugees.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/countrycodes.json', 'data/populations.json', 'data/refugees_processed.csv', 'data/events.csv'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_sequence.csv', 'visualization/data/years_refugees.json']},
+    {'track': '07_louisiana', 'script': 'louisiana.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/land_loss.json'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_sequence.csv']},
+    {'track': '08_body', 'script': 'analyze_lyrics.py', 'args': [],
+        'inputs': ['data/lyrics.json', 'data/words.csv'],
+        'outputs': ['data/analysis.json', 'data/song_analysis.csv']},
+    {'track': '08_body', 'script': 'body.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/artists.csv', 'data/analysis.json'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_sequence.csv', 'visualization/data/visualization.json']},
+    {'track': '09_hollywood', 'script': 'csv_to_json.py', 'args': ['data/top_10_movies_2006-2015.csv', 'data/top_10_movies_2006-2015_people.csv', 'data/top_10_movies_2006-2015.json', 'data/races.json'],
+        'inputs': ['data/top_10_movies_2006-2015.csv', 'data/top_10_movies_2006-2015_people.csv'],
+        'outputs': ['data/top_10_movies_2006-2015.json', 'data/races.json']},
+    {'track': '09_hollywood', 'script': 'hollywood.py', 'args': [],
+        'inputs': ['data/instruments.csv', 'data/top_10_movies_2006-2015.json'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv', 'data/report_summary.csv', 'data/report_sequence.csv']},
+    {'track': '09_hollywood', 'script': 'hollywood_census.py', 'args': [],
+        'inputs': ['data/top_10_movies_2006-2015.json', 'data/census_2014.json'],
+        'outputs': ['data/hollywood_census_report.csv']},
+    {'track': '10_stars', 'script': 'stars.py', 'args': [],
+        'inputs': ['data/sequence.json'],
+        'outputs': ['data/ck_instruments.csv', 'data/ck_sequence.csv']}
+]
+
+# Name of a stage, e.g. 02_brain/preprocess_data
+def getName(stage):
+    return stage['track'] + '/' + os.path.splitext(stage['script'])[0]
+
+# Path of a stage's file from the root directory
+def getPath(stage, filename):
+    return os.path.normpath(os.path.join(stage['track'], filename))
+
+# Stages each stage depends on, i.e. the last stage before it that writes each of its inputs
+def getDependencies(stages):
+    dependencies = {}
+    writers = {}
+    for stage in stages:
+        name = getName(stage)
+        dependencies[name] = set([writers[getPath(stage, f)] for f in stage['inputs'] if getPath(stage, f) in writers])
+        for f in stage['outputs']:
+            writers[getPath(stage, f)] = name
+    return dependencies
+
+# Inputs of a stage that don't exist and that no stage writes
+def getMissingInputs(stage, stages, root_dir=ROOT_DIR):
+    written = set([getPath(s, f) for s in stages for f in s['outputs']])
+    return [f for f in stage['inputs'] if getPath(stage, f) not in written and not os.path.exists(os.path.join(root_dir, getPath(stage, f)))]
+
+# Run a stage's script in its track's directory, unless the build cache has its outputs (and {force} isn't set)
+# Returns (name, return code, output, seconds, status, changes): status is 'built', 'current' or 'restored',
+# and changes lists what changed since the stage was last built
+def runStage(stage, root_dir=ROOT_DIR, cache=None, force=False):
+    started = time.time()
+    track_dir = os.path.join(root_dir, stage['track'])
+    manifest = None
+    changes = []
+    if cache is not None:
+        status, manifest, changes = cache.check(stage, track_dir)
+        if force:
+            changes = ['forced']
+        elif status != 'stale':
+            return (getName(stage), 0, '', time.time() - started, status, changes)
+    try:
+        process = subprocess.Popen([sys.executable, stage['script']] + stage['args'], cwd=track_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        return (getName(stage), -1, str(e) + '\n', time.time() - started, 'built', changes)
+    output = process.communicate()[0]
+    if process.returncode == 0 and cache is not None:
+        cache.store(stage, track_dir, manifest)
+    return (getName(stage), process.returncode, output, time.time() - started, 'built', changes)
+
+# Run stages in a pool of {processes}, each as soon as the stages it depends on have succeeded
+# Stages are skipped or restored from the build cache if nothing they're built from has changed (see build_cache.py)
+# Returns a dict of stage name => 'done', 'failed' or 'skipped'
+# {trace_events}, if given, gets a Chrome trace event for each stage that ran
+def build(stages, processes=None, root_dir=ROOT_DIR, log=sys.stdout, cache=None, force=False, trace_events=None):
+    by_name = dict([(getName(stage), stage) for stage in stages])
+    dependencies = getDependencies(stages)
+    results = {}
+    for stage in stages:
+        missing = getMissingInputs(stage, stages, root_dir)
+        if len(missing) <= 0:
+            continue
+        # e.g. raw data that isn't distributed, but whose processed files are
+        read = set([getPath(s, f) for s in stages for f in s['inputs']])
+        needed = [f for f in stage['outputs'] if getPath(stage, f) in read] or stage['outputs']
+        if all([os.path.exists(os.path.join(root_dir, getPath(stage, f))) for f in needed]):
+            results[getName(stage)] = 'done'
+            log.write('Using the existing outputs of %s, missing %s\n' % (getName(stage), ', '.join(missing)))
+        else:
+            results[getName(stage)] = 'skipped'
+            log.write('Skipping %s, missing %s\n' % (getName(stage), ', '.join(missing)))
+
+    finished = Queue.Queue()
+    pool = ThreadPool(processes or multiprocessing.cpu_count())
+    running = 0
+    try:
+        while True:
+            for stage in stages:
+                name = getName(stage)
+                if name in results:
+                    continue
+                states = [results.get(d) for d in dependencies[name]]
+                if any([state in ('failed', 'skipped') for state in states]):
+                    results[name] = 'skipped'
+                    log.write('Skipping %s, a stage it depends on didn\'t finish\n' % name)
+                elif all([state == 'done' for state in states]):
+                    results[name] = 'running'
+                    running += 1
+                    pool.apply_async(runStage, (stage, root_dir, cache, force), callback=finished.put)
+            if running <= 0:
+                break
+            name, returncode, output, seconds, status, changes = finished.get()
+            running -= 1
+            if trace_events is not None:
+                lane = [getName(stage) for stage in stages].index(name)
+                trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': lane, 'args': {'name': name}})
+                trace_events.append({'name': name, 'cat': 'build', 'ph': 'X', 'ts': int((time.time() - seconds) * 1000000), 'dur': int(seconds * 1000000), 'pid': os.getpid(), 'tid': lane, 'args': {'status': status if returncode == 0 else 'failed'}})
+            results[name] = 'done' if returncode == 0 else 'failed'
+            reason = ' (changed: %s)' % ', '.join(changes) if len(changes) > 0 else ''
+            if status == 'current':
+                log.write('Up to date %s\n' % name)
+            elif status == 'restored':
+                log.write('Restored %s from the build cache%s\n' % (name, reason))
+            else:
+                log.write('%s %s in %ss%s\n' % ('Built' if returncode == 0 else 'FAILED', name, round(seconds, 1), reason))
+            if returncode != 0:
+                log.write(output)
+    finally:
+        pool.close()
+        pool.join()
+    # stages left waiting on a dependency outside the build
+    for name in by_name:
+        if results.get(name) not in ('done', 'failed', 'skipped'):
+            results[name] = 'skipped'
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('TRACKS', nargs='*', help="Tracks to build, e.g. 02_brain 03_smog; all of them by default")
+    parser.add_argument('-p', dest="PROCESSES", default=0, type=int, help="Stages to run at a time; 0 for one per CPU")
+    parser.add_argument('-n', dest="DRY_RUN", action="store_true", help="List the stages and what they depend on without running them")
+    parser.add_argument('-f', dest="FORCE", action="store_true", help="Run every stage, even if it's up to date")
+    parser.add_argument('-nocache', dest="NO_CACHE", action="store_true", help="Don't use or update the build cache")
+    parser.add_argument('-trace', dest="TRACE_FILE", default="", help="Write a Chrome trace of the build and each stage's phases to this file")
+    args = parser.parse_args()
+
+    tracks = [track.strip('/') for track in args.TRACKS]
+    stages = [stage for stage in STAGES if len(tracks) <= 0 or stage['track'] in tracks]
+    if len(stages) <= 0:
+        print('No stages to build for: '+', '.join(tracks))
+        sys.exit(1)
+
+    if args.DRY_RUN:
+        dependencies = getDependencies(stages)
+        for stage in stages:
+            name = getName(stage)
+            print(name + (' <- ' + ', '.join(sorted(dependencies[name])) if dependencies[name] else ''))
+        sys.exit(0)
+
+    started = time.time()
+    cache = None if args.NO_CACHE else BuildCache()
+    trace_events = None
+    if args.TRACE_FILE:
+        # stages' scripts trace themselves into this directory (see tracing.py)
+        trace_dir = tempfile.mkdtemp(prefix='trace_')
+        os.environ[tracing.TRACE_DIR_VARIABLE] = trace_dir
+        trace_events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': 'build'}}]
+    results = build(stages, args.PROCESSES or None, cache=cache, force=args.FORCE, trace_events=trace_events)
+    if args.TRACE_FILE:
+        with open(args.TRACE_FILE, 'w') as f:
+            json.dump(tracing.merge(sorted(glob.glob(os.path.join(trace_dir, '*.json'))), trace_events), f)
+        shutil.rmtree(trace_dir, ignore_errors=True)
+        print('Wrote trace to %s' % args.TRACE_FILE)
+    counts = dict([(state, sum([1 for result in results.values() if result == state])) for state in ('done', 'failed', 'skipped')])
+    print('Finished %s stages in %ss (%s failed, %s skipped)' % (counts['done'], round(time.time() - started, 1), counts['failed'], counts['skipped']))
+    if counts['failed'] > 0:
+        sys.exit(1)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+##
+# Incremental build cache for util/build.py
+# Each stage records a manifest of what it was built from: hashes of its input files, its script and the util modules
+# the script imports (the code version), the script's config constants, its arguments and the Python version.
+# A stage whose manifest hasn't changed and whose outputs are as it left them is up to date and isn't run again.
+# Outputs are also kept in the cache under a key made from the manifest, so going back to an earlier state of the
+# inputs (e.g. undoing a config change) restores that build's outputs instead of running the stage.
+# Files are only read to be hashed when their size or modification time has changed since the last build.
+##
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(UTIL_DIR, 'cache', 'build')
+
+# Hash of a file's contents
+def hashFile(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Hashes of files, or of every file under directories, as a dict of path => {size, mtime, hash}
+# {known} hashes from an earlier build are reused for files whose size and modification time haven't changed
+def getHashes(base_dir, paths, known={}):
+    files = []
+    for path in paths:
+        full_path = os.path.join(base_dir, path)
+        if os.path.isdir(full_path):
+            for directory, dirnames, filenames in os.walk(full_path):
+                dirnames.sort()
+                files += [os.path.relpath(os.path.join(directory, filename), base_dir) for filename in sorted(filenames)]
+        else:
+            files.append(path)
+    hashes = {}
+    for path in files:
+        full_path = os.path.join(base_dir, path)
+        if not os.path.exists(full_path):
+            hashes[path] = None
+            continue
+        stat = os.stat(full_path)
+        entry = known.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': hashFile(full_path)}
+        hashes[path] = entry
+    return hashes
+
+# Util modules a script imports, and the modules they import
+def getModules(filename, modules=None):
+    if modules is None:
+        modules = []
+    with open(filename, 'rb') as f:
+        text = f.read().decode('utf-8', 'replace')
+    names = re.findall(r'^\s*(?:import|from)\s+(\w+)', text, re.MULTILINE)
+    for name in names:
+        module_file = os.path.join(UTIL_DIR, name + '.py')
+        if name not in modules and os.path.exists(module_file):
+            modules.append(name)
+            getModules(module_file, modules)
+    return sorted(modules)
+
+# A script's config constants, i.e. its top level UPPER_CASE assignments, as written
+def getConfig(filename):
+    with open(filename, 'rb') as f:
+        text = f.read().decode('utf-8', 'replace')
+    config = {}
+    for name, value in re.findall(r'^([A-Z][A-Z0-9_]*)\s*=\s*(.*?)\s*(?:#.*)?$', text, re.MULTILINE):
+        config[name] = value
+    return config
+
+# Manifest of a stage (see util/build.py) built in {track_dir}, reusing the file hashes of its {previous} manifest
+def getManifest(stage, track_dir, previous=None):
+    previous = previous or {}
+    script = os.path.join(track_dir, stage['script'])
+    modules = getModules(script)
+    code = getHashes(track_dir, [stage['script']], previous.get('code', {}))
+    code.update(getHashes(UTIL_DIR, [name + '.py' for name in modules], previous.get('code', {})))
+    return {
+        'inputs': getHashes(track_dir, stage['inputs'], previous.get('inputs', {})),
+        'code': code,
+        'config': getConfig(script),
+        'args': stage['args'],
+        'python': sys.version.split()[0]
+    }
+
+# Hashes only, i.e. what the stage's outputs depend on
+def getContents(hashes):
+    return dict([(path, entry['hash'] if entry else None) for path, entry in hashes.items()])
+
+# Key of a manifest: a hash of everything the stage's outputs depend on
+def getKey(manifest):
+    contents = {
+        'inputs': getContents(manifest['inputs']),
+        'code': getContents(manifest['code']),
+        'args': manifest['args'],
+        'python': manifest['python']
+    }
+    return hashlib.sha1(json.dumps(contents, sort_keys=True).encode('utf-8')).hexdigest()
+
+# What changed between two manifests, e.g. ['data/instruments.csv', 'BPM'], for reporting why a stage runs
+def getChanges(previous, manifest):
+    if not previous:
+        return ['not built before']
+    changes = []
+    for group in ['inputs', 'code']:
+        before = getContents(previous.get(group, {}))
+        after = getContents(manifest[group])
+        changes += sorted([path for path in set(before) | set(after) if before.get(path) != after.get(path)])
+    before = previous.get('config', {})
+    changes += sorted([name for name in set(before) | set(manifest['config']) if before.get(name) != manifest['config'].get(name)])
+    if previous.get('args') != manifest['args']:
+        changes.append('arguments')
+    if previous.get('python') != manifest['python']:
+        changes.append('python version')
+    return changes or ['code']
+
+# Write JSON to a file atomically
+def saveJson(filename, data):
+    fd, temporary = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(temporary, filename)
+
+class BuildCache(object):
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def getManifestFile(self, stage):
+        return os.path.join(self.cache_dir, 'manifests', stage['track'], os.path.splitext(stage['script'])[0] + '.json')
+
+    def getOutputsDir(self, key):
+        return os.path.join(self.cache_dir, 'outputs', key)
+
+    def loadManifest(self, stage):
+        filename = self.getManifestFile(stage)
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            return json.load(f)
+
+    # Check a stage before running it; returns (status, manifest, reasons)
+    #   status: 'current' if its outputs are up to date, 'restored' if they were restored from the cache, else 'stale'
+    def check(self, stage, track_dir):
+        previous = self.loadManifest(stage)
+        manifest = getManifest(stage, track_dir, previous)
+        manifest['key'] = getKey(manifest)
+        if previous and previous.get('key') == manifest['key']:
+            outputs = getHashes(track_dir, stage['outputs'], previous.get('outputs', {}))
+            if getContents(outputs) == getContents(previous.get('outputs', {})):
+                return ('current', manifest, [])
+        if self.restore(stage, track_dir, manifest):
+            return ('restored', manifest, getChanges(previous, manifest))
+        return ('stale', manifest, getChanges(previous, manifest))
+
+    # Copy a stage's outputs back from the cache, if it has been built from the same manifest before
+    def restore(self, stage, track_dir, manifest):
+        outputs_dir = self.getOutputsDir(manifest['key'])
+        outputs_file = os.path.join(outputs_dir, 'outputs.json')
+        if not os.path.exists(outputs_file):
+            return False
+        with open(outputs_file) as f:
+            outputs = json.load(f)
+        for path, entry in outputs.items():
+            target = os.path.join(track_dir, path)
+            if entry is None:
+                if os.path.exists(target):
+                    os.remove(target)
+                continue
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copyfile(os.path.join(outputs_dir, entry['hash']), target)
+        self.record(stage, track_dir, manifest)
+        return True
+
+    # Record a stage's manifest and its outputs as they are now, after building (or restoring) it
+    def record(self, stage, track_dir, manifest):
+        manifest['outputs'] = getHashes(track_dir, stage['outputs'])
+        filename = self.getManifestFile(stage)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        saveJson(filename, manifest)
+
+    # Keep copies of a stage's outputs under its manifest's key, then record it
+    def store(self, stage, track_dir, manifest):
+        outputs = getHashes(track_dir, stage['outputs'])
+        outputs_dir = self.getOutputsDir(manifest['key'])
+        if not os.path.exists(outputs_dir):
+            os.makedirs(outputs_dir)
+        for path, entry in outputs.items():
+            if entry is not None and not os.path.exists(os.path.join(outputs_dir, entry['hash'])):
+                shutil.copyfile(os.path.join(track_dir, path), os.path.join(outputs_dir, entry['hash']))
+        saveJson(os.path.join(outputs_dir, 'outputs.json'), outputs)
+        self.record(stage, track_dir, manifest)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+##
+# Streams a track's notes out of its build as they're generated, for stream.py -build
+# A track script that generates its notes in order of time (give or take {slack_ms}) hands them to a BuildStream
+# instead of its sequence. The stream holds them until the build has moved {slack_ms} past them, so no note it
+# generates later can come before them, then passes them on in order as blocks of columns (like
+# SequenceBuffer.merged), so the first notes can play while the rest of the song is still being generated.
+# Notes at the same ms are passed on in order of instrument, as a build that appends every instrument's notes in
+# turn sorts them.
+# A streamed build is only listened to: it keeps no notes and stops once they're all passed on, so it writes none
+# of the track's files, which only a build that isn't streamed makes. Only a build run by stream.py in its own
+# process streams; otherwise getStream() is None and the script builds as usual.
+# Usage (in a track script):
+#   notes = build_stream.getStream(slack_ms)
+#   for each segment in order of time (ms):
+#       ... generate its notes ...
+#       if notes:
+#           notes.append(index, elapsed_ms, gains)
+#           notes.advance(ms)
+#       else:
+#           sequence.append(index, elapsed_ms, gains)
+#   if notes:
+#       notes.close()
+#       sys.exit()
+##
+
+import numpy as np
+
+from sequence_buffer import COLUMNS
+
+listener = None # queue of blocks (see report.BlockQueue) a build streams its notes to, while one is listening
+
+# Stream the notes of builds run in this process to {blocks}, or stop streaming them if None
+def listen(blocks):
+    global listener
+    listener = blocks
+
+# A stream for a build's notes if one is listening, else None
+def getStream(slack_ms):
+    if listener is None:
+        return None
+    return BuildStream(listener, slack_ms)
+
+class BuildStream(object):
+
+    # blocks: queue to put blocks of notes on; slack_ms: how far before the build's current ms it can still add notes
+    def __init__(self, blocks, slack_ms):
+        self.blocks = blocks
+        self.slack_ms = slack_ms
+        self.pending = []
+        self.previous_ms = 0
+        self.sent = 0
+
+    # Hold notes until the build has moved past them; values are as SequenceBuffer.append takes them
+    def append(self, instrument_index, elapsed_ms, gain, **columns):
+        elapsed_ms = np.atleast_1d(np.asarray(elapsed_ms, dtype=np.int64))
+        count = len(elapsed_ms)
+        if count <= 0:
+            return
+        values = dict(columns)
+        values['instrument_index'] = instrument_index
+        values['elapsed_ms'] = elapsed_ms
+        values['gain'] = gain
+        # stored as a sequence stores them, so the notes streamed are the ones its file would have
+        self.pending.append(dict([(name, np.broadcast_to(np.asarray(value, dtype=COLUMNS[name]), (count,))) for name, value in values.items()]))
+
+    # The build has got to {ms}: pass on every note before {ms} - {slack_ms} in order
+    def advance(self, ms):
+        self.flush(int(ms) - self.slack_ms)
+
+    # Pass on every note held before {until_ms} (all of them if None) in order of ms, then instrument; notes of an
+    # instrument at the same ms keep the order they were added in
+    def flush(self, until_ms=None):
+        if len(self.pending) <= 0:
+            return
+        names = self.pending[0].keys()
+        columns = dict([(name, np.concatenate([notes[name] for notes in self.pending])) for name in names])
+        order = np.lexsort((columns['instrument_index'], columns['elapsed_ms']))
+        columns = dict([(name, column[order]) for name, column in columns.items()])
+        count = len(order) if until_ms is None else int(np.searchsorted(columns['elapsed_ms'], until_ms, side='left'))
+        self.pending = [dict([(name, column[count:]) for name, column in columns.items()])] if count < len(order) else []
+        if count <= 0:
+            return
+        block = dict([(name, column[:count]) for name, column in columns.items()])
+        block['milliseconds'] = np.diff(block['elapsed_ms'], prepend=self.previous_ms)
+        self.previous_ms = block['elapsed_ms'][-1]
+        self.sent += count
+        self.blocks.put(block)
+
+    # The build is done generating: pass on every note left
+    def close(self):
+        self.flush()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+##
+# Golden-output equivalence check for rewrites of the build stages: runs each stage on the same fixed fixtures
+# (the benchmark's synthetic data, see benchmark.py) in a base tree and in a candidate tree, then compares
+# their outputs and times. The base is a git revision (HEAD by default) or the working tree itself, and either
+# side's config constants can be overridden, e.g. to compare a new engine's setting against the legacy one.
+# Sequences (ck_sequence.csv or .cks) are compared note by note, ck_instruments.csv line by line, and reports
+# (CSV or JSON) value by value; numbers may differ by up to {tolerance}, and note times by {ms_tolerance} ms.
+# Stages of the build with no fixtures (no entry in benchmark.BENCHMARKS) can't be checked, and are listed.
+# Usage:
+#   python golden.py # working tree vs HEAD, every stage
+#   python golden.py 03_smog -base . -set MEMORY_BUDGET_MB=0.01 # spilling to disk vs in memory
+#   python golden.py -base 4a74d01 -tol 0.001 -mstol 1 -repeat 3
+##
+
+import argparse
+import csv
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import benchmark
+import build
+import stream
+
+ROOT_DIR = build.ROOT_DIR
+BASE = 'HEAD' # git revision to compare against, or '.' for the working tree
+TOLERANCE = 0.0 # how much numbers may differ
+MS_TOLERANCE = 0 # how many ms note times may differ
+SCALE = 1 # size of the fixtures, in multiples of each stage's base size (see benchmark.py)
+MAX_DIFFERENCES = 10 # differences listed per file
+SEQUENCE_FIELDS = ['instrument_index', 'position', 'gain', 'rate', 'reverb']
+
+# Write the files of {tracks} and util at a git revision into {target}, leaving out the (large) instruments
+def exportRevision(revision, target, tracks, root_dir=ROOT_DIR):
+    paths = subprocess.check_output(['git', 'ls-tree', '-r', '--name-only', revision, '--'] + tracks + ['util'], cwd=root_dir).splitlines()
+    paths = [path for path in paths if '/instruments/' not in path]
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    archive = subprocess.Popen(['git', 'archive', revision, '--'] + paths, cwd=root_dir, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', target], stdin=archive.stdout)
+    archive.stdout.close()
+    if archive.wait() != 0:
+        raise ValueError('Could not export revision %s' % revision)
+
+# Build a tree to run stages in: util and each track (see benchmark.copyTrack), from {source_dir}
+def makeTree(source_dir, target, tracks):
+    shutil.copytree(os.path.join(source_dir, 'util'), os.path.join(target, 'util'), ignore=shutil.ignore_patterns('cache', '*.pyc'))
+    for track in tracks:
+        if not os.path.isdir(os.path.join(source_dir, track)):
+            continue
+        track_dir = benchmark.copyTrack(track, target, source_dir)
+        instruments_dir = os.path.join(ROOT_DIR, track, 'instruments')
+        if not os.path.exists(os.path.join(track_dir, 'instruments')) and os.path.isdir(instruments_dir):
+            os.symlink(os.path.abspath(instruments_dir), os.path.join(track_dir, 'instruments'))
+
+# Override the config constants in a script's text, e.g. {'MEMORY_BUDGET_MB': '0.01'}, keeping their comments
+# Returns the new text and the settings the script doesn't have
+def setConstants(text, settings):
+    missing = []
+    for name, value in sorted(settings.items()):
+        text, count = re.subn(r'^(%s\s*=\s*)([^#\n]*?)(\s*(?:#.*)?)$' % re.escape(name), lambda m: m.group(1) + value + m.group(3), text, count=1, flags=re.MULTILINE)
+        if count <= 0:
+            missing.append(name)
+    return (text, missing)
+
+# Override a script's config constants in place; returns the settings the script doesn't have
+def applySettings(filename, settings):
+    with open(filename, 'rb') as f:
+        text, missing = setConstants(f.read(), settings)
+    with open(filename, 'wb') as f:
+        f.write(text)
+    return missing
+
+# Parse 'NAME=VALUE' arguments
+def parseSettings(values):
+    settings = {}
+    for value in values or []:
+        if '=' not in value:
+            raise ValueError('Settings look like NAME=VALUE: %s' % value)
+        name, value = value.split('=', 1)
+        settings[name.strip()] = value.strip()
+    return settings
+
+# Whether two values are the same, numbers within {tolerance}
+def isClose(a, b, tolerance):
+    if isinstance(a, bool) or isinstance(b, bool) or not isinstance(a, (int, long, float)) or not isinstance(b, (int, long, float)):
+        return a == b
+    return abs(a - b) <= tolerance
+
+# A CSV cell as a number if it is one
+def toValue(cell):
+    try:
+        return float(cell)
+    except ValueError:
+        return cell
+
+# Differences between two track directories' sequences, note by note: fields within {tolerance}, times within {ms_tolerance}
+def compareSequences(base_dir, candidate_dir, tolerance=TOLERANCE, ms_tolerance=MS_TOLERANCE):
+    differences = []
+    base_steps = stream.readTrackSteps(base_dir)
+    candidate_steps = stream.readTrackSteps(candidate_dir)
+    base_ms = 0
+    candidate_ms = 0
+    index = 0
+    while True:
+        base_step = next(base_steps, None)
+        candidate_step = next(candidate_steps, None)
+        if base_step is None or candidate_step is None:
+            if base_step is not None or candidate_step is not None:
+                remaining = 1 + sum([1 for step in (base_steps if base_step is not None else candidate_steps)])
+                differences.append('%s has %s more notes from note %s' % ('base' if base_step is not None else 'candidate', remaining, index))
+            break
+        base_ms += base_step['milliseconds']
+        candidate_ms += candidate_step['milliseconds']
+        if abs(base_ms - candidate_ms) > ms_tolerance:
+            differences.append('note %s: at %sms, was %sms' % (index, candidate_ms, base_ms))
+        for field in SEQUENCE_FIELDS:
+            if field in base_step or field in candidate_step:
+                if not isClose(base_step.get(field), candidate_step.get(field), tolerance):
+                    differences.append('note %s: %s %s, was %s' % (index, field, candidate_step.get(field), base_step.get(field)))
+        index += 1
+    return differences
+
+# Differences between two CSV files, cell by cell
+def compareCsv(base_file, candidate_file, tolerance=TOLERANCE):
+    differences = []
+    with open(base_file, 'rb') as f:
+        base_rows = list(csv.reader(f))
+    with open(candidate_file, 'rb') as f:
+        candidate_rows = list(csv.reader(f))
+    if len(base_rows) != len(candidate_rows):
+        differences.append('%s rows, was %s' % (len(candidate_rows), len(base_rows)))
+    for i, (base_row, candidate_row) in enumerate(zip(base_rows, candidate_rows)):
+        if len(base_row) != len(candidate_row):
+            differences.append('row %s: %s columns, was %s' % (i, len(candidate_row), len(base_row)))
+            continue
+        for j, (a, b) in enumerate(zip(base_row, candidate_row)):
+            if a != b and not isClose(toValue(a), toValue(b), tolerance):
+                differences.append('row %s, column %s: %s, was %s' % (i, j, b, a))
+    return differences
+
+# Differences between two JSON values, by path
+def compareJson(base, candidate, tolerance=TOLERANCE, path='$'):
+    if isinstance(base, dict) and isinstance(candidate, dict):
+        differences = []
+        for key in sorted(set(base) | set(candidate)):
+            if key not in base or key not in candidate:
+                differences.append('%s.%s: %s' % (path, key, 'added' if key in candidate else 'removed'))
+            else:
+                differences += compareJson(base[key], candidate[key], tolerance, '%s.%s' % (path, key))
+        return differences
+    if isinstance(base, list) and isinstance(candidate, list):
+        differences = []
+        if len(base) != len(candidate):
+            differences.append('%s: %s items, was %s' % (path, len(candidate), len(base)))
+        for i, (a, b) in enumerate(zip(base, candidate)):
+            differences += compareJson(a, b, tolerance, '%s[%s]' % (path, i))
+        return differences
+    if not isClose(base, candidate, tolerance):
+        return ['%s: %s, was %s' % (path, candidate, base)]
+    return []
+
+# Compare a stage's outputs in two track directories; returns a list of (output, status, differences)
+#   status: 'identical' (same bytes), 'equivalent' (within tolerance), 'different' or 'missing'
+def compareOutputs(stage, base_dir, candidate_dir, tolerance=TOLERANCE, ms_tolerance=MS_TOLERANCE):
+    results = []
+    sequence_compared = False
+    for output in stage['outputs']:
+        base_file = os.path.join(base_dir, output)
+        candidate_file = os.path.join(candidate_dir, output)
+        is_sequence = os.path.basename(output) in ('ck_sequence.csv', 'ck_sequence.cks')
+        if is_sequence:
+            # either side may have written its sequence as csv or binary
+            if sequence_compared:
+                continue
+            sequence_compared = True
+            base_file = getSequenceFile(base_dir)
+            candidate_file = getSequenceFile(candidate_dir)
+            output = 'data/ck_sequence'
+        if not os.path.exists(base_file) and not os.path.exists(candidate_file):
+            continue
+        if not os.path.exists(base_file) or not os.path.exists(candidate_file):
+            results.append((output, 'missing', ['only in the %s' % ('base' if os.path.exists(base_file) else 'candidate')]))
+            continue
+        if readBytes(base_file) == readBytes(candidate_file):
+            results.append((output, 'identical', []))
+            continue
+        if is_sequence:
+            differences = compareSequences(base_dir, candidate_dir, tolerance, ms_tolerance)
+        elif output.endswith('.json'):
+            with open(base_file) as f:
+                base = json.load(f)
+            with open(candidate_file) as f:
+                candidate = json.load(f)
+            differences = compareJson(base, candidate, tolerance)
+        else:
+            differences = compareCsv(base_file, candidate_file, tolerance)
+        results.append((output, 'different' if differences else 'equivalent', differences))
+    return results
+
+# Sequence file a track's players would read
+def getSequenceFile(track_dir):
+    binary_file = os.path.join(track_dir, 'data', 'ck_sequence.cks')
+    return binary_file if os.path.exists(binary_file) else os.path.join(track_dir, 'data', 'ck_sequence.csv')
+
+def readBytes(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+# Run a stage {repeat} times, returning (return code, fastest seconds)
+def timeStage(stage, track_dir, log, repeat=1):
+    times = []
+    for i in range(repeat):
+        code, seconds, peak_mb = benchmark.runStage(stage, track_dir, log)
+        if code != 0:
+            return (code, None)
+        times.append(seconds)
+    return (0, min(times))
+
+# Stages of the build (or of the tracks/stages named) that have no fixtures to check them on
+def getUnchecked(names=None):
+    checked = [b['stage'] for b in benchmark.BENCHMARKS]
+    stages = [build.getName(s) for s in build.STAGES]
+    return [name for name in stages if name not in checked and (not names or name in names or name.split('/')[0] in names)]
+
+# Run each stage on the same fixtures in a base and a candidate tree and compare them; returns a list of results
+def check(names=None, base=BASE, base_settings={}, settings={}, tolerance=TOLERANCE, ms_tolerance=MS_TOLERANCE, scale=SCALE, repeat=1, log=sys.stdout, root_dir=ROOT_DIR, keep=False):
+    benchmarks = [b for b in benchmark.BENCHMARKS if not names or b['stage'] in names or b['stage'].split('/')[0] in names]
+    tracks = sorted(set([b['stage'].split('/')[0] for b in benchmarks]))
+    scratch_dir = tempfile.mkdtemp(prefix='golden_')
+    results = []
+    try:
+        base_source = root_dir
+        if base != '.':
+            base_source = os.path.join(scratch_dir, 'export')
+            exportRevision(base, base_source, tracks, root_dir)
+        trees = {'base': os.path.join(scratch_dir, 'base'), 'candidate': os.path.join(scratch_dir, 'candidate')}
+        makeTree(base_source, trees['base'], tracks)
+        makeTree(root_dir, trees['candidate'], tracks)
+        for b in benchmarks:
+            stage = [s for s in build.STAGES if build.getName(s) == b['stage']][0]
+            result = {'stage': b['stage'], 'outputs': [], 'seconds': {}}
+            for side in ['base', 'candidate']:
+                track_dir = os.path.join(trees[side], stage['track'])
+                script = os.path.join(track_dir, stage['script'])
+                if not os.path.exists(script):
+                    result['seconds'][side] = None
+                    continue
+                missing = applySettings(script, base_settings if side == 'base' else settings)
+                if len(missing) > 0:
+                    log.write('%s (%s) has no setting %s\n' % (b['stage'], side, ', '.join(missing)))
+                for filename, generate in sorted(b['inputs'].items()):
+                    generate(os.path.join(track_dir, filename), b['rows'] * scale, random.Random(benchmark.SEED))
+                with open(os.path.join(scratch_dir, side + '.log'), 'ab') as stage_log:
+                    stage_log.write('=== %s\n' % b['stage'])
+                    stage_log.flush()
+                    code, seconds = timeStage(stage, track_dir, stage_log, repeat)
+                result['seconds'][side] = seconds
+                if code != 0:
+                    result['failed'] = side
+                    break
+            if 'failed' in result or None in result['seconds'].values():
+                result['status'] = 'failed' if 'failed' in result else 'missing'
+            else:
+                result['outputs'] = compareOutputs(stage, os.path.join(trees['base'], stage['track']), os.path.join(trees['candidate'], stage['track']), tolerance, ms_tolerance)
+                statuses = [status for output, status, differences in result['outputs']]
+                result['status'] = 'different' if 'different' in statuses or 'missing' in statuses else ('equivalent' if 'equivalent' in statuses else 'identical')
+            writeResult(result, log)
+            results.append(result)
+    finally:
+        if keep:
+            log.write('Kept scratch directory: %s\n' % scratch_dir)
+        else:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    return results
+
+# Write a stage's result: its status, times and any differences
+def writeResult(result, log):
+    base_seconds = result['seconds'].get('base')
+    candidate_seconds = result['seconds'].get('candidate')
+    timing = ''
+    if base_seconds and candidate_seconds:
+        timing = '%.2fs -> %.2fs (%.2fx)' % (base_seconds, candidate_seconds, base_seconds / candidate_seconds)
+    status = result['status'] if result['status'] in ('identical', 'equivalent') else result['status'].upper()
+    if result['status'] == 'failed':
+        status += ' in the ' + result['failed']
+    log.write('%-30s %-12s %s\n' % (result['stage'], status, timing))
+    for output, output_status, differences in result['outputs']:
+        if output_status in ('identical', 'equivalent'):
+            continue
+        log.write('  %s: %s\n' % (output, output_status))
+        for difference in differences[:MAX_DIFFERENCES]:
+            log.write('    %s\n' % difference)
+        if len(differences) > MAX_DIFFERENCES:
+            log.write('    ... and %s more\n' % (len(differences) - MAX_DIFFERENCES))
+    log.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('STAGES', nargs='*', help="Stages or tracks to check, e.g. 03_smog 06_refugees/preprocess_data (default: all)")
+    parser.add_argument('-base', dest="BASE", default=BASE, help="Git revision to compare against, or . for the working tree")
+    parser.add_argument('-set', dest="SETTINGS", nargs='+', default=[], help="Config to override in the candidate, e.g. MEMORY_BUDGET_MB=0.01")
+    parser.add_argument('-baseset', dest="BASE_SETTINGS", nargs='+', default=[], help="Config to override in the base")
+    parser.add_argument('-tol', dest="TOLERANCE", default=TOLERANCE, type=float, help="How much numbers may differ")
+    parser.add_argument('-mstol', dest="MS_TOLERANCE", default=MS_TOLERANCE, type=int, help="How many ms note times may differ")
+    parser.add_argument('-scale', dest="SCALE", default=SCALE, type=int, help="Size of the fixtures, in multiples of each stage's base size")
+    parser.add_argument('-repeat', dest="REPEAT", default=1, type=int, help="Times to run each stage; the fastest is compared")
+    parser.add_argument('-keep', dest="KEEP", action="store_true", help="Keep the scratch directory (both trees and their outputs)")
+    args = parser.parse_args()
+
+    results = check(args.STAGES, args.BASE, parseSettings(args.BASE_SETTINGS), parseSettings(args.SETTINGS), args.TOLERANCE, args.MS_TOLERANCE, args.SCALE, args.REPEAT, keep=args.KEEP)
+    counts = dict([(status, len([r for r in results if r['status'] == status])) for status in ('identical', 'equivalent', 'different', 'failed', 'missing')])
+    unchecked = getUnchecked(args.STAGES)
+    if len(unchecked) > 0:
+        print('No fixtures for: %s' % ', '.join(unchecked))
+    print('%s identical, %s equivalent, %s different, %s failed, %s missing' % (counts['identical'], counts['equivalent'], counts['different'], counts['failed'], counts['missing']))
+    if counts['different'] + counts['failed'] > 0:
+        sys.exit(1)
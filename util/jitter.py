@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+##
+# Halton sequence jitter for the track scripts
+# Produces halton values for whole ranges of indices at once from precomputed digit tables.
+# Values are identical to the scalar halton(index, base) the tracks have always used.
+#
+# Indices come from streams: stream 0 is the single global stream the tracks have always used,
+# i.e. notes take indices in the order they are generated, with no limit on how many. Every other
+# stream owns its own block of STREAM_SIZE indices, so giving each instrument (or segment) its own
+# stream makes its jitter independent of generation order and reproducible when generated in
+# parallel. A build takes all its indices in one mode, so stream 0 running past the first block
+# never shares indices with another stream.
+##
+
+import math
+import numpy as np
+
+TABLE_SIZE = 2 ** 16 # max entries in a digit table
+STREAM_SIZE = 2 ** 24 # indices reserved for each stream
+STREAM_MODES = ['global', 'instrument']
+
+tables = {}
+
+# For creating pseudo-random numbers, digit by digit for an array of indices
+def haltonDigits(i, base, result, f):
+    while np.any(i > 0):
+        result += f * (i % base)
+        i = np.floor(i / base)
+        f = f / base
+    return result
+
+# Retrieve the digit table of a base: halton values of every number with up to {digits} digits
+def getTable(base):
+    if base not in tables:
+        digits = max(1, int(math.log(TABLE_SIZE, base)))
+        size = base ** digits
+        f = 1.0 / base
+        for d in range(digits):
+            f = f / base
+        values = haltonDigits(np.arange(size, dtype=np.float64), base, np.zeros(size), 1.0 / base)
+        tables[base] = (size, f, values)
+    return tables[base]
+
+# Halton values for an array of indices
+def haltonIndices(indices, base):
+    size, f, values = getTable(base)
+    i = np.asarray(indices, dtype=np.float64)
+    result = values[(i % size).astype(np.int64)]
+    return haltonDigits(np.floor(i / size), base, result, f)
+
+# Halton values for {count} indices starting at {start}
+def halton(start, count, base):
+    return haltonIndices(np.arange(start, start + count, dtype=np.float64), base)
+
+# Retrieve the stream an instrument's notes take their indices from
+def getStream(mode, instrument_index, segment_index=0, segments=1):
+    if mode == 'global':
+        return 0
+    return 1 + instrument_index * segments + segment_index
+
+# Take the next {count} indices of a stream; {streams} keeps track of each stream's position
+# Only the per-instrument streams are limited to their block; the global stream 0 never runs out
+def takeIndices(streams, stream, count):
+    start = streams.get(stream, 0)
+    if stream > 0 and start + count > STREAM_SIZE:
+        raise ValueError('Stream %s ran out of indices' % stream)
+    streams[stream] = start + count
+    return np.arange(start, start + count, dtype=np.int64) + stream * STREAM_SIZE
+
+# Retrieve the +/- ms each note should be off by
+def getVariance(indices, variance_ms, base=3):
+    h = haltonIndices(indices, base)
+    return np.trunc(h * variance_ms * 2 - variance_ms).astype(np.int64)
+
+# Offset onsets by their variance, never before the start of the song
+def addVariance(elapsed_ms, variance):
+    return np.maximum(np.asarray(elapsed_ms) + variance, 0)
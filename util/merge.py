@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+##
+# K-way merge of sorted runs of elapsed ms
+# The track scripts generate notes instrument by instrument, so each batch of notes (a run) is already
+# in order apart from a few ms of jitter. Rather than sorting the whole song at once, each run is put in
+# order on its own, then the runs are merged a window of time at a time: every run is cut at the end of
+# the window and only the notes that fall inside the window are ordered and emitted.
+# Ties go to the earlier run, then the earlier note, so the result is identical to a stable sort of the
+# runs concatenated in order.
+##
+
+import numpy as np
+
+WINDOW_MS = 10000 # ms of notes to merge at a time
+
+# Order a run that is nearly in order, e.g. onsets off by +/- a few ms of jitter; ties keep their order
+def orderRun(values):
+    return np.argsort(values, kind='mergesort')
+
+# Indices of the ranges [starts, stops) laid end to end
+def getRanges(starts, stops):
+    lengths = stops - starts
+    total = int(np.sum(lengths))
+    if total <= 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(total, dtype=np.int64) - np.repeat(offsets - starts, lengths)
+
+# Merge sorted runs; {values} holds the runs end to end, run i being values[offsets[i]:offsets[i+1]]
+# Yields the indices of each window's values in order
+def mergeRuns(values, offsets, window_ms=WINDOW_MS):
+    values = np.asarray(values)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if len(values) <= 0:
+        return
+    if window_ms <= 0:
+        raise ValueError('Merge window must be positive: %s' % window_ms)
+    starts = offsets[:-1].copy()
+    stops = offsets[1:]
+
+    # key every value by its run, so where runs cut at a time can be found with a single search
+    min_value = int(np.min(values))
+    span = int(np.max(values)) - min_value + 2
+    keys = np.repeat(np.arange(len(starts), dtype=np.int64), stops - starts) * span + (values.astype(np.int64) - min_value)
+
+    # runs join the merge once the window reaches their first value and leave it once they run out
+    pending = np.flatnonzero(starts < stops)
+    pending = pending[orderRun(values[starts[pending]])]
+    firsts = values[starts[pending]].astype(np.int64) - min_value
+    joined = 0
+    active = np.zeros(0, dtype=np.int64)
+
+    while len(active) > 0 or joined < len(pending):
+        heads = values[starts[active]].astype(np.int64) - min_value
+        if joined < len(pending):
+            heads = np.append(heads, firsts[joined])
+        until = min(int(np.min(heads)) + window_ms, span - 1)
+        joining = int(np.searchsorted(firsts, until, side='left'))
+        active = np.sort(np.concatenate((active, pending[joined:joining])))
+        joined = joining
+        cuts = np.searchsorted(keys, active * span + until, side='left')
+        indices = getRanges(starts[active], cuts)
+        yield indices[orderRun(values[indices])]
+        starts[active] = cuts
+        active = active[cuts < stops[active]]
+
+# Merge sorted runs kept apart, e.g. memory-mapped runs spilled to disk, reading only a window of each at a time
+# Yields each window as a list of (run, start, stop) slices; the slices laid end to end, ordered stably,
+# are the window's values in order
+def mergeSortedRuns(runs, window_ms=WINDOW_MS):
+    if window_ms <= 0:
+        raise ValueError('Merge window must be positive: %s' % window_ms)
+    starts = [0 for run in runs]
+    while True:
+        heads = [int(run[start]) for run, start in zip(runs, starts) if start < len(run)]
+        if len(heads) <= 0:
+            return
+        until = min(heads) + window_ms
+        cuts = []
+        for r, run in enumerate(runs):
+            start = starts[r]
+            if start >= len(run):
+                continue
+            stop = start + int(np.searchsorted(run[start:], until, side='left'))
+            if stop > start:
+                cuts.append((r, start, stop))
+            starts[r] = stop
+        yield cuts
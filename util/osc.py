@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+##
+# Minimal OSC (Open Sound Control) over UDP, enough to stream notes to ChucK's OscIn
+# Messages carry int32 (i), float32 (f) and string (s) arguments; bundles and time tags aren't used.
+# Includes a receiver stub that stands in for ChucK when testing a stream.
+# Usage:
+#   sender = osc.OscSender('localhost', 6449)
+#   sender.send('/note', 3, 0, 0.5, 1.0, 1250)
+# or, to print what a stream sends: python osc.py -port 6449
+##
+
+import argparse
+import socket
+import struct
+import threading
+import time
+
+HOST = 'localhost'
+PORT = 6449 # the port util/stream.ck listens on
+
+# Pad bytes with nulls to a multiple of 4; strings always get at least one null
+def pad(data, terminate=True):
+    if terminate:
+        data += b'\0'
+    return data + b'\0' * (-len(data) % 4)
+
+# Encode an OSC message
+def encodeMessage(address, *args):
+    tags = ','
+    data = b''
+    for arg in args:
+        if isinstance(arg, bool) or not isinstance(arg, (int, long, float, str, unicode)):
+            raise ValueError('Unsupported OSC argument: %r' % (arg,))
+        if isinstance(arg, (int, long)):
+            tags += 'i'
+            data += struct.pack('>i', arg)
+        elif isinstance(arg, float):
+            tags += 'f'
+            data += struct.pack('>f', arg)
+        else:
+            tags += 's'
+            data += pad(arg.encode('utf-8'))
+    return pad(address.encode('utf-8')) + pad(tags.encode('utf-8')) + data
+
+# Read a null-terminated, padded string at {position}; returns (string, position after it)
+def readString(data, position):
+    end = data.index(b'\0', position)
+    return (data[position:end].decode('utf-8'), end + 1 + (-(end + 1) % 4))
+
+# Decode an OSC message; returns (address, list of arguments)
+def decodeMessage(data):
+    address, position = readString(data, 0)
+    tags, position = readString(data, position)
+    if not tags.startswith(','):
+        raise ValueError('OSC message has no type tags: %s' % address)
+    args = []
+    for tag in tags[1:]:
+        if tag == 'i':
+            args.append(struct.unpack('>i', data[position:position+4])[0])
+            position += 4
+        elif tag == 'f':
+            args.append(struct.unpack('>f', data[position:position+4])[0])
+            position += 4
+        elif tag == 's':
+            value, position = readString(data, position)
+            args.append(value)
+        else:
+            raise ValueError('Unsupported OSC type tag: %s' % tag)
+    return (address, args)
+
+class OscSender(object):
+
+    def __init__(self, host=HOST, port=PORT):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, address, *args):
+        self.socket.sendto(encodeMessage(address, *args), self.address)
+
+    def close(self):
+        self.socket.close()
+
+# Receiver stub: collects the messages sent to a port on a background thread
+# Each message is kept as (time received, address, arguments); {callback} is also called with each one
+class OscReceiver(object):
+
+    def __init__(self, host=HOST, port=PORT, callback=None):
+        self.messages = []
+        self.callback = callback
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.1)
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                continue
+            message = (time.time(),) + decodeMessage(data)
+            self.messages.append(message)
+            if self.callback:
+                self.callback(message)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.socket.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-port', dest="PORT", default=PORT, type=int, help="Port to listen on")
+    args = parser.parse_args()
+
+    def printMessage(message):
+        print('%.3f %s %s' % (message[0], message[1], ' '.join([str(arg) for arg in message[2]])))
+
+    receiver = OscReceiver(HOST, args.PORT, printMessage)
+    print('Listening on port %s (Ctrl+C to stop)' % args.PORT)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        receiver.close()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+##
+# Offline renderer: mixes a track's ck_instruments + ck_sequence straight to a WAV file without ChucK
+# Plays notes the way the track's .ck player does: each instrument has {instrument_buffers} SndBufs used in turn (or
+# as many as ck_instruments gives it, see voices.py), so a note is cut off when its buffer is retriggered that many
+# plays later, samples play from channel 0
+# at their own sample rate times the note's rate (linearly interpolated), and padding and start are read from the player.
+# Reverb (04_dating) isn't rendered; those tracks render dry.
+# Long tracks can be mixed in parallel, a window of the timeline per process, with samples shared through the sample bank.
+# Usage: python render.py ../03_smog/smog.ck ../03_smog/data/render.wav [-p 8]
+# or, from a track script with the sequence still in memory:
+#   frames = render.renderSequence('smog.ck', instruments, sequence)
+##
+
+import argparse
+import multiprocessing
+import os
+import re
+import time
+
+import numpy as np
+
+import sequence_file
+import wav_file
+from sample_bank import SampleBank
+from sequence_buffer import DEFAULTS
+
+SAMPLE_RATE = 44100 # ChucK's default sample rate
+WINDOW_MS = 20000 # ms of the timeline each process mixes at a time when rendering in parallel
+FIELDS = ['instrument_index', 'position', 'gain', 'rate', 'milliseconds']
+REVERB_FIELDS = ['instrument_index', 'position', 'gain', 'rate', 'reverb', 'milliseconds']
+
+# Read the settings at the top of a .ck player, e.g. "2 => int instrument_buffers;"
+def readPlayer(filename):
+    with open(filename, 'rb') as f:
+        text = f.read().decode('utf-8')
+    settings = dict([(name, int(value)) for value, name in re.findall(r'^\s*(-?\d+)\s*=>\s*int\s+(\w+)\s*;', text, re.MULTILINE)])
+    padding = settings.get('padding', 0)
+    return {
+        'padding_start': settings.get('padding_start', padding),
+        'padding_end': settings.get('padding_end', padding),
+        'instrument_buffers': settings.get('instrument_buffers', 1),
+        'start': settings.get('start', 0),
+        'reverb': 'rvb_max' in text
+    }
+
+# Read ck_instruments.csv; returns a dict of instrument index => sample file (relative to the track directory)
+def readInstruments(filename, reverb=False):
+    with open(filename, 'rb') as f:
+        lines = [line.strip() for line in f.read().decode('utf-8').splitlines()]
+    # with reverb, each index is followed by the instrument's max reverb and then its file
+    lines_per_instrument = 3 if reverb else 2
+    return dict([(int(lines[i].split(',')[0]), lines[i+lines_per_instrument-1]) for i in range(0, len(lines) - lines_per_instrument + 1, lines_per_instrument)])
+
+# Read the buffers ck_instruments.csv gives each instrument (on its index line, e.g. "12,3"); returns a dict of
+# instrument index => buffers, empty if it gives none
+def readInstrumentBuffers(filename, reverb=False):
+    with open(filename, 'rb') as f:
+        lines = [line.strip() for line in f.read().decode('utf-8').splitlines()]
+    lines_per_instrument = 3 if reverb else 2
+    fields = [lines[i].split(',') for i in range(0, len(lines) - lines_per_instrument + 1, lines_per_instrument)]
+    return dict([(int(values[0]), int(values[1])) for values in fields if len(values) > 1])
+
+# Read ck_sequence.csv, one value per line; returns a dict of columns
+def readSequence(filename, reverb=False):
+    fields = REVERB_FIELDS if reverb else FIELDS
+    values = np.loadtxt(filename, dtype=np.float64, ndmin=1).reshape(-1, len(fields))
+    columns = dict([(field, values[:, i]) for i, field in enumerate(fields)])
+    for field in ['instrument_index', 'position', 'milliseconds']:
+        columns[field] = columns[field].astype(np.int64)
+    return columns
+
+# Columns of every note of a SequenceBuffer in order
+def getNotes(sequence):
+    blocks = list(sequence.merged())
+    columns = {}
+    for field in FIELDS:
+        if len(blocks) > 0 and field in blocks[0]:
+            columns[field] = np.concatenate([block[field] for block in blocks])
+        else:
+            columns[field] = np.full(len(sequence), DEFAULTS[field])
+    return columns
+
+# Load the samples of instruments as mono float32 (channel 0, like SndBuf); returns a dict of index => (sample rate, frames)
+# With a SampleBank, samples come memory-mapped from its cache at the bank's sample rate instead of being decoded
+def loadSamples(instruments, base_dir='', indices=None, bank=None):
+    if indices is None:
+        indices = instruments.keys()
+    loaded = {}
+    samples = {}
+    for index in indices:
+        filename = os.path.join(base_dir, instruments[index])
+        if filename in loaded:
+            pass
+        elif bank is not None:
+            loaded[filename] = (bank.sample_rate, bank.load(filename)[:, 0])
+        else:
+            sample_rate, frames = wav_file.readWav(filename)
+            loaded[filename] = (sample_rate, np.ascontiguousarray(frames[:, 0]))
+        samples[index] = loaded[filename]
+    return samples
+
+# Frame of each note's onset, dropping the notes before {start} ms the way the players skip them
+# Returns (onset frames, indices of the notes that play)
+def getOnsets(milliseconds, sample_rate=SAMPLE_RATE, padding_start=0, start=0):
+    milliseconds = np.asarray(milliseconds, dtype=np.int64)
+    played = np.flatnonzero(padding_start + np.cumsum(milliseconds) >= start)
+    onsets_ms = padding_start + np.cumsum(milliseconds[played])
+    return (np.round(onsets_ms * (sample_rate / 1000.0)).astype(np.int64), played)
+
+# Frame each note is cut off at because its buffer is retriggered, or -1 if it isn't
+#   instrument_buffers: buffers of every instrument, or a dict of instrument index => buffers
+def getCutoffs(instrument_indices, onsets, instrument_buffers):
+    instrument_indices = np.asarray(instrument_indices)
+    cutoffs = np.full(len(onsets), -1, dtype=np.int64)
+    if isinstance(instrument_buffers, dict):
+        return getInstrumentCutoffs(instrument_indices, onsets, instrument_buffers, cutoffs)
+    if instrument_buffers <= 0 or len(onsets) <= instrument_buffers:
+        return cutoffs
+    # every instrument's plays in order, so a play's buffer is next used {instrument_buffers} plays later
+    order = np.argsort(instrument_indices, kind='mergesort')
+    grouped = instrument_indices[order]
+    retriggered = grouped[:-instrument_buffers] == grouped[instrument_buffers:]
+    cutoffs[order[:-instrument_buffers][retriggered]] = onsets[order[instrument_buffers:][retriggered]]
+    return cutoffs
+
+# getCutoffs with buffers of their own for each instrument
+def getInstrumentCutoffs(instrument_indices, onsets, instrument_buffers, cutoffs):
+    order = np.argsort(instrument_indices, kind='mergesort')
+    grouped = instrument_indices[order]
+    buffers = np.array([instrument_buffers[i] for i in grouped.tolist()], dtype=np.int64)
+    following = np.arange(len(order)) + buffers
+    retriggered = (buffers > 0) & (following < len(order))
+    retriggered[retriggered] = grouped[following[retriggered]] == grouped[retriggered]
+    cutoffs[order[retriggered]] = onsets[order[following[retriggered]]]
+    return cutoffs
+
+# Number of frames a note plays from {position} at {step} frames of sample per output frame
+def getLengths(sample_lengths, positions, steps):
+    lengths = np.zeros(len(steps), dtype=np.int64)
+    inside = (positions >= 0) & (positions < sample_lengths)
+    forward = inside & (steps > 0)
+    backward = inside & (steps < 0)
+    lengths[forward] = np.ceil((sample_lengths[forward] - positions[forward]) / steps[forward]).astype(np.int64)
+    lengths[backward] = np.floor(positions[backward] / -steps[backward]).astype(np.int64) + 1
+    return lengths
+
+# Every note that plays, with where and how much of its sample it plays
+#   samples: dict of instrument index => (sample rate, mono frames), see loadSamples
+#   notes: dict of columns instrument_index, position, gain, rate, milliseconds, see readSequence and getNotes
+# Returns a dict of columns instrument_index, onset, length (in output frames), position, step and gain
+def getPlays(samples, notes, sample_rate=SAMPLE_RATE, instrument_buffers=2, padding_start=0, start=0):
+    onsets, played = getOnsets(notes['milliseconds'], sample_rate, padding_start, start)
+    instrument_indices = np.asarray(notes['instrument_index'], dtype=np.int64)[played]
+    positions = np.asarray(notes['position'], dtype=np.float64)[played]
+    rates = np.asarray(notes['rate'], dtype=np.float64)[played]
+
+    sample_rates = np.array([samples[i][0] for i in instrument_indices.tolist()], dtype=np.float64)
+    sample_lengths = np.array([len(samples[i][1]) for i in instrument_indices.tolist()], dtype=np.int64)
+    steps = rates * sample_rates / sample_rate
+    lengths = getLengths(sample_lengths, positions, steps)
+    cutoffs = getCutoffs(instrument_indices, onsets, instrument_buffers)
+    cut = cutoffs >= 0
+    lengths[cut] = np.minimum(lengths[cut], cutoffs[cut] - onsets[cut])
+    return {
+        'instrument_index': instrument_indices,
+        'onset': onsets,
+        'length': lengths,
+        'position': positions,
+        'step': steps,
+        'gain': np.asarray(notes['gain'], dtype=np.float32)[played]
+    }
+
+# Add plays (see getPlays) into a float32 buffer of frames that starts at output frame {offset}
+def addPlays(frames, samples, plays, offset=0):
+    for i, onset, length, position, step, gain in zip(plays['instrument_index'].tolist(), plays['onset'].tolist(), plays['length'].tolist(), plays['position'].tolist(), plays['step'].tolist(), plays['gain']):
+        if length <= 0 or gain == 0:
+            continue
+        sample = samples[i][1]
+        onset -= offset
+        if step == 1.0 and position == int(position):
+            position = int(position)
+            frames[onset:onset+length] += gain * sample[position:position+length]
+            continue
+        # linear interpolation between neighbouring frames
+        points = position + np.arange(length) * step
+        indices = points.astype(np.int64)
+        fractions = (points - indices).astype(np.float32)
+        following = np.minimum(indices + 1, len(sample) - 1)
+        frames[onset:onset+length] += gain * (sample[indices] * (1 - fractions) + sample[following] * fractions)
+
+# Frames of output for plays, plus padding
+def getFrameCount(plays, sample_rate=SAMPLE_RATE, padding_start=0, padding_end=0):
+    if len(plays['onset']) > 0:
+        end = int(np.max(plays['onset'] + plays['length']))
+    else:
+        end = padding_start * sample_rate // 1000
+    return end + int(round(padding_end * sample_rate / 1000.0))
+
+# Mix notes into a float32 buffer of mono frames
+def mix(samples, notes, sample_rate=SAMPLE_RATE, instrument_buffers=2, padding_start=0, padding_end=0, start=0):
+    plays = getPlays(samples, notes, sample_rate, instrument_buffers, padding_start, start)
+    frames = np.zeros(getFrameCount(plays, sample_rate, padding_start, padding_end), dtype=np.float32)
+    addPlays(frames, samples, plays)
+    return frames
+
+# Mix a window of plays in a worker process; samples are memory-mapped from the sample bank rather than sent to it
+# Returns (first frame, frames), the frames running on past the window for as long as its last play does
+worker_bank = None
+def mixWindow(task):
+    global worker_bank
+    files, bank_settings, plays = task
+    if worker_bank is None or worker_bank.getSettings() != bank_settings:
+        worker_bank = SampleBank(*bank_settings)
+    samples = loadSamples(files, '', np.unique(plays['instrument_index']).tolist(), worker_bank)
+    offset = int(np.min(plays['onset']))
+    frames = np.zeros(int(np.max(plays['onset'] + plays['length'])) - offset, dtype=np.float32)
+    addPlays(frames, samples, plays, offset)
+    return (offset, frames)
+
+# Mix notes in a pool of {processes}, one window of {window_ms} of the timeline per task: each task mixes the plays that
+# start in its window, including their tails past it, and the windows are overlap-added in the order they finish
+#   files: dict of instrument index => sample file; bank: SampleBank the workers load samples from
+def mixWindows(files, bank, notes, sample_rate=SAMPLE_RATE, instrument_buffers=2, padding_start=0, padding_end=0, start=0, window_ms=WINDOW_MS, processes=None):
+    files = dict([(index, os.path.abspath(filename)) for index, filename in files.items()])
+    samples = loadSamples(files, '', np.unique(notes['instrument_index']).tolist(), bank)
+    plays = getPlays(samples, notes, sample_rate, instrument_buffers, padding_start, start)
+    frames = np.zeros(getFrameCount(plays, sample_rate, padding_start, padding_end), dtype=np.float32)
+
+    windows = plays['onset'] // max(1, int(window_ms * sample_rate // 1000))
+    bounds = np.flatnonzero(np.diff(windows)) + 1
+    starts = [0] + bounds.tolist()
+    stops = bounds.tolist() + [len(windows)]
+    order = np.argsort(windows, kind='mergesort')
+    tasks = []
+    for first, last in zip(starts, stops):
+        if last <= first:
+            continue
+        indices = order[first:last]
+        tasks.append((files, bank.getSettings(), dict([(name, column[indices]) for name, column in plays.items()])))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for offset, window in pool.imap_unordered(mixWindow, tasks):
+            frames[offset:offset+len(window)] += window
+    finally:
+        pool.close()
+        pool.join()
+    return frames
+
+# Mix notes with a track's player settings, in a pool of {processes} if there's more than one
+def renderNotes(base_dir, files, notes, player, sample_rate=SAMPLE_RATE, bank=None, processes=1, window_ms=WINDOW_MS):
+    files = dict([(index, os.path.join(base_dir, filename)) for index, filename in files.items()])
+    if processes > 1:
+        if bank is None:
+            bank = SampleBank(sample_rate)
+        return mixWindows(files, bank, notes, sample_rate, player['instrument_buffers'], player['padding_start'], player['padding_end'], player['start'], window_ms, processes)
+    samples = loadSamples(files, '', np.unique(notes['instrument_index']).tolist(), bank)
+    return mix(samples, notes, sample_rate, player['instrument_buffers'], player['padding_start'], player['padding_end'], player['start'])
+
+# Render a track from its .ck player and data files (the binary sequence if there is one, like the players)
+def renderTrack(player_file, sample_rate=SAMPLE_RATE, bank=None, processes=1, window_ms=WINDOW_MS):
+    base_dir = os.path.dirname(os.path.abspath(player_file))
+    player = readPlayer(player_file)
+    instruments = readInstruments(os.path.join(base_dir, 'data', 'ck_instruments.csv'), player['reverb'])
+    buffers = readInstrumentBuffers(os.path.join(base_dir, 'data', 'ck_instruments.csv'), player['reverb'])
+    if len(buffers) > 0:
+        player['instrument_buffers'] = buffers
+    binary_file = os.path.join(base_dir, 'data', 'ck_sequence.cks')
+    if os.path.exists(binary_file):
+        notes = sequence_file.readBinary(binary_file)
+    else:
+        notes = readSequence(os.path.join(base_dir, 'data', 'ck_sequence.csv'), player['reverb'])
+    return renderNotes(base_dir, instruments, notes, player, sample_rate, bank, processes, window_ms)
+
+# Render a SequenceBuffer that's still in memory with the instruments list of a track script
+def renderSequence(player_file, instruments, sequence, sample_rate=SAMPLE_RATE, bank=None, processes=1, window_ms=WINDOW_MS):
+    base_dir = os.path.dirname(os.path.abspath(player_file))
+    player = readPlayer(player_file)
+    files = dict([(index, instrument['file']) for index, instrument in enumerate(instruments)])
+    return renderNotes(base_dir, files, getNotes(sequence), player, sample_rate, bank, processes, window_ms)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('PLAYER_FILE', help="Path to the track's .ck player, e.g. ../03_smog/smog.ck")
+    parser.add_argument('OUTPUT_FILE', help="Path to output wav file")
+    parser.add_argument('-sr', dest="SAMPLE_RATE", default=SAMPLE_RATE, type=int, help="Output sample rate")
+    parser.add_argument('-nocache', dest="NO_CACHE", action="store_true", help="Decode samples instead of using the sample bank cache")
+    parser.add_argument('-p', dest="PROCESSES", default=1, type=int, help="Processes to render with; 0 for one per CPU")
+    parser.add_argument('-win', dest="WINDOW_MS", default=WINDOW_MS, type=int, help="Ms of the timeline per task when rendering with more than one process")
+    args = parser.parse_args()
+
+    started = time.time()
+    bank = None if args.NO_CACHE else SampleBank(args.SAMPLE_RATE)
+    processes = args.PROCESSES if args.PROCESSES > 0 else multiprocessing.cpu_count()
+    frames = renderTrack(args.PLAYER_FILE, args.SAMPLE_RATE, bank, processes, args.WINDOW_MS)
+    peak = float(np.max(np.abs(frames))) if len(frames) > 0 else 0.0
+    wav_file.writeWav(args.OUTPUT_FILE, args.SAMPLE_RATE, frames)
+    seconds = 1.0 * len(frames) / args.SAMPLE_RATE
+    print('Rendered %ss of audio in %ss (peak %s): %s' % (round(seconds, 1), round(time.time() - started, 1), round(peak, 3), args.OUTPUT_FILE))
+    if peak > 1.0:
+        print('Warning: the mix clips; lower the track\'s GAIN')
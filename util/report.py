@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+##
+# Report writing for the track scripts (report_sequence.csv, report_summary.csv...)
+# Times are formatted a column at a time, the same as time.strftime('%M:%S', time.gmtime(int(ms/1000))) + '.' + ms
+# would one row at a time, rows are written in bulk, and reports are written on threads of their own so they're
+# written while the script writes its sequence.
+# Usage (from a track directory):
+#   reports = report.ReportWriter()
+#   reports.writeSequence(REPORT_SEQUENCE_OUTPUT_FILE, ['Time', 'Instrument', 'Gain'], sequence.merged(), instruments, ['gain'])
+#   reports.write(REPORT_SUMMARY_OUTPUT_FILE, ['Time', 'Value'], zip(report.formatTimes(elapsed_ms), values))
+#   ... write the sequence ...
+#   reports.close() # waits for every report, then prints where each was written
+##
+
+import csv
+import os
+import Queue
+import sys
+import threading
+
+import numpy as np
+
+import tracing
+from sequence_buffer import toValues
+
+THREADS = 4 # reports written at a time
+QUEUE_SIZE = 16 # blocks of notes a sequence report can fall behind by before the sequence waits for it
+
+# Every 'MM:SS' in an hour (time.strftime's %M wraps at an hour) and every '.ms' in a second
+CLOCK = np.array(['%02d:%02d' % (seconds // 60, seconds % 60) for seconds in range(3600)], dtype=object)
+MILLISECONDS = np.array(['.%d' % ms for ms in range(1000)], dtype=object)
+
+# Format a column of elapsed ms as 'MM:SS.ms' (or 'MM:SS' without {milliseconds}); returns a list of text
+def formatTimes(elapsed_ms, milliseconds=True):
+    elapsed_ms = np.asarray(elapsed_ms)
+    if elapsed_ms.dtype.kind == 'f':
+        seconds = np.trunc(elapsed_ms / 1000.0).astype(np.int64)
+        ms = np.trunc(np.mod(elapsed_ms, 1000)).astype(np.int64)
+    else:
+        elapsed_ms = elapsed_ms.astype(np.int64)
+        seconds = elapsed_ms // 1000
+        ms = elapsed_ms % 1000
+    times = CLOCK[seconds % 3600]
+    if milliseconds:
+        times = times + MILLISECONDS[ms]
+    return times.tolist()
+
+# Elapsed ms of {count} rows {step_ms} apart, added up a row at a time like elapsed += step_ms
+def getElapsed(count, step_ms):
+    if count <= 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.cumsum(np.concatenate([np.zeros(1, dtype=np.int64), np.full(count - 1, step_ms)]))
+
+# Convert a column of notes to python values like sequence_buffer.toValues, converting each distinct value once
+def toColumnValues(values):
+    if values.dtype.kind != 'f' or len(values) <= 0:
+        return toValues(values)
+    # distinct by bits, so e.g. -0.0 and 0.0 keep their own text
+    bits = values.view('u%s' % values.dtype.itemsize)
+    unique, first, inverse = np.unique(bits, return_index=True, return_inverse=True)
+    return np.array(toValues(values[first]), dtype=object)[inverse].tolist()
+
+# Write {header} and {rows} to a CSV file, optionally without the last newline
+@tracing.traced('write report')
+def writeRows(filename, header, rows, truncate=False):
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        w.writerows(rows)
+        if truncate:
+            f.seek(-2, os.SEEK_END) # remove newline
+            f.truncate()
+
+# Write a report of every note in {blocks} (see SequenceBuffer.merged): its time, its instrument's file and
+# the values of its {columns}, without the last newline
+@tracing.traced('write sequence report')
+def writeSequenceRows(filename, header, blocks, instruments, columns):
+    files = np.array([instrument['file'] for instrument in instruments], dtype=object)
+    try:
+        with open(filename, 'wb') as f:
+            w = csv.writer(f)
+            w.writerow(header)
+            for block in blocks:
+                values = [formatTimes(block['elapsed_ms']), files[block['instrument_index']].tolist()]
+                values += [toColumnValues(block[name]) for name in columns]
+                w.writerows(zip(*values))
+            f.seek(-2, os.SEEK_END) # remove newline
+            f.truncate()
+    except Exception:
+        # don't leave a script waiting to queue blocks nothing will take
+        if isinstance(blocks, BlockQueue):
+            for block in blocks:
+                pass
+        raise
+
+# Blocks of notes handed to a sequence report as a script writes them, e.g. in a single pass over sequence.merged()
+class BlockQueue(object):
+
+    def __init__(self, size=QUEUE_SIZE):
+        self.queue = Queue.Queue(size)
+
+    def put(self, block):
+        self.queue.put(block)
+
+    # No more blocks
+    def close(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            yield block
+
+# Writes reports on threads, {threads} at a time; close() waits for them
+class ReportWriter(object):
+
+    def __init__(self, threads=THREADS):
+        self.slots = threading.BoundedSemaphore(threads)
+        self.pending = []
+
+    # Run {function} on a thread of its own once a slot is free
+    def start(self, function, args, message):
+        task = {'error': None}
+        def run():
+            with self.slots:
+                try:
+                    function(*args)
+                except Exception:
+                    task['error'] = sys.exc_info()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.pending.append((thread, task, message))
+
+    # Write {rows} (an iterable of lists, e.g. zip of columns) under {header}
+    def write(self, filename, header, rows, message=None, truncate=False):
+        self.start(writeRows, (filename, header, rows, truncate), message or 'Successfully wrote report to file: ' + filename)
+
+    # Write a sequence report of the notes of {blocks}, e.g. sequence.merged() or a BlockQueue
+    def writeSequence(self, filename, header, blocks, instruments, columns=['gain'], message=None):
+        self.start(writeSequenceRows, (filename, header, blocks, instruments, columns), message or 'Successfully wrote sequence report to file: ' + filename)
+
+    # Wait for every report, printing their messages in the order they were started; raises the first error
+    def close(self):
+        pending = self.pending
+        self.pending = []
+        for thread, task, message in pending:
+            thread.join()
+            if task['error'] is not None:
+                raise task['error'][0], task['error'][1], task['error'][2]
+            print(message)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+##
+# Decoded sample bank shared by the offline tools (rendering, analysis, duration lookups)
+# Each WAV file is decoded once, converted to float32 at a common sample rate and channel layout and saved as a .npy file
+# in the cache directory, keyed by a hash of the file's contents. Later loads are memory-mapped, so they're near-instant
+# and processes using the same samples share the pages rather than each holding a copy.
+# An index of files (by path, size and modification time) remembers their hashes and original format,
+# so a file isn't read again just to hash it and durations are answered without touching the audio.
+# Usage:
+#   bank = sample_bank.SampleBank(sample_rate=44100, channels=1)
+#   frames = bank.load('instruments/kk_0-21-146.wav') # read-only float32 array of frames x channels
+#   duration_ms = bank.getDuration('instruments/kk_0-21-146.wav')
+##
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import wav_file
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'samples')
+INDEX_FILE = 'index.json'
+SAMPLE_RATE = 44100
+CHANNELS = 1 # 1 keeps the first channel, like ChucK's SndBuf
+
+# Hash of a file's contents
+def getHash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Resample frames (frames x channels) from one sample rate to another with linear interpolation
+def resample(frames, from_rate, to_rate):
+    if from_rate == to_rate or len(frames) <= 0:
+        return frames
+    count = int(round(len(frames) * float(to_rate) / from_rate))
+    points = np.arange(count) * (float(from_rate) / to_rate)
+    indices = np.minimum(points.astype(np.int64), len(frames) - 1)
+    following = np.minimum(indices + 1, len(frames) - 1)
+    fractions = (points - indices).astype(np.float32)[:, np.newaxis]
+    return frames[indices] * (1 - fractions) + frames[following] * fractions
+
+# Convert frames (frames x channels) to {channels} channels: the first channels are kept, mono is repeated
+def toChannels(frames, channels):
+    if frames.shape[1] == channels:
+        return frames
+    if frames.shape[1] > channels:
+        return frames[:, :channels]
+    return np.repeat(frames[:, :1], channels, axis=1)
+
+# Write an array to a .npy file atomically, so processes sharing the cache never load half a file
+def saveArray(filename, values):
+    directory = os.path.dirname(filename)
+    fd, temporary = tempfile.mkstemp(suffix='.npy', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, values)
+    os.rename(temporary, filename)
+
+class SampleBank(object):
+
+    def __init__(self, sample_rate=SAMPLE_RATE, channels=CHANNELS, cache_dir=CACHE_DIR):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, INDEX_FILE)
+        self.index = {}
+        self.index_changed = False
+        self.samples = {}
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    # Arguments that create an identical bank, e.g. in another process
+    def getSettings(self):
+        return (self.sample_rate, self.channels, self.cache_dir)
+
+    # Index entry of a file (its hash and original format), adding one if it's new or has changed
+    def getEntry(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        entry = self.index.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            sample_rate, frames = wav_file.readWav(path)
+            entry = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'hash': getHash(path),
+                'sample_rate': sample_rate,
+                'frames': len(frames),
+                'channels': frames.shape[1]
+            }
+            self.index[path] = entry
+            self.index_changed = True
+            self.save(entry, frames)
+        return entry
+
+    # Cached .npy file of a file's decoded samples
+    def getCacheFile(self, entry):
+        return os.path.join(self.cache_dir, '%s_%s_%s.npy' % (entry['hash'], self.sample_rate, self.channels))
+
+    # Convert decoded frames to the bank's format and cache them, unless an identical file already has been
+    def save(self, entry, frames):
+        cache_file = self.getCacheFile(entry)
+        if not os.path.exists(cache_file):
+            frames = resample(toChannels(frames, self.channels), entry['sample_rate'], self.sample_rate)
+            saveArray(cache_file, np.ascontiguousarray(frames, dtype=np.float32))
+
+    # Write the index if files were added to it
+    def flush(self):
+        if not self.index_changed:
+            return
+        fd, temporary = tempfile.mkstemp(suffix='.json', dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.rename(temporary, self.index_file)
+        self.index_changed = False
+
+    # Samples of a file as a read-only, memory-mapped float32 array of frames x channels at the bank's sample rate
+    def load(self, filename):
+        path = os.path.abspath(filename)
+        if path not in self.samples:
+            entry = self.getEntry(path)
+            cache_file = self.getCacheFile(entry)
+            if not os.path.exists(cache_file):
+                self.save(entry, wav_file.readWav(path)[1])
+            self.samples[path] = np.load(cache_file, mmap_mode='r')
+            self.flush()
+        return self.samples[path]
+
+    # Duration of a file in ms, from its original sample rate and length
+    def getDuration(self, filename):
+        entry = self.getEntry(filename)
+        self.flush()
+        return 1000.0 * entry['frames'] / entry['sample_rate']
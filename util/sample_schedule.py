@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+##
+# Sample load schedule for the players
+# A player reads every instrument's sample into its SndBufs before it starts, so a track with many instruments takes
+# long to start and holds every sample in memory to the end. From when each instrument is first and last played (and
+# how long its last notes sound, see voices.py) this works out when to load its sample, {load_ahead_ms} before its
+# first note, and when to release it, once its last note has stopped sounding. Tracks write the schedule into
+# ck_schedule, three lines to an entry (ms into the sequence, 1 to load or 0 to release, instrument index) in order
+# of ms; a player that finds it loads only the samples due at the start before it plays and the rest as it goes.
+# Usage (from a track directory, once the sequence is sorted):
+#   schedule = sample_schedule.getSchedule(sequence, instruments)
+#   sample_schedule.writeSchedule(SCHEDULE_OUTPUT_FILE, schedule)
+##
+
+import csv
+import os
+
+import numpy as np
+
+import voices
+
+LOAD_AHEAD_MS = 5000 # ms before an instrument's first note its sample is loaded; samples due sooner load before the track starts
+UNLOAD_AFTER_MS = 1000 # ms after an instrument's last note stops sounding its sample is released
+
+# When to load and release each played instrument's sample
+#   instrument_index, elapsed_ms: every note in the order it's played; durations_ms: how long each note sounds
+# Returns a list of (ms, load, instrument index) in order of ms, loads before releases at the same ms
+def getEntries(instrument_index, elapsed_ms, durations_ms, count, load_ahead_ms=LOAD_AHEAD_MS, unload_after_ms=UNLOAD_AFTER_MS):
+    instrument_index = np.asarray(instrument_index, dtype=np.int64)
+    elapsed_ms = np.asarray(elapsed_ms, dtype=np.int64)
+    if len(elapsed_ms) <= 0:
+        return []
+    ends = np.ceil(elapsed_ms + np.asarray(durations_ms, dtype=np.float64)).astype(np.int64)
+    played = np.bincount(instrument_index, minlength=count) > 0
+    firsts = np.full(count, np.iinfo(np.int64).max, dtype=np.int64)
+    lasts = np.zeros(count, dtype=np.int64)
+    np.minimum.at(firsts, instrument_index, elapsed_ms)
+    np.maximum.at(lasts, instrument_index, ends)
+    indices = np.flatnonzero(played)
+    loads = np.maximum(firsts[indices] - load_ahead_ms, 0)
+    unloads = lasts[indices] + unload_after_ms
+    entries = [(int(ms), 1, int(i)) for ms, i in zip(loads, indices)]
+    entries += [(int(ms), 0, int(i)) for ms, i in zip(unloads, indices)]
+    return sorted(entries, key=lambda entry: (entry[0], -entry[1], entry[2]))
+
+# Load schedule of a sorted sequence (see SequenceBuffer)
+#   instruments: the track's instruments, each with its sample 'file'
+def getSchedule(sequence, instruments, base_dir='', load_ahead_ms=LOAD_AHEAD_MS, unload_after_ms=UNLOAD_AFTER_MS):
+    instrument_index, elapsed_ms, durations_ms = voices.getNotes(sequence, instruments, base_dir)
+    return getEntries(instrument_index, elapsed_ms, durations_ms, len(instruments), load_ahead_ms, unload_after_ms)
+
+# Write a schedule for the players, or remove one from an earlier build if {schedule} is None, so a player never
+# loads samples on the schedule of another sequence
+def writeSchedule(filename, schedule):
+    if schedule is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        for ms, load, index in schedule:
+            w.writerow([ms])
+            w.writerow([load])
+            w.writerow([index])
+        if len(schedule) > 0:
+            f.seek(-2, os.SEEK_END) # remove newline
+            f.truncate()
+    loads = [ms for ms, load, index in schedule if load]
+    preloads = len([ms for ms in loads if ms <= 0])
+    print('Successfully wrote sample schedule to file: %s (%s samples loaded before the start, %s later)' % (filename, preloads, len(loads) - preloads))
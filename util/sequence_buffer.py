@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+##
+# Struct-of-arrays sequence buffer for the track scripts
+# Keeps every note of a sequence in typed NumPy columns instead of a list of dicts,
+# so a note costs a few bytes rather than a dict holding a copy of its instrument.
+# Instrument details are looked up by instrument_index in the track's instruments list when needed.
+# Given a memory budget, notes that don't fit are spilled to disk as sorted runs (.npy files in a temporary
+# directory) and merged back in order while the sequence is written, so a song can be larger than memory.
+# Usage (from a track directory):
+#   sequence = SequenceBuffer(['duration'], memory_budget=MEMORY_BUDGET_MB * 1024 * 1024)
+#   sequence.append(instrument['index'], elapsed_ms, gains, duration=durations)
+#   sequence.sort() # or stream the notes in order with sequence.merged()
+#   for step in sequence.steps():
+#       instrument = instruments[step['instrument_index']]
+##
+
+import atexit
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import merge
+import tracing
+
+# Every column a buffer can hold and its type
+COLUMNS = {
+    'instrument_index': np.int16,
+    'elapsed_ms': np.int32,
+    'gain': np.float32,
+    'rate': np.float32,
+    'reverb': np.float32,
+    'duration': np.int32,
+    'year': np.int16
+}
+REQUIRED_COLUMNS = ['instrument_index', 'elapsed_ms', 'gain']
+OPTIONAL_COLUMNS = ['rate', 'reverb', 'duration', 'year']
+
+# Values of the columns a buffer doesn't store, i.e. shared by every note
+DEFAULTS = {
+    'position': 0,
+    'rate': 1
+}
+
+# Convert a column to python values; floats are converted through their shortest representation
+# so e.g. a gain of 0.35 is written as 0.35 rather than 0.3499999940395355
+def toValues(values):
+    if values.dtype.kind == 'f':
+        return [float(v) for v in values.astype(str)]
+    return values.tolist()
+
+# Iterate over a block of notes (see SequenceBuffer.merged) as dicts of python values
+def toSteps(block):
+    values = dict([(name, toValues(column)) for name, column in block.items()])
+    defaults = dict([(name, value) for name, value in DEFAULTS.items() if name not in values])
+    for i in range(len(values['elapsed_ms'])):
+        step = defaults.copy()
+        for name in values:
+            step[name] = values[name][i]
+        yield step
+
+class SequenceBuffer(object):
+
+    # memory_budget: bytes of notes to keep in memory before spilling them to disk, 0 for no limit
+    # spill_dir: where to spill notes; a temporary directory (removed on exit) by default
+    def __init__(self, columns=[], capacity=1024, memory_budget=0, spill_dir=None):
+        for name in columns:
+            if name not in OPTIONAL_COLUMNS:
+                raise ValueError('Unknown sequence column: %s' % name)
+        if memory_budget < 0:
+            raise ValueError('Memory budget must not be negative: %s' % memory_budget)
+        self.names = REQUIRED_COLUMNS + [name for name in OPTIONAL_COLUMNS if name in columns]
+        self.size = 0
+        self.runs = []
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.spill_temporary = False
+        self.spills = []
+        self.spilled_size = 0
+        self.last_ms = None
+        if memory_budget > 0:
+            capacity = min(capacity, self.getCapacity())
+        self.columns = dict([(name, np.zeros(max(1, capacity), dtype=COLUMNS[name])) for name in self.names])
+
+    def __len__(self):
+        return self.spilled_size + self.size
+
+    # Record type of the stored columns, i.e. of a spilled note
+    def getRecordType(self):
+        return np.dtype([(name, COLUMNS[name]) for name in self.names])
+
+    # Notes that fit in the memory budget
+    def getCapacity(self):
+        return max(1, int(self.memory_budget // self.getRecordType().itemsize))
+
+    # Grow columns so they can hold at least {capacity} notes
+    def reserve(self, capacity):
+        current = len(self.columns['elapsed_ms'])
+        if capacity <= current:
+            return
+        capacity = max(capacity, current * 2)
+        for name in self.names:
+            column = np.zeros(capacity, dtype=COLUMNS[name])
+            column[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = column
+
+    # Append notes; every value can be an array (one value per note) or a scalar shared by all of them
+    def append(self, instrument_index, elapsed_ms, gain, **columns):
+        elapsed_ms = np.atleast_1d(elapsed_ms)
+        count = len(elapsed_ms)
+        if count <= 0:
+            return
+        values = dict(columns)
+        values['instrument_index'] = instrument_index
+        values['elapsed_ms'] = elapsed_ms
+        values['gain'] = gain
+        for name in values:
+            if name not in self.names:
+                raise ValueError('Sequence has no column: %s' % name)
+        if self.memory_budget > 0 and self.size > 0 and self.size + count > self.getCapacity():
+            self.spill()
+        start = self.size
+        self.reserve(start + count)
+        for name in self.names:
+            if name not in values:
+                raise ValueError('Missing sequence column: %s' % name)
+            value = np.asarray(values[name])
+            dtype = COLUMNS[name]
+            if np.issubdtype(dtype, np.integer) and value.size > 0:
+                info = np.iinfo(dtype)
+                if value.min() < info.min or value.max() > info.max:
+                    raise ValueError('Sequence column %s out of range: %s to %s' % (name, value.min(), value.max()))
+            self.columns[name][start:start+count] = value
+        self.size = start + count
+        self.runs.append((start, self.size))
+        last_ms = int(np.max(self.columns['elapsed_ms'][start:self.size]))
+        if self.last_ms is None or last_ms > self.last_ms:
+            self.last_ms = last_ms
+
+    # Retrieve the notes of a column that are in memory
+    def column(self, name):
+        return self.columns[name][:self.size]
+
+    # Elapsed ms of the last note, or None if there are no notes
+    def getLastMs(self):
+        return self.last_ms
+
+    # Write the notes in memory to disk as one sorted run and empty the buffer
+    @tracing.traced('spill sequence')
+    def spill(self):
+        if self.size <= 0:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='sequence_')
+            self.spill_temporary = True
+            atexit.register(self.close)
+        elif not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        order = np.concatenate(list(self.mergedIndices()))
+        records = np.zeros(self.size, dtype=self.getRecordType())
+        for name in self.names:
+            records[name] = self.column(name)[order]
+        filename = os.path.join(self.spill_dir, 'run_%05d.npy' % len(self.spills))
+        np.save(filename, records)
+        self.spills.append(filename)
+        self.spilled_size += self.size
+        self.size = 0
+        self.runs = []
+
+    # Remove spilled notes from disk
+    def close(self):
+        for filename in self.spills:
+            if os.path.exists(filename):
+                os.remove(filename)
+        if self.spill_temporary and os.path.exists(self.spill_dir):
+            shutil.rmtree(self.spill_dir)
+        self.spills = []
+        self.spilled_size = 0
+
+    # Iterate over the indices of notes in order of elapsed ms, one window of time at a time;
+    # every batch of appended notes is a run, and runs are merged rather than sorting the whole sequence
+    def mergedIndices(self):
+        elapsed_ms = self.column('elapsed_ms')
+        order = np.zeros(self.size, dtype=np.int64)
+        for start, stop in self.runs:
+            order[start:stop] = start + merge.orderRun(elapsed_ms[start:stop])
+        offsets = [start for start, stop in self.runs] + [self.size]
+        for indices in merge.mergeRuns(elapsed_ms[order], offsets):
+            yield order[indices]
+
+    # Iterate over spilled notes in order of elapsed ms as blocks of columns, reading each run from disk
+    # a window of time at a time; notes still in memory are spilled first so every note is in a run
+    def mergedSpills(self):
+        self.spill()
+        runs = [np.load(filename, mmap_mode='r') for filename in self.spills]
+        for cuts in merge.mergeSortedRuns([run['elapsed_ms'] for run in runs]):
+            records = np.concatenate([runs[r][start:stop] for r, start, stop in cuts])
+            records = records[merge.orderRun(records['elapsed_ms'])]
+            yield dict([(name, records[name]) for name in self.names])
+
+    # Iterate over notes in order of elapsed ms as blocks of columns, with the ms since the previous note
+    def merged(self):
+        if len(self.spills) > 0:
+            blocks = self.mergedSpills()
+        else:
+            blocks = (dict([(name, self.column(name)[indices]) for name in self.names]) for indices in self.mergedIndices())
+        previous_ms = 0
+        for block in blocks:
+            elapsed_ms = block['elapsed_ms'].astype(np.int64)
+            block['milliseconds'] = np.diff(elapsed_ms, prepend=previous_ms)
+            previous_ms = elapsed_ms[-1]
+            yield block
+
+    # Sort notes by elapsed ms; ties keep the order they were appended in
+    # Once notes have been spilled they stay on disk and are merged in order when streamed instead
+    @tracing.traced('sort sequence')
+    def sort(self):
+        if len(self.spills) > 0:
+            self.spill()
+            return
+        if self.size <= 0:
+            return
+        order = np.concatenate(list(self.mergedIndices()))
+        for name in self.names:
+            self.columns[name][:self.size] = self.column(name)[order]
+        self.runs = [(0, self.size)]
+
+    # Ms between each note and the previous one
+    def getMilliseconds(self):
+        elapsed_ms = self.column('elapsed_ms').astype(np.int64)
+        return np.diff(elapsed_ms, prepend=0)
+
+    # Iterate over notes (or the notes in memory at {indices}) as dicts of python values
+    def steps(self, indices=None):
+        if indices is None and len(self.spills) > 0:
+            for block in self.merged():
+                for step in toSteps(block):
+                    yield step
+            return
+        if indices is None:
+            indices = slice(None)
+        block = dict([(name, self.column(name)[indices]) for name in self.names])
+        block['milliseconds'] = self.getMilliseconds()[indices]
+        for step in toSteps(block):
+            yield step
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+##
+# Binary sequence files (.cks) for the ChucK players
+# A compact alternative to ck_sequence.csv: a header followed by one fixed-width record per note,
+# so players read a song with a handful of binary reads per note instead of parsing five lines of text.
+#
+# Layout (little-endian 32-bit signed integers throughout):
+#   header: magic "CKS1", fields per record (5, or 6 with reverb), record count
+#   record: instrument_index, position, gain, rate, [reverb], milliseconds
+# Gain, rate and reverb are stored in millionths, so the players don't depend on ChucK's binary float width.
+# Usage (from a track directory):
+#   sequence_file.writeBinary('data/ck_sequence.cks', sequence)
+# or, to write other files from the same pass over the notes:
+#   writer = sequence_file.BinaryWriter('data/ck_sequence.cks', sequence)
+#   for block in sequence.merged():
+#       writer.write(block)
+#   writer.close()
+##
+
+import numpy as np
+
+from sequence_buffer import DEFAULTS
+
+MAGIC = b'CKS1'
+SCALE = 1000000 # gain, rate and reverb are stored in millionths
+HEADER = np.dtype([('magic', 'S4'), ('fields', '<i4'), ('count', '<i4')])
+FIELDS = ['instrument_index', 'position', 'gain', 'rate', 'reverb', 'milliseconds']
+SCALED_FIELDS = ['gain', 'rate', 'reverb']
+
+# Retrieve the record fields of a sequence, with or without reverb
+def getFields(reverb=False):
+    return [field for field in FIELDS if reverb or field != 'reverb']
+
+# Retrieve the record type of a sequence, with or without reverb
+def getRecordType(reverb=False):
+    return np.dtype([(field, '<i4') for field in getFields(reverb)])
+
+# Convert a column to its stored values
+def toRecordValues(field, values):
+    values = np.asarray(values, dtype=np.float64)
+    if field in SCALED_FIELDS:
+        values = np.round(values * SCALE)
+    info = np.iinfo(np.int32)
+    if values.size > 0 and (values.min() < info.min or values.max() > info.max):
+        raise ValueError('Sequence field %s out of range: %s to %s' % (field, values.min(), values.max()))
+    return values.astype(np.int32)
+
+# Writes the blocks of notes of a SequenceBuffer's merge (see SequenceBuffer.merged) to a binary sequence file as they come
+class BinaryWriter(object):
+
+    def __init__(self, filename, sequence):
+        self.filename = filename
+        self.reverb = 'reverb' in sequence.names
+        self.record_type = getRecordType(self.reverb)
+        self.count = len(sequence)
+        self.written = 0
+        self.f = open(filename, 'wb')
+        header = np.array([(MAGIC, len(self.record_type.names), self.count)], dtype=HEADER)
+        header.tofile(self.f)
+
+    # Write a block of notes, with the ms since the previous note
+    def write(self, block):
+        count = len(block['elapsed_ms'])
+        records = np.zeros(count, dtype=self.record_type)
+        for field in getFields(self.reverb):
+            if field in block:
+                records[field] = toRecordValues(field, block[field])
+            else:
+                records[field] = toRecordValues(field, DEFAULTS[field])
+        records.tofile(self.f)
+        self.written += count
+
+    def close(self):
+        self.f.close()
+        if self.written != self.count:
+            raise ValueError('Wrote %s of %s notes to binary sequence file: %s' % (self.written, self.count, self.filename))
+
+# Write a SequenceBuffer to a binary sequence file
+def writeBinary(filename, sequence):
+    writer = BinaryWriter(filename, sequence)
+    for block in sequence.merged():
+        writer.write(block)
+    writer.close()
+
+# Read a binary sequence file; returns a dict of columns
+def readBinary(filename):
+    with open(filename, 'rb') as f:
+        header = np.fromfile(f, dtype=HEADER, count=1)
+        if len(header) <= 0 or header['magic'][0] != MAGIC:
+            raise ValueError('Not a binary sequence file: %s' % filename)
+        fields = int(header['fields'][0])
+        count = int(header['count'][0])
+        records = np.fromfile(f, dtype=getRecordType(fields > 5), count=count)
+    if len(records) != count:
+        raise ValueError('Binary sequence file is truncated: %s' % filename)
+    columns = {}
+    for field in records.dtype.names:
+        if field in SCALED_FIELDS:
+            columns[field] = records[field] / float(SCALE)
+        else:
+            columns[field] = records[field].astype(np.int64)
+    return columns
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+##
+# Incremental sequence patching for the track scripts that generate an instrument's notes at a time
+# Every build keeps each instrument's notes (in the order they were generated) in the cache directory. The next
+# build compares its instruments to the last build's, regenerates only the notes of the instruments that changed
+# and splices them in with the notes kept for the rest, then the sequence is sorted as usual.
+# The result is the same sequence a full build makes:
+#   - Everything but the instruments (the script, its config and its other input files) has to be unchanged, or
+#     every instrument is generated again
+#   - With jitter streams of their own ('instrument'), only the instruments that changed are generated again
+#   - With the global jitter stream, every instrument after the first that changed is generated again, starting
+#     the stream where the last build was when it got to that instrument
+# Usage (from a track directory):
+#   patches = sequence_patch.SequencePatch(__file__, instruments, jitter_streams, JITTER_STREAMS, [ARTISTS_INPUT_FILE], globals())
+#   for instrument in instruments:
+#       if not patches.begin(instrument):
+#           continue # kept from the last build
+#       ... generate the instrument's notes ...
+#   sequence = patches.splice(sequence)
+##
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import build_cache
+from sequence_buffer import SequenceBuffer, REQUIRED_COLUMNS
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'patches')
+
+# Cache file of a script; copies of a script elsewhere (e.g. sweep variants) have their own
+def getCacheFile(script, cache_dir=CACHE_DIR):
+    key = hashlib.sha1(os.path.realpath(script).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.npz')
+
+# Hash of what every instrument's notes depend on besides the instrument itself: the script and the util modules
+# it imports, its config constants (as they are when it runs, which may not be as written), its other input files
+# and the jitter stream mode
+def getContext(script, input_files, config, mode):
+    digest = hashlib.sha1()
+    files = [script] + [os.path.join(build_cache.UTIL_DIR, name + '.py') for name in build_cache.getModules(script)]
+    for filename in files + list(input_files):
+        digest.update(filename + '|' + build_cache.hashFile(filename) + '\n')
+    for name in sorted(config.keys()):
+        if name.isupper() and isinstance(config[name], (basestring, bool, int, long, float)):
+            digest.update(name + '=' + repr(config[name]) + '\n')
+    digest.update('mode=' + mode)
+    return digest.hexdigest()
+
+# Where each instrument's notes start and stop in notes appended in order of instrument, e.g. [0, 12, 12, 30]
+def getOffsets(instrument_index, count):
+    counts = np.bincount(np.asarray(instrument_index, dtype=np.int64), minlength=count)
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+# Hash of an instrument, i.e. of the values its notes are generated from
+def getFingerprint(instrument):
+    return hashlib.sha1(json.dumps(instrument, sort_keys=True)).hexdigest()
+
+class SequencePatch(object):
+
+    # script: the track's script (__file__); instruments: the track's instruments, each with its 'index'
+    # streams: the jitter streams' positions (see jitter.takeIndices); mode: the jitter stream mode
+    # input_files: every input file the notes depend on besides the instruments; config: the script's globals()
+    def __init__(self, script, instruments, streams, mode, input_files=[], config={}, cache_dir=CACHE_DIR):
+        self.cache_file = getCacheFile(script, cache_dir)
+        self.instruments = instruments
+        self.streams = streams
+        self.mode = mode
+        self.context = getContext(script, input_files, config, mode)
+        self.fingerprints = [getFingerprint(instrument) for instrument in instruments]
+        self.previous = self.load()
+        self.kept = set()
+        self.starts = {}
+        if self.previous is None:
+            return
+        previous_fingerprints = self.previous['fingerprints'].tolist()
+        for index, fingerprint in enumerate(self.fingerprints):
+            if index < len(previous_fingerprints) and previous_fingerprints[index] == fingerprint:
+                self.kept.add(index)
+            elif mode == 'global':
+                # every later instrument's jitter depends on the notes of this one
+                break
+        if mode == 'global':
+            self.streams[0] = int(self.previous['stream_starts'][len(self.kept)])
+
+    # The last build's notes, if they were built from the same context, else None
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return None
+        with np.load(self.cache_file) as data:
+            arrays = dict([(name, data[name]) for name in data.files])
+        if str(arrays['context']) != self.context:
+            return None
+        return arrays
+
+    # Start generating an instrument's notes; returns False if its notes are kept from the last build instead
+    def begin(self, instrument):
+        if instrument['index'] in self.kept:
+            return False
+        self.starts[instrument['index']] = self.streams.get(0, 0)
+        return True
+
+    # Splice the notes generated this build into the notes kept from the last build; returns a new sequence that
+    # holds every instrument's notes in order of instrument (as a full build appends them), and keeps them for
+    # the next build
+    def splice(self, sequence):
+        if len(sequence.spills) > 0:
+            raise ValueError('Can\'t patch a sequence that has been spilled to disk')
+        names = sequence.names
+        count = len(self.instruments)
+        generated = sequence.column('instrument_index')
+        order = np.argsort(generated, kind='mergesort')
+        offsets = getOffsets(generated, count)
+        columns = dict([(name, sequence.column(name)[order]) for name in names])
+        kept_total = sum([int(self.previous['offsets'][i+1] - self.previous['offsets'][i]) for i in self.kept])
+        result = SequenceBuffer([name for name in names if name not in REQUIRED_COLUMNS], capacity=kept_total + len(generated))
+        for index in range(count):
+            if index in self.kept:
+                start, stop = self.previous['offsets'][index:index+2]
+                values = dict([(name, self.previous['column_' + name][start:stop]) for name in names])
+            else:
+                start, stop = offsets[index:index+2]
+                values = dict([(name, columns[name][start:stop]) for name in names])
+            result.append(**values)
+        self.save(result)
+        print('Patched sequence: generated %s of %s instruments, kept %s from the last build' % (count - len(self.kept), count, len(self.kept)))
+        return result
+
+    # Keep every instrument's notes of {sequence} (appended in order of instrument) for the next build
+    def save(self, sequence):
+        count = len(self.instruments)
+        stream_starts = np.zeros(count + 1, dtype=np.int64)
+        for index in range(count):
+            stream_starts[index] = self.starts[index] if index in self.starts else self.previous['stream_starts'][index]
+        stream_starts[count] = self.streams.get(0, 0)
+        arrays = {
+            'context': np.array(self.context),
+            'fingerprints': np.array(self.fingerprints, dtype=str),
+            'stream_starts': stream_starts,
+            'offsets': getOffsets(sequence.column('instrument_index'), count)
+        }
+        for name in sequence.names:
+            arrays['column_' + name] = sequence.column(name)
+        cache_dir = os.path.dirname(self.cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # write atomically, so scripts running at the same time never load half a file
+        fd, temporary = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(temporary, self.cache_file)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+##
+# Shared beat generation for the track scripts
+# Generates every beat an instrument plays over a window of time (start ms, duration) at once as NumPy arrays
+# Beats are laid out on the integer timeline (see timeline.py): durations are whole ticks of {round_to} ms and
+# onsets are added up in int64, so long tracks don't drift
+# Usage (from a track directory):
+#   sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+#   import sequencer
+#   beats = sequencer.getBeats(instrument, ms, duration, ROUND_TO_NEAREST, offset_ms=offset_ms)
+##
+
+import math
+import numpy as np
+
+import timeline
+
+# Apply python's round to every value, so results are identical to the scalar implementation
+def roundValues(values, ndigits=None):
+    values = np.asarray(values, dtype=np.float64)
+    if values.size <= 0:
+        return values.copy()
+    if ndigits is None:
+        return timeline.roundHalfAway(values).astype(np.float64)
+    unique, inverse = np.unique(values, return_inverse=True)
+    rounded = [round(v, ndigits) for v in unique.tolist()]
+    return np.array(rounded, dtype=np.float64)[inverse].reshape(values.shape)
+
+# round {n} to nearest {nearest}
+def roundToNearest(n, nearest):
+    return timeline.toTicks(n, nearest) * nearest
+
+# Multiplier based on sine curve
+def getMultiplier(percent_complete, rad=1.0):
+    multiplier = np.sin(np.asarray(percent_complete, dtype=np.float64) * (math.pi * rad))
+    return np.where(multiplier < 0, 0.0, multiplier)
+
+# Interpolate gain between an instrument's from/to gain
+def getGain(instrument, multiplier):
+    from_gain = instrument['from_gain']
+    to_gain = instrument['to_gain']
+    min_gain = min(from_gain, to_gain)
+    gain = roundValues(multiplier * (to_gain - from_gain) + from_gain, 2)
+    return np.where(gain > min_gain, gain, min_gain)
+
+# Get beat duration in ticks of {round_to} ms from a tempo multiplier
+def getBeatTicks(instrument, multiplier, round_to):
+    from_beat_ms = instrument['from_beat_ms']
+    to_beat_ms = instrument['to_beat_ms']
+    ms = multiplier * (to_beat_ms - from_beat_ms) + from_beat_ms
+    return timeline.toTicks(ms, round_to)
+
+# Get beat duration in ms from a tempo multiplier
+def getBeatMs(instrument, multiplier, round_to):
+    return timeline.toMs(getBeatTicks(instrument, multiplier, round_to), round_to)
+
+# Return which elapsed ms the instrument should be played in
+def isValidInterval(instrument, elapsed_ms):
+    interval_ms = instrument['interval_ms']
+    interval = instrument['interval']
+    interval_offset = instrument['interval_offset']
+    intervals = timeline.floorDivide(elapsed_ms, interval_ms)
+    return intervals % interval == interval_offset
+
+# Convert ms to a beat count the same way the scalar scripts do, i.e. int(ms / beat_ms)
+def getElapsedBeats(elapsed_ms, beat_ms):
+    return timeline.truncDivide(elapsed_ms, beat_ms)
+
+# Walk the beats of a window; returns each beat's whole elapsed ms, ms into the window and duration
+def walkBeats(instrument, start_ms, duration, round_to, offset_ms, min_ms, tempo, tempo_rad, beat_ms, continue_beat):
+    remaining_duration = int(duration)
+    if remaining_duration < min_ms:
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty, empty)
+    previous_ms = int(start_ms)
+
+    # Constant tempo: beats are evenly spaced
+    if tempo == 'constant' or instrument['from_beat_ms'] == instrument['to_beat_ms']:
+        if tempo == 'constant':
+            step = int(beat_ms)
+        else:
+            step = int(getBeatMs(instrument, np.zeros(1), round_to)[0])
+        if step <= 0:
+            raise ValueError('Beat duration must be positive: %s' % step)
+        count = int((remaining_duration - min_ms) // step) + 1
+        steps = np.full(count, step, dtype=np.int64)
+
+    # Changing tempo: each beat's duration (in ticks of {round_to} ms) depends on where the previous beat ended,
+    # so compute the duration of every possible beat position at once, then follow the chain
+    else:
+        grid = int(round_to)
+        if grid != round_to or grid <= 0:
+            raise ValueError('Round to must be a positive whole number of ms: %s' % round_to)
+        positions = np.arange(int((remaining_duration - min_ms) // grid) + 1, dtype=np.int64) * grid
+        if tempo == 'beat':
+            elapsed_ms = timeline.getOnsets(start_ms, np.full(len(positions), grid))
+            if continue_beat:
+                elapsed_beat = getElapsedBeats(elapsed_ms, beat_ms)
+            else:
+                elapsed_beat = getElapsedBeats(elapsed_ms - previous_ms, beat_ms)
+            beats_per_phase = instrument['tempo_phase']
+            percent_complete = (elapsed_beat % beats_per_phase).astype(np.float64) / beats_per_phase
+            multiplier = getMultiplier(percent_complete)
+        else:
+            percent_complete = 1.0 * (offset_ms + positions) / duration
+            multiplier = getMultiplier(percent_complete, tempo_rad)
+        table = getBeatTicks(instrument, multiplier, grid).tolist()
+        last = len(table)
+        steps = []
+        j = 0
+        while j < last:
+            step = table[j]
+            if step <= 0:
+                raise ValueError('Beat duration must be positive: %s' % (step * grid))
+            steps.append(step * grid)
+            j += step
+        steps = np.array(steps, dtype=np.int64)
+
+    # Add up ms in int64, so onsets are exact however many beats there are
+    elapsed_ms = timeline.getOnsets(start_ms, steps)
+    elapsed_duration = offset_ms + np.concatenate(([0], np.cumsum(steps)[:-1]))
+    return (elapsed_ms, elapsed_duration, steps)
+
+# Generate all the beats of an instrument from {ms} over {duration} ms
+#   offset_ms: ms to shift the first beat by (e.g. tempo_offset * beat_ms)
+#   min_ms: stop once less than this many ms remain; defaults to the shortest beat
+#   tempo: 'percent' curves from/to beat ms over the window (tempo_rad of a sine phase),
+#          'beat' curves over every tempo_phase beats of {beat_ms},
+#          'constant' plays every {beat_ms}
+#   gain: 'percent' curves from/to gain over the window (gain_rad of a sine phase),
+#         'beat' curves over every gain_phase beats of {beat_ms},
+#         'elapsed' curves by elapsed ms over duration (gain_rad of a sine phase),
+#         'constant' plays at the instrument's gain
+#   continue_beat: count beats from the start of the song rather than the window
+#   round_start_to: round the window's first beat to the nearest of this many ms
+# Returns a dict of arrays for the beats that fall on a valid interval:
+#   ms (elapsed ms before variance), beat_ms (beat duration), percent (percent complete of window), gain
+def getBeats(instrument, ms, duration, round_to, offset_ms=0, min_ms=None, tempo='percent', tempo_rad=1.0, gain='percent', gain_rad=1.0, beat_ms=None, continue_beat=False, round_start_to=0):
+    ms += offset_ms
+    if round_start_to > 0:
+        ms = 1.0 * int(timeline.toTicks(ms, round_start_to)) * round_start_to
+    if min_ms is None:
+        if tempo == 'constant':
+            min_ms = beat_ms
+        else:
+            min_ms = min(instrument['from_beat_ms'], instrument['to_beat_ms'])
+    elapsed_ms, elapsed_duration, steps = walkBeats(instrument, ms, duration, round_to, offset_ms, min_ms, tempo, tempo_rad, beat_ms, continue_beat)
+
+    # only keep beats in a valid interval
+    valid = isValidInterval(instrument, elapsed_ms)
+    elapsed_ms = elapsed_ms[valid]
+    elapsed_duration = elapsed_duration[valid]
+    steps = steps[valid]
+    percent_complete = 1.0 * elapsed_duration / duration
+
+    if gain == 'constant':
+        gains = np.full(len(elapsed_ms), instrument['gain'], dtype=np.float64)
+    elif gain == 'beat':
+        if continue_beat:
+            elapsed_beat = getElapsedBeats(elapsed_ms, beat_ms)
+        else:
+            elapsed_beat = getElapsedBeats(elapsed_ms - int(ms), beat_ms)
+        beats_per_phase = instrument['gain_phase']
+        gains = getGain(instrument, getMultiplier((elapsed_beat % beats_per_phase).astype(np.float64) / beats_per_phase))
+    elif gain == 'elapsed':
+        gains = getGain(instrument, getMultiplier(1.0 * elapsed_ms / duration, gain_rad))
+    else:
+        gains = getGain(instrument, getMultiplier(percent_complete, gain_rad))
+
+    return {
+        'ms': elapsed_ms,
+        'beat_ms': steps,
+        'percent': percent_complete,
+        'gain': gains
+    }
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+##
+# Sequence server for live tweaking: keeps a Python process warm with the tracks' parsed data in memory and
+# rebuilds a track's sequence for posted config overrides, so a change is a request round-trip instead of a cold
+# start of Python, NumPy and every file parse.
+# A build runs the track's script in this process with its config constants overridden, the same as running it
+# by hand after editing them, and writes the same files (so ChucK plays the new sequence). The script's inputs come
+# from the table cache's in-memory arrays (see table_cache.py) after the first build, and the script is only read
+# again when it changes.
+# Usage:
+#   python serve.py [03_smog ...] [-port 8765 | -socket /tmp/sequence.sock]
+#   curl -d '{"BPM": 100, "GAIN": 0.3}' localhost:8765/build/03_smog
+#   curl --unix-socket /tmp/sequence.sock -d '{}' http://localhost/build/03_smog
+#   curl localhost:8765/tracks
+# A build responds with JSON of its time, sequence stats (notes, duration_ms, peak_notes_per_second) and output.
+##
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import SocketServer
+import StringIO
+import sys
+import time
+import traceback
+
+import build
+import golden
+import sweep
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+scripts = {} # script filename => ((size, mtime), text)
+
+# Text of a stage's script, read again only when it changes
+def getScript(stage, root_dir=build.ROOT_DIR):
+    filename = os.path.abspath(os.path.join(root_dir, stage['track'], stage['script']))
+    stat = os.stat(filename)
+    if filename not in scripts or scripts[filename][0] != (stat.st_size, stat.st_mtime):
+        with open(filename, 'rb') as f:
+            scripts[filename] = ((stat.st_size, stat.st_mtime), f.read())
+    return (filename, scripts[filename][1])
+
+# Python source of a posted config value, e.g. 100 => 100, "binary" => 'binary'
+def toLiteral(value):
+    if isinstance(value, basestring):
+        return repr(str(value))
+    return repr(value)
+
+# Build a stage's sequence with its config constants set to {settings} (name => value), in this process
+# Returns a dict of how it went, for the response
+def buildSequence(stage, settings, root_dir=build.ROOT_DIR):
+    filename, text = getScript(stage, root_dir)
+    text, missing = golden.setConstants(text, dict([(name, toLiteral(value)) for name, value in settings.items()]))
+    if len(missing) > 0:
+        raise ValueError('%s has no setting %s' % (stage['script'], ', '.join(missing)))
+    track_dir = os.path.dirname(filename)
+    result = {'stage': build.getName(stage), 'settings': settings, 'error': None}
+    started = time.time()
+    log = StringIO.StringIO()
+    cwd = os.getcwd()
+    argv = sys.argv
+    stdout = sys.stdout
+    os.chdir(track_dir)
+    sys.argv = [filename]
+    sys.stdout = log
+    try:
+        code = compile(text, filename, 'exec')
+        exec(code, {'__name__': '__main__', '__file__': filename})
+    except SystemExit as e:
+        if e.code:
+            result['error'] = 'exited with %s' % e.code
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        sys.stdout = stdout
+        sys.argv = argv
+        os.chdir(cwd)
+    result['seconds'] = round(time.time() - started, 3)
+    result['output'] = log.getvalue()
+    if result['error'] is None:
+        result['duration_ms'], result['notes'], result['peak_notes_per_second'] = sweep.getStats(track_dir)
+    return result
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Tracks that can be built
+    def do_GET(self):
+        if self.path.rstrip('/') != '/tracks':
+            self.respond(404, {'error': 'Not found: %s' % self.path})
+            return
+        stages = [stage for stage in build.STAGES if 'data/ck_sequence.csv' in stage['outputs']]
+        self.respond(200, {'tracks': [stage['track'] for stage in stages]})
+
+    # Build a track with the posted settings, e.g. POST /build/03_smog {"BPM": 100}
+    def do_POST(self):
+        parts = self.path.strip('/').split('/', 1)
+        if len(parts) != 2 or parts[0] != 'build':
+            self.respond(404, {'error': 'Not found: %s' % self.path})
+            return
+        try:
+            stage = sweep.getStage(parts[1])
+            body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+            settings = json.loads(body) if body.strip() else {}
+            if not isinstance(settings, dict):
+                raise ValueError('Post settings as a JSON object, e.g. {"BPM": 100}')
+        except ValueError as e:
+            self.respond(400, {'error': str(e)})
+            return
+        try:
+            result = buildSequence(stage, settings)
+        except ValueError as e:
+            self.respond(400, {'error': str(e)})
+            return
+        self.server.log('Built %s%s in %ss%s' % (result['stage'], ''.join([' %s=%s' % s for s in sorted(settings.items())]), result['seconds'], ', FAILED' if result['error'] else ''))
+        self.respond(500 if result['error'] else 200, result)
+
+    # Requests are logged by the server instead, so Unix socket clients (which have no address) are too
+    def log_message(self, format, *args):
+        pass
+
+class HTTPServer(BaseHTTPServer.HTTPServer):
+
+    def log(self, message):
+        print(message)
+        sys.stdout.flush()
+
+class UnixHTTPServer(SocketServer.UnixStreamServer):
+
+    def log(self, message):
+        print(message)
+        sys.stdout.flush()
+
+# Serve on a TCP port of {HOST}, or on a Unix socket if {socket_file} is given
+def serve(port=PORT, socket_file=None, warm=[]):
+    for name in warm:
+        result = buildSequence(sweep.getStage(name), {})
+        print('Warmed %s in %ss%s' % (result['stage'], result['seconds'], ', FAILED:\n' + result['error'] if result['error'] else ''))
+    if socket_file:
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+        server = UnixHTTPServer(socket_file, RequestHandler)
+        print('Serving sequences on %s' % socket_file)
+    else:
+        server = HTTPServer((HOST, port), RequestHandler)
+        print('Serving sequences on http://%s:%s' % (HOST, port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_file and os.path.exists(socket_file):
+            os.remove(socket_file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('TRACKS', nargs='*', help="Tracks to build once at start, so their data is warm, e.g. 03_smog")
+    parser.add_argument('-port', dest="PORT", default=PORT, type=int, help="Port to serve on")
+    parser.add_argument('-socket', dest="SOCKET", default="", help="Unix socket to serve on instead of a port")
+    args = parser.parse_args()
+
+    serve(args.PORT, args.SOCKET, args.TRACKS)
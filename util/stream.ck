@@ -0,0 +1,145 @@
+// Plays notes streamed over OSC by util/stream.py instead of reading a sequence file
+// Usage: chuck stream.ck:<track directory>:<instrument buffers>, e.g. chuck stream.ck:../03_smog/:2
+// Start this first, then: python stream.py ../03_smog/
+
+6449 => int port;
+2 => int instrument_buffers;
+2000 => int padding_end;
+me.sourceDir() + "/../03_smog/" => string base_dir;
+
+if (me.args() > 0)
+{
+    me.arg(0) => base_dir;
+}
+if (me.args() > 1)
+{
+    Std.atoi(me.arg(1)) => instrument_buffers;
+}
+
+// normalize base directory
+if (base_dir.charAt(base_dir.length()-1) != '/')
+{
+    "/" +=> base_dir;
+}
+
+// instrument object
+class Instrument {
+    string filename;
+    SndBuf buf[];
+    int buffers;
+    int plays;
+}
+
+// read instruments file
+base_dir + "data/ck_instruments.csv" => string instruments_file;
+FileIO instruments_fio;
+instruments_fio.open( instruments_file, FileIO.READ );
+if( !instruments_fio.good() )
+{
+    cherr <= "can't open instruments file for reading..."
+          <= IO.newline();
+    me.exit();
+}
+
+// create instruments array
+Instrument instruments[256];
+
+while( instruments_fio.more() )
+{
+    // read instrument index (and its number of buffers if the builder sized them, e.g. "12,3") and filename
+    instruments_fio.readLine() => string index_line;
+    Std.atoi(index_line) => int instrument_index;
+    instrument_buffers => instruments[instrument_index].buffers;
+    index_line.find(",") => int buffers_match;
+    if (buffers_match >= 0)
+    {
+        Std.atoi(index_line.substring(buffers_match + 1)) => instruments[instrument_index].buffers;
+    }
+    instruments_fio.readLine() => string filename;
+    filename.find("\r") => int return_match;
+    if (return_match >= 0)
+    {
+        filename.erase(return_match, 1);
+    }
+    // instruments files with reverb (e.g. 04_dating) have a max reverb line between each index and file
+    filename.lower() => string lower_filename;
+    if (lower_filename.length() < 4 || lower_filename.substring(lower_filename.length() - 4) != ".wav")
+    {
+        instruments_fio.readLine() => filename;
+        filename.find("\r") => return_match;
+        if (return_match >= 0)
+        {
+            filename.erase(return_match, 1);
+        }
+    }
+    base_dir + filename => instruments[instrument_index].filename;
+    0 => instruments[instrument_index].plays;
+    // create buffers from filename
+    SndBuf bufs[instruments[instrument_index].buffers];
+    bufs @=> instruments[instrument_index].buf;
+    for( 0 => int i; i < instruments[instrument_index].buffers; i++ )
+    {
+        instruments[instrument_index].filename => instruments[instrument_index].buf[i].read;
+        // set position to end, so it won't play immediately upon open
+        instruments[instrument_index].buf[i].samples() => instruments[instrument_index].buf[i].pos;
+        instruments[instrument_index].buf[i] => dac;
+    }
+}
+
+// listen for the stream
+OscIn oin;
+port => oin.port;
+oin.addAddress( "/start, i" );
+oin.addAddress( "/note, i i f f i" );
+oin.addAddress( "/stop" );
+OscMsg msg;
+
+// the song's clock starts when the stream does, {lookahead} ms from now
+time start_time;
+0 => int playing;
+
+// wait until a note's time, then play it on its buffer
+fun void play( int instrument_index, int buffer_index, int position, float gain, float rate, int elapsed_ms )
+{
+    start_time + elapsed_ms::ms => time at;
+    if (at > now)
+    {
+        at => now;
+    }
+    position => instruments[instrument_index].buf[buffer_index].pos;
+    gain => instruments[instrument_index].buf[buffer_index].gain;
+    rate => instruments[instrument_index].buf[buffer_index].rate;
+}
+
+<<< "Listening on port", port >>>;
+
+0 => int stopped;
+while( !stopped )
+{
+    oin => now;
+    while( oin.recv(msg) )
+    {
+        if (msg.address == "/start")
+        {
+            now + msg.getInt(0)::ms => start_time;
+            1 => playing;
+        }
+        else if (msg.address == "/note" && playing)
+        {
+            msg.getInt(0) => int instrument_index;
+            // choose buffer index in the order notes arrive, i.e. the order they play in
+            instruments[instrument_index].plays % instruments[instrument_index].buffers => int buffer_index;
+            instruments[instrument_index].plays++;
+            spork ~ play(instrument_index, buffer_index, msg.getInt(1), msg.getFloat(2), msg.getFloat(3), msg.getInt(4));
+        }
+        else if (msg.address == "/stop")
+        {
+            1 => stopped;
+        }
+    }
+}
+
+// let the last notes play out
+padding_end::ms => now;
+
+<<< "Done." >>>;
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+##
+# Streaming playback: sends notes to a ChucK OSC receiver (util/stream.ck) as they're due instead of
+# having a player read a finished sequence file. Notes come from any generator of steps (dicts with
+# instrument_index, position, gain, rate and milliseconds since the previous note), e.g. sequence.steps()
+# or a sequence file read a note at a time, so memory stays flat however long the song is. With -build, they
+# come from the track's build as it generates them (see build_stream.py), so the first notes play before the
+# build is done.
+# A scheduler thread sends each note {lookahead_ms} before it should sound, with its time on the song's clock;
+# ChucK starts that clock when the stream starts and plays every note at its time, absorbing any delay in sending.
+# Usage (ChucK first, then the stream):
+#   chuck stream.ck:../03_smog/:2
+#   python stream.py ../03_smog/
+#   python stream.py ../03_smog/ -build
+# or, without ChucK, to check timing against a local receiver stub:
+#   python stream.py ../03_smog/ -stub
+##
+
+import argparse
+import os
+import runpy
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+import build
+import build_cache
+import build_stream
+import osc
+import report
+import sequence_file
+from sequence_buffer import toSteps
+
+LOOKAHEAD_MS = 200 # ms ahead of time each note is sent
+CHUNK_SIZE = 4096 # notes read from a binary sequence file at a time
+
+# Iterate over the notes of ck_sequence.csv a note at a time
+def readSteps(filename, reverb=False):
+    fields = ['instrument_index', 'position', 'gain', 'rate', 'milliseconds']
+    if reverb:
+        fields.insert(4, 'reverb')
+    types = dict([(field, float if field in sequence_file.SCALED_FIELDS else int) for field in fields])
+    with open(filename, 'rb') as f:
+        values = []
+        for line in f:
+            line = line.strip()
+            if len(line) <= 0:
+                continue
+            values.append(line)
+            if len(values) >= len(fields):
+                yield dict([(field, types[field](value)) for field, value in zip(fields, values)])
+                values = []
+
+# Iterate over the notes of a binary sequence file, reading {CHUNK_SIZE} notes at a time
+def readBinarySteps(filename):
+    with open(filename, 'rb') as f:
+        header = np.fromfile(f, dtype=sequence_file.HEADER, count=1)
+        if len(header) <= 0 or header['magic'][0] != sequence_file.MAGIC:
+            raise ValueError('Not a binary sequence file: %s' % filename)
+        record_type = sequence_file.getRecordType(int(header['fields'][0]) > 5)
+        remaining = int(header['count'][0])
+        while remaining > 0:
+            records = np.fromfile(f, dtype=record_type, count=min(CHUNK_SIZE, remaining))
+            if len(records) <= 0:
+                raise ValueError('Binary sequence file is truncated: %s' % filename)
+            remaining -= len(records)
+            columns = []
+            for field in record_type.names:
+                if field in sequence_file.SCALED_FIELDS:
+                    columns.append((field, (records[field] / float(sequence_file.SCALE)).tolist()))
+                else:
+                    columns.append((field, records[field].tolist()))
+            for i in range(len(records)):
+                yield dict([(field, values[i]) for field, values in columns])
+
+# Iterate over the notes of a track directory's sequence, preferring the binary file like the players do
+def readTrackSteps(track_dir):
+    binary_file = os.path.join(track_dir, 'data', 'ck_sequence.cks')
+    if os.path.exists(binary_file):
+        return readBinarySteps(binary_file)
+    with open(os.path.join(track_dir, 'data', 'ck_instruments.csv'), 'rb') as f:
+        lines = f.read().splitlines()
+    # instruments files with reverb have a max reverb line between each index and file
+    reverb = len(lines) > 1 and not lines[1].strip().lower().endswith('.wav')
+    return readSteps(os.path.join(track_dir, 'data', 'ck_sequence.csv'), reverb)
+
+# Iterate over blocks of notes in order (see SequenceBuffer.merged) a note at a time
+def readBlockSteps(blocks):
+    for block in blocks:
+        for step in toSteps(block):
+            yield step
+
+# Iterate over the notes of a track directory's sequence as its build generates them: runs the track's script on
+# a thread of this process and streams each note once the build has moved past it (see build_stream.py). A
+# streamed build writes none of the track's files
+def buildTrackSteps(track_dir):
+    track_dir = os.path.abspath(track_dir)
+    track = os.path.basename(os.path.normpath(track_dir))
+    stages = [stage for stage in build.STAGES if stage['track'] == track and 'data/ck_sequence.csv' in stage['outputs']]
+    if len(stages) <= 0:
+        raise ValueError('No stage builds a sequence for: %s' % track)
+    script = os.path.join(track_dir, stages[0]['script'])
+    if 'build_stream' not in build_cache.getModules(script):
+        raise ValueError('%s doesn\'t stream its notes as it builds them' % stages[0]['script'])
+    # the build waits for playback once it's a few blocks ahead, so only those blocks are held
+    blocks = report.BlockQueue()
+    def run():
+        build_stream.listen(blocks)
+        cwd = os.getcwd()
+        argv = sys.argv
+        os.chdir(track_dir)
+        sys.argv = [script]
+        try:
+            runpy.run_path(script, run_name='__main__')
+        except SystemExit as e:
+            if e.code:
+                print('%s exited with %s' % (stages[0]['script'], e.code))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.argv = argv
+            os.chdir(cwd)
+            build_stream.listen(None)
+            blocks.close()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return readBlockSteps(blocks)
+
+# Sends steps to an OSC receiver on a background thread, each {lookahead_ms} before it's due
+#   /start lookahead_ms, then /note instrument_index position gain rate elapsed_ms for every note, then /stop
+class Scheduler(threading.Thread):
+
+    def __init__(self, steps, sender, lookahead_ms=LOOKAHEAD_MS, start_ms=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.steps = steps
+        self.sender = sender
+        self.lookahead_ms = lookahead_ms
+        self.start_ms = start_ms
+        self.stopped = threading.Event()
+        self.sent = 0
+        self.late = 0
+        self.max_delay_ms = 0
+
+    def run(self):
+        self.sender.send('/start', int(self.lookahead_ms))
+        started = time.time()
+        elapsed_ms = 0
+        for step in self.steps:
+            if self.stopped.is_set():
+                break
+            elapsed_ms += step['milliseconds']
+            if elapsed_ms < self.start_ms:
+                continue
+            due = started + (elapsed_ms - self.start_ms) / 1000.0
+            wait = due - time.time()
+            if wait > 0:
+                self.stopped.wait(wait)
+                if self.stopped.is_set():
+                    break
+            delay_ms = (time.time() - due) * 1000
+            self.max_delay_ms = max(self.max_delay_ms, delay_ms)
+            if delay_ms > self.lookahead_ms:
+                self.late += 1
+            self.sender.send('/note', int(step['instrument_index']), int(step['position']), float(step['gain']), float(step['rate']), int(elapsed_ms - self.start_ms))
+            self.sent += 1
+        self.sender.send('/stop')
+
+    def stop(self):
+        self.stopped.set()
+
+# Stream steps and wait until they've all been sent (or Ctrl+C)
+def play(steps, host=osc.HOST, port=osc.PORT, lookahead_ms=LOOKAHEAD_MS, start_ms=0):
+    sender = osc.OscSender(host, port)
+    scheduler = Scheduler(steps, sender, lookahead_ms, start_ms)
+    scheduler.start()
+    try:
+        while scheduler.is_alive():
+            scheduler.join(0.5)
+    except KeyboardInterrupt:
+        scheduler.stop()
+        scheduler.join()
+    sender.close()
+    return scheduler
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('TRACK_DIR', help="Path to the track directory, e.g. ../03_smog/")
+    parser.add_argument('-port', dest="PORT", default=osc.PORT, type=int, help="Port ChucK listens on")
+    parser.add_argument('-la', dest="LOOKAHEAD_MS", default=LOOKAHEAD_MS, type=int, help="Ms ahead of time each note is sent")
+    parser.add_argument('-start', dest="START_MS", default=0, type=int, help="Ms into the song to start at")
+    parser.add_argument('-build', dest="BUILD", action="store_true", help="Build the track and stream its notes as they're generated, instead of reading its sequence file")
+    parser.add_argument('-stub', dest="STUB", action="store_true", help="Send to a local receiver stub instead of ChucK and report timing")
+    args = parser.parse_args()
+
+    receiver = osc.OscReceiver(osc.HOST, args.PORT) if args.STUB else None
+    steps = buildTrackSteps(args.TRACK_DIR) if args.BUILD else readTrackSteps(args.TRACK_DIR)
+    scheduler = play(steps, osc.HOST, args.PORT, args.LOOKAHEAD_MS, args.START_MS)
+    print('Sent %s notes, %s late (max delay %sms)' % (scheduler.sent, scheduler.late, int(round(scheduler.max_delay_ms))))
+    if receiver:
+        time.sleep(0.2)
+        receiver.close()
+        print('Receiver stub got %s messages' % len(receiver.messages))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+##
+# Parameter sweeps: builds every combination of a grid of config values (BPM, GAIN, TEMPO, DIVISIONS_PER_BEAT...)
+# of a track, each into its own output directory, and summarizes each variant's sequence (duration, notes,
+# peak notes per second) to compare them.
+# The track's data is parsed once: the first variant runs in this process and loads its inputs into the table cache
+# (see table_cache.py), then the rest run in a pool of processes forked from it that share those parsed arrays.
+# Each variant runs the track's script in the worker itself (no new interpreter), in a directory that links to the
+# track's data and instruments, with its config constants set to the variant's values.
+# Usage: python sweep.py 03_smog -grid BPM=100,110,120 GAIN=0.3,0.4 [-p 4] [-o ../output/sweeps]
+##
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import re
+import runpy
+import shutil
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import build
+import golden
+import stream
+
+ROOT_DIR = build.ROOT_DIR
+OUTPUT_DIR = os.path.join(ROOT_DIR, 'output', 'sweeps')
+DENSITY_WINDOW_MS = 1000 # window notes are counted over for peak density
+SUMMARY_FILE = 'summary.csv'
+
+# The stage that builds a track's sequence, e.g. 03_smog => 03_smog/smog
+def getStage(name):
+    stages = [s for s in build.STAGES if build.getName(s) == name]
+    if len(stages) <= 0:
+        stages = [s for s in build.STAGES if s['track'] == name.strip('/') and 'data/ck_sequence.csv' in s['outputs']]
+    if len(stages) <= 0:
+        raise ValueError('No stage builds a sequence for: %s' % name)
+    return stages[0]
+
+# Parse 'NAME=value,value,...' arguments into a list of (name, values)
+def parseGrid(values):
+    grid = []
+    for value in values:
+        if '=' not in value:
+            raise ValueError('Grid values look like NAME=1,2,3: %s' % value)
+        name, options = value.split('=', 1)
+        grid.append((name.strip(), [option.strip() for option in options.split(',') if option.strip()]))
+    return grid
+
+# Every combination of a grid's values, as a list of (variant name, settings)
+def getVariants(grid):
+    names = [name for name, values in grid]
+    variants = []
+    for values in itertools.product(*[values for name, values in grid]):
+        settings = dict(zip(names, values))
+        variant = '_'.join(['%s-%s' % (name, re.sub(r'[^\w.-]+', '', value)) for name, value in zip(names, values)])
+        variants.append((variant, settings))
+    return variants
+
+# Make a variant's directory: its copy of the track's script with {settings} applied, links to the track's data
+# files and instruments, and the directories its outputs go in; returns the variant's track directory
+def makeVariant(stage, variant_dir, settings, root_dir=ROOT_DIR):
+    source = os.path.join(root_dir, stage['track'])
+    track_dir = os.path.join(variant_dir, stage['track'])
+    if os.path.exists(variant_dir):
+        shutil.rmtree(variant_dir)
+    os.makedirs(os.path.join(track_dir, 'data'))
+    # scripts import util from their parent directory
+    os.symlink(os.path.join(os.path.abspath(root_dir), 'util'), os.path.join(variant_dir, 'util'))
+    if os.path.isdir(os.path.join(source, 'instruments')):
+        os.symlink(os.path.abspath(os.path.join(source, 'instruments')), os.path.join(track_dir, 'instruments'))
+    outputs = set([os.path.normpath(output) for output in stage['outputs']] + [os.path.join('data', 'ck_sequence.cks'), os.path.join('data', 'trace.json')])
+    for filename in os.listdir(os.path.join(source, 'data')):
+        if os.path.join('data', filename) not in outputs:
+            os.symlink(os.path.abspath(os.path.join(source, 'data', filename)), os.path.join(track_dir, 'data', filename))
+    for output in stage['outputs']:
+        directory = os.path.dirname(os.path.join(track_dir, output))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    script = os.path.join(track_dir, stage['script'])
+    shutil.copyfile(os.path.join(source, stage['script']), script)
+    missing = golden.applySettings(script, settings)
+    if len(missing) > 0:
+        raise ValueError('%s has no setting %s' % (stage['script'], ', '.join(missing)))
+    return track_dir
+
+# Run a variant's script in this process, with its output going to sweep.log in its directory
+# Returns (variant, error or None, seconds)
+def runVariant(task):
+    variant, track_dir, script = task
+    started = time.time()
+    error = None
+    cwd = os.getcwd()
+    argv = sys.argv
+    stdout = sys.stdout
+    with open(os.path.join(track_dir, 'sweep.log'), 'w') as log:
+        os.chdir(track_dir)
+        sys.argv = [script]
+        sys.stdout = log
+        try:
+            runpy.run_path(script, run_name='__main__')
+        except SystemExit as e:
+            if e.code:
+                error = 'exited with %s' % e.code
+        except Exception:
+            error = traceback.format_exc()
+            log.write(error)
+        finally:
+            sys.stdout = stdout
+            sys.argv = argv
+            os.chdir(cwd)
+    return (variant, error, time.time() - started)
+
+# Duration (ms), number of notes and peak notes per {window_ms} of a track directory's sequence
+def getStats(track_dir, window_ms=DENSITY_WINDOW_MS):
+    milliseconds = np.array([step['milliseconds'] for step in stream.readTrackSteps(track_dir)], dtype=np.int64)
+    if len(milliseconds) <= 0:
+        return (0, 0, 0)
+    elapsed = np.cumsum(milliseconds)
+    # notes from each note to {window_ms} after it
+    counts = np.searchsorted(elapsed, elapsed + window_ms, side='left') - np.arange(len(elapsed))
+    return (int(elapsed[-1]), len(elapsed), int(counts.max()))
+
+# Build every variant of a stage's grid into {output_dir}/<variant>, in {processes} processes
+# Returns a list of results, one per variant, in grid order
+def sweep(stage, grid, output_dir=OUTPUT_DIR, processes=None, log=sys.stdout, root_dir=ROOT_DIR):
+    variants = getVariants(grid)
+    tasks = []
+    for variant, settings in variants:
+        track_dir = makeVariant(stage, os.path.join(output_dir, variant), settings, root_dir)
+        tasks.append((variant, track_dir, os.path.join(track_dir, stage['script'])))
+    # the first variant parses the data; the pool is forked after it so every worker has the parsed arrays
+    finished = [runVariant(tasks[0])]
+    log.write('Built %s in %ss%s\n' % (finished[0][0], round(finished[0][2], 2), ', FAILED' if finished[0][1] else ''))
+    if len(tasks) > 1:
+        pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+        try:
+            for result in pool.imap_unordered(runVariant, tasks[1:]):
+                log.write('Built %s in %ss%s\n' % (result[0], round(result[2], 2), ', FAILED' if result[1] else ''))
+                finished.append(result)
+        finally:
+            pool.close()
+            pool.join()
+    finished = dict([(result[0], result) for result in finished])
+    results = []
+    for (variant, settings), task in zip(variants, tasks):
+        name, error, seconds = finished[variant]
+        duration_ms, notes, peak = getStats(task[1]) if not error else (None, None, None)
+        results.append({'variant': variant, 'settings': settings, 'error': error, 'seconds': seconds, 'duration_ms': duration_ms, 'notes': notes, 'peak_notes_per_second': peak})
+    return results
+
+# Write a sweep's summary, one row per variant
+def writeSummary(filename, grid, results):
+    with open(filename, 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(['Variant'] + [name for name, values in grid] + ['Duration', 'Notes', 'Peak Notes Per Second', 'Build Seconds', 'Error'])
+        for result in results:
+            duration = ''
+            if result['duration_ms'] is not None:
+                duration = time.strftime('%M:%S', time.gmtime(int(result['duration_ms']/1000))) + '.%03d' % (result['duration_ms'] % 1000)
+            error = result['error'].strip().splitlines()[-1] if result['error'] else ''
+            w.writerow([result['variant']] + [result['settings'][name] for name, values in grid] + [duration, result['notes'], result['peak_notes_per_second'], round(result['seconds'], 3), error])
+        f.seek(-2, os.SEEK_END) # remove newline
+        f.truncate()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('STAGE', help="Track or stage to sweep, e.g. 03_smog")
+    parser.add_argument('-grid', dest="GRID", nargs='+', required=True, help="Config values to sweep, e.g. BPM=100,110,120 GAIN=0.3,0.4")
+    parser.add_argument('-p', dest="PROCESSES", default=0, type=int, help="Variants to build at a time; 0 for one per CPU")
+    parser.add_argument('-o', dest="OUTPUT_DIR", default="", help="Directory to write the variants to (default: output/sweeps/<track>)")
+    args = parser.parse_args()
+
+    stage = getStage(args.STAGE)
+    grid = parseGrid(args.GRID)
+    output_dir = args.OUTPUT_DIR or os.path.join(OUTPUT_DIR, stage['track'])
+    started = time.time()
+    results = sweep(stage, grid, output_dir, args.PROCESSES or None)
+    summary_file = os.path.join(output_dir, SUMMARY_FILE)
+    writeSummary(summary_file, grid, results)
+    failed = len([r for r in results if r['error']])
+    print('Built %s variants in %ss (%s failed); summary: %s' % (len(results), round(time.time() - started, 1), failed, summary_file))
+    if failed > 0:
+        sys.exit(1)
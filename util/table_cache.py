@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+##
+# Compiled columnar cache of the tracks' input files (instruments.csv, data CSVs and JSON)
+# The first time a file is read it's parsed as usual, then its columns are stored typed (int64, float64 or text)
+# in a .npz file in the cache directory; later reads load the arrays instead of tokenizing the text again.
+# A cached file is used while its source's size and modification time are unchanged, or its contents hash the same.
+# Arrays a process has loaded are kept in memory too, so a process that builds several variants of a track (and
+# processes forked from it, see sweep.py) only loads them once.
+# A CSV column is only typed as int or float if every value converts back to exactly the text it came from,
+# so the cache can give back the text of every row as well as typed columns.
+# Usage (from a track directory):
+#   with open(INSTRUMENTS_INPUT_FILE, 'rb') as f:
+#       r = table_cache.reader(f, delimiter='\t') # instead of csv.reader; rows are the same text csv.reader gives
+#   columns = table_cache.readColumns('data/eeg.csv') # dict of typed arrays, by header name
+#   for ms, s1 in table_cache.getRows(columns, [('Time', int), ('S1', float)]): # for loops over large files
+#   years = table_cache.loadJson(LAND_LOSS_INPUT_FILE) # instead of json.load, for lists of flat objects
+##
+
+import csv
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import tracing
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'tables')
+
+loaded = {} # cache file => ((size, mtime) of its source, arrays)
+
+# Hash of a file's contents
+def getHash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Cache file of a source file; links to a file share its cache
+def getCacheFile(filename, kind, cache_dir=CACHE_DIR):
+    key = hashlib.sha1((os.path.realpath(filename) + '|' + kind).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.npz')
+
+# Load a cached file's arrays if it's still valid for its source, else None
+def loadCache(filename, kind, cache_dir=CACHE_DIR):
+    cache_file = getCacheFile(filename, kind, cache_dir)
+    stat = os.stat(filename)
+    if cache_file in loaded and loaded[cache_file][0] == (stat.st_size, stat.st_mtime):
+        return loaded[cache_file][1]
+    if not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as data:
+        arrays = dict([(name, data[name]) for name in data.files])
+    if int(arrays['size']) == stat.st_size and float(arrays['mtime']) == stat.st_mtime:
+        loaded[cache_file] = ((stat.st_size, stat.st_mtime), arrays)
+        return arrays
+    # touched but not changed, e.g. checked out again
+    if int(arrays['size']) == stat.st_size and str(arrays['hash']) == getHash(filename):
+        saveCache(filename, kind, arrays, cache_dir)
+        return arrays
+    return None
+
+# Cache a source file's arrays, with what's needed to tell whether it has changed since
+def saveCache(filename, kind, arrays, cache_dir=CACHE_DIR):
+    stat = os.stat(filename)
+    arrays = dict(arrays)
+    arrays['size'] = np.array(stat.st_size)
+    arrays['mtime'] = np.array(stat.st_mtime)
+    arrays['hash'] = np.array(getHash(filename))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write atomically, so scripts running at the same time never load half a file
+    fd, temporary = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(temporary, getCacheFile(filename, kind, cache_dir))
+    loaded[getCacheFile(filename, kind, cache_dir)] = ((stat.st_size, stat.st_mtime), arrays)
+
+# Type a column of text values: int64 or float64 if every value converts back to its text exactly, else text
+def toColumn(values):
+    try:
+        ints = map(int, values)
+        if map(str, ints) == values:
+            return np.array(ints, dtype=np.int64)
+    except (ValueError, OverflowError):
+        pass
+    try:
+        floats = map(float, values)
+        if map(repr, floats) == values:
+            return np.array(floats, dtype=np.float64)
+    except ValueError:
+        pass
+    return np.array(values, dtype=object).astype(str)
+
+# Parse a CSV file into arrays: its first row as text and a typed array per column of the other rows
+# Returns None if rows have different numbers of fields, which can't be stored as columns
+@tracing.traced()
+def compileCsv(f, delimiter):
+    rows = list(csv.reader(f, delimiter=delimiter))
+    if len(rows) <= 0:
+        return {'header': np.array([], dtype=str), 'columns': np.array(0)}
+    width = len(rows[0])
+    if any([len(row) != width for row in rows]):
+        return None
+    arrays = {'header': np.array(rows[0], dtype=str), 'columns': np.array(width)}
+    for i in range(width):
+        arrays['column_%s' % i] = toColumn([row[i] for row in rows[1:]])
+    return arrays
+
+# Arrays of a CSV file, from the cache if it's valid, else parsed (and cached)
+# Returns None (and nothing is cached) if the file can't be stored as columns
+def getCsvArrays(f, delimiter=','):
+    kind = 'csv' + delimiter
+    arrays = loadCache(f.name, kind)
+    if arrays is None:
+        arrays = compileCsv(f, delimiter)
+        if arrays is not None:
+            saveCache(f.name, kind, arrays)
+    return arrays
+
+# Text of a typed column, i.e. the text every value was parsed from (see toColumn)
+def toText(column):
+    if column.dtype.kind == 'i':
+        return [str(v) for v in column.tolist()]
+    if column.dtype.kind == 'f':
+        return [repr(v) for v in column.tolist()]
+    return column.tolist()
+
+# Drop-in replacement for csv.reader(f, delimiter=...) on an open file: iterates over rows of text, loading the
+# columns from the cache when it's valid
+def reader(f, delimiter=','):
+    arrays = getCsvArrays(f, delimiter)
+    if arrays is None:
+        f.seek(0)
+        return csv.reader(f, delimiter=delimiter)
+    header = [arrays['header'].tolist()] if len(arrays['header']) > 0 else []
+    columns = [toText(arrays['column_%s' % i]) for i in range(int(arrays['columns']))]
+    return iter(header + [list(row) for row in zip(*columns)])
+
+# Columns of a CSV file with a header row, as a dict of header name => typed array
+def readColumns(filename, delimiter=','):
+    with open(filename, 'rb') as f:
+        arrays = getCsvArrays(f, delimiter)
+    if arrays is None:
+        raise ValueError('Rows of %s have different numbers of fields' % filename)
+    return dict([(name, arrays['column_%s' % i]) for i, name in enumerate(arrays['header'].tolist())])
+
+# Values of a column (see readColumns) as {type} (str, int or float), i.e. the text of each field or what int() or
+# float() of it gives; a column typed as the script wants it is taken as it is, without converting any text
+# A type of None takes the column as it's typed, for fields a script doesn't use
+def getValues(column, type):
+    if type is None:
+        return column.tolist()
+    if type is str:
+        return toText(column)
+    if type is int and column.dtype.kind == 'i':
+        return column.tolist()
+    if type is float and column.dtype.kind in 'if':
+        return column.astype(np.float64).tolist()
+    return [type(v) for v in toText(column)]
+
+# Rows of the named columns (see readColumns) for a script's loop over a file, each value as the column's type
+#   types: list of (header name, str, int, float or None)
+def getRows(columns, types):
+    return zip(*[getValues(columns[name], type) for name, type in types])
+
+# Type a JSON column: int64, float64 or unicode text for scalars; lists of numbers are stored flat, with offsets
+# Returns a dict of arrays, or None if the values can't be stored as a column and read back exactly
+def toJsonColumn(values):
+    if all([isinstance(v, list) for v in values]):
+        flat = [x for v in values for x in v]
+        column = toJsonColumn(flat) if len(flat) > 0 else {'values': np.zeros(0, dtype=np.int64)}
+        if column is None or 'offsets' in column:
+            return None
+        column['offsets'] = np.cumsum([0] + [len(v) for v in values]).astype(np.int64)
+        return column
+    if all([isinstance(v, (int, long)) and not isinstance(v, bool) for v in values]):
+        if all([-2**63 <= v < 2**63 for v in values]):
+            return {'values': np.array(values, dtype=np.int64)}
+        return None
+    if all([isinstance(v, float) for v in values]):
+        return {'values': np.array(values, dtype=np.float64)}
+    if all([isinstance(v, unicode) for v in values]) and not any([v.endswith(u'\0') for v in values]):
+        return {'values': np.array(values, dtype=np.unicode_)}
+    return None
+
+# Parse a JSON file that holds a list of flat objects (scalar or list-of-number values) into columns
+# Returns None if it holds anything else, which is loaded as usual
+@tracing.traced()
+def compileJson(f):
+    items = json.load(f)
+    if not isinstance(items, list) or not all([isinstance(item, dict) for item in items]):
+        return (items, None)
+    keys = sorted(items[0].keys()) if len(items) > 0 else []
+    if any([sorted(item.keys()) != keys for item in items]):
+        return (items, None)
+    arrays = {'keys': np.array(keys, dtype=np.unicode_), 'count': np.array(len(items))}
+    for i, key in enumerate(keys):
+        column = toJsonColumn([item[key] for item in items])
+        if column is None:
+            return (items, None)
+        for name, values in column.items():
+            arrays['%s_%s' % (name, i)] = values
+    return (items, arrays)
+
+# Drop-in replacement for json.load(f) on an open file, loading lists of flat objects from the cache when it's valid
+def loadJson(f):
+    arrays = loadCache(f.name, 'json')
+    if arrays is None:
+        items, arrays = compileJson(f)
+        if arrays is not None:
+            saveCache(f.name, 'json', arrays)
+        return items
+    keys = arrays['keys'].tolist()
+    columns = []
+    for i in range(len(keys)):
+        values = arrays['values_%s' % i].tolist()
+        if 'offsets_%s' % i in arrays:
+            offsets = arrays['offsets_%s' % i].tolist()
+            values = [values[offsets[j]:offsets[j+1]] for j in range(len(offsets) - 1)]
+        columns.append(values)
+    return [dict(zip(keys, row)) for row in zip(*columns)] if len(keys) > 0 else [{} for j in range(int(arrays['count']))]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+##
+# Integer timeline for the track scripts
+# Times are counted in whole ticks of a grid (e.g. ROUND_TO_NEAREST ms, i.e. a division of a beat) held in int64,
+# so beats add up exactly however many of them a track has; they're turned into ms only where notes are placed.
+# Rounding is python's round() (halves away from zero) done a whole array at a time, so every tick is the same
+# one the tracks' float arithmetic (1.0 * round(1.0 * n / nearest) * nearest) has always given.
+# Usage:
+#   tick_ms = timeline.getTickMs(BEAT_MS, DIVISIONS_PER_BEAT) # the same as ROUND_TO_NEAREST
+#   ticks = timeline.toTicks(beat_ms, tick_ms)
+#   elapsed_ms = timeline.getOnsets(start_ms, timeline.toMs(ticks, tick_ms))
+##
+
+import numpy as np
+
+# Round every value like python's round(value), i.e. halves away from zero; returns int64
+def roundHalfAway(values):
+    values = np.asarray(values, dtype=np.float64)
+    magnitude = np.abs(values)
+    whole = np.floor(magnitude)
+    # magnitude - whole is exact, so a value just under a half never rounds up
+    rounded = whole + (magnitude - whole >= 0.5)
+    return (np.sign(values) * rounded).astype(np.int64)
+
+# Whole ms of a tick: {divisions_per_beat} ticks to a beat of {beat_ms}, rounded as the tracks' ROUND_TO_NEAREST is
+def getTickMs(beat_ms, divisions_per_beat):
+    return int(round(1.0 * beat_ms / divisions_per_beat))
+
+# Nearest tick of every ms
+def toTicks(ms, tick_ms):
+    return roundHalfAway(np.asarray(ms, dtype=np.float64) / tick_ms)
+
+# Ms of every tick; exact when a tick is a whole number of ms, else truncated to the ms
+def toMs(ticks, tick_ms):
+    ticks = np.asarray(ticks, dtype=np.int64)
+    if tick_ms == int(tick_ms):
+        return ticks * int(tick_ms)
+    return np.trunc(ticks * float(tick_ms)).astype(np.int64)
+
+# Whole ms each of {steps} (ms) starts at when they're played back to back from {start_ms}, i.e. int(start_ms + the
+# steps before it), added up exactly in int64; start_ms may be a fraction of a ms
+def getOnsets(start_ms, steps):
+    steps = np.asarray(steps, dtype=np.int64)
+    if len(steps) <= 0:
+        return np.zeros(0, dtype=np.int64)
+    start = np.floor(start_ms)
+    fraction = start_ms - start
+    onsets = int(start) + np.concatenate(([0], np.cumsum(steps)[:-1]))
+    # int() rounds toward zero, so a fraction of a ms before zero rounds up
+    if fraction > 0:
+        onsets = onsets + (onsets < 0)
+    return onsets
+
+# Whether every value is a whole number
+def isWhole(values):
+    values = np.asarray(values)
+    return values.dtype.kind in 'iu' or bool(np.all(np.floor(values) == values))
+
+# int(a / b) of every a, i.e. rounded toward zero, in exact integer arithmetic when a and b are whole numbers
+def truncDivide(a, b):
+    a = np.asarray(a)
+    if isWhole(a) and isWhole(b) and b != 0:
+        a = a.astype(np.int64)
+        b = int(b)
+        quotient = np.abs(a) // abs(b)
+        return np.where((a < 0) != (b < 0), -quotient, quotient)
+    return np.trunc(a / float(b)).astype(np.int64)
+
+# floor(a / b) of every a, in exact integer arithmetic when a and b are whole numbers
+def floorDivide(a, b):
+    a = np.asarray(a)
+    if isWhole(a) and isWhole(b) and b != 0:
+        return a.astype(np.int64) // int(b)
+    return np.floor(1.0 * a / b).astype(np.int64)
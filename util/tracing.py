@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+##
+# Timing and memory instrumentation for the build stages, written as a Chrome trace (load it in chrome://tracing
+# or https://ui.perfetto.dev) so you can see where a build's time goes without adding print statements.
+# Each stage records its wall time, CPU time, the process's peak memory when it ended (and how much it raised it),
+# the peak of memory traced by tracemalloc where Python has it, and a count of the items it handled.
+# Nothing is recorded until tracing is started, so instrumented code runs as before.
+# Usage (from a track directory):
+#   tracing.start('data/trace.json') # or set TRACE_DIR to trace every script into that directory
+#   tracing.phase('load') # flat scripts: ends the last phase and starts the next
+#   tracing.count(len(readings))
+#   with tracing.stage('write sequence') as stage: # nested stages
+#       stage.count(len(sequence))
+#   @tracing.traced('sort') # functions
+##
+
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+TRACE_DIR_VARIABLE = 'TRACE_DIR' # environment variable of a directory to write every script's trace to
+
+events = []
+trace_file = None
+enabled = False
+current_phase = None
+
+# Microseconds since the epoch, so traces of different processes line up when merged
+def getTimestamp():
+    return int(time.time() * 1000000)
+
+# Peak memory of this process so far in MB (ru_maxrss is in KB on Linux and bytes on macOS)
+def getPeakMb(usage):
+    return usage.ru_maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else usage.ru_maxrss / 1024.0
+
+# A timed stage; recorded as a complete event when it ends
+class Stage(object):
+
+    def __init__(self, name, category='stage'):
+        self.name = name
+        self.category = category
+        self.items = None
+
+    def start(self):
+        if not enabled:
+            return self
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.started = getTimestamp()
+        self.cpu = usage.ru_utime + usage.ru_stime
+        self.peak_mb = getPeakMb(usage)
+        return self
+
+    def count(self, items):
+        self.items = (self.items or 0) + items
+
+    def end(self):
+        if not enabled or not hasattr(self, 'started'):
+            return
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        peak_mb = getPeakMb(usage)
+        args = {
+            'cpu_ms': round((usage.ru_utime + usage.ru_stime - self.cpu) * 1000, 3),
+            'peak_mb': round(peak_mb, 1),
+            'peak_increase_mb': round(peak_mb - self.peak_mb, 1)
+        }
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            args['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0), 1)
+        if self.items is not None:
+            args['items'] = self.items
+        now = getTimestamp()
+        events.append({'name': self.name, 'cat': self.category, 'ph': 'X', 'ts': self.started, 'dur': now - self.started, 'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': args})
+        events.append({'name': 'memory', 'ph': 'C', 'ts': now, 'pid': os.getpid(), 'args': {'peak_mb': args['peak_mb']}})
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end()
+        return False
+
+# Context manager for a stage, e.g. with tracing.stage('sort') as stage:
+def stage(name, category='stage'):
+    return Stage(name, category)
+
+# Decorator that traces every call of a function as a stage
+def traced(name=None):
+    def decorate(function):
+        label = name or function.__name__
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Stage(label, 'function'):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorate
+
+# End the current phase of a script (if any) and start the next one
+def phase(name):
+    global current_phase
+    if current_phase is not None:
+        current_phase.end()
+    current_phase = Stage(name, 'phase').start() if name else None
+
+# Count items handled by the current phase
+def count(items):
+    if current_phase is not None:
+        current_phase.count(items)
+
+# Start recording; the trace is written to {filename} when the script exits
+def start(filename):
+    global enabled, trace_file
+    if enabled:
+        return
+    enabled = True
+    trace_file = filename
+    if tracemalloc is not None:
+        tracemalloc.start()
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': getProcessName()}})
+    atexit.register(save)
+
+# Name a script's process in the trace, e.g. 03_smog/smog
+def getProcessName():
+    script = os.path.abspath(sys.argv[0]) if sys.argv and sys.argv[0] else 'python'
+    return os.path.basename(os.path.dirname(script)) + '/' + os.path.splitext(os.path.basename(script))[0]
+
+# Write the trace file, ending the current phase
+def save():
+    if not enabled or not trace_file:
+        return
+    phase(None)
+    directory = os.path.dirname(trace_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+# Combine trace files (e.g. of every stage of a build) into one
+def merge(filenames, extra_events=[]):
+    merged = list(extra_events)
+    for filename in filenames:
+        with open(filename) as f:
+            merged += json.load(f)['traceEvents']
+    return {'traceEvents': merged, 'displayTimeUnit': 'ms'}
+
+# Scripts run with TRACE_DIR set trace themselves into that directory
+if os.environ.get(TRACE_DIR_VARIABLE):
+    start(os.path.join(os.environ[TRACE_DIR_VARIABLE], '%s_%s.json' % (getProcessName().replace('/', '_'), os.getpid())))
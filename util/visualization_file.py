@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+##
+# Chunked visualization files: a compact alternative to the single JSON files the visualizations load
+# Rows (dicts, or lists with column names) are stored a column at a time and split into windows of time, so a
+# visualization can start drawing once it has the index and the first chunk instead of the whole file.
+#
+# Layout, for e.g. visualization/data/pairs.json:
+#   pairs.index.json  {"version": 1, "meta": {...}, "count": rows, "time": time column or null, "chunk_ms": ms,
+#                      "columns": [{"name", "type", ["scale"], ["values"]}...],
+#                      "chunks": [{"file": "pairs.0000.json.gz", "start": first row, "count": rows,
+#                                  "start_ms", "stop_ms"}...]}
+#   pairs.0000.json.gz  {"columns": [one list per column, in the index's order]} (gzipped unless compress=False)
+# Column types:
+#   int      integers, delta-encoded (the first value, then the difference from the previous one)
+#   decimal  numbers with at most 6 decimal places, stored as delta-encoded integers of value * scale;
+#            decode with value = integer / scale, which gives back the exact number
+#   text     text with few distinct values, stored as indices into the index's "values"
+#   json     anything else (text, other numbers, lists, objects), as is
+# Every chunk decodes on its own: deltas start again at each chunk's first row.
+# Usage (from a track directory):
+#   visualization_file.write('visualization/data/pairs.json', pairs, meta={'min_year': min_year}, times='start_ms')
+#   rows, meta = visualization_file.read('visualization/data/pairs.json')
+##
+
+import gzip
+import json
+import os
+
+import numpy as np
+
+VERSION = 1
+CHUNK_MS = 30000 # ms of rows per chunk
+CHUNK_ROWS = 1000 # rows per chunk, when rows have no time
+MAX_DECIMALS = 6
+MAX_INT = 2 ** 53 # integers a visualization's doubles hold exactly
+
+# Index and chunk filenames of a visualization file, e.g. data/pairs.json => data/pairs.index.json
+def getIndexFile(filename):
+    return os.path.splitext(filename)[0] + '.index.json'
+
+def getChunkFile(filename, chunk, compress=True):
+    return os.path.splitext(filename)[0] + '.%04d.json' % chunk + ('.gz' if compress else '')
+
+# Whether a value is an int (and not a bool, which JSON keeps as true/false)
+def isInt(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+# Smallest power of ten that turns every value into an integer it can be decoded from exactly, or None
+def getScale(values):
+    for decimals in range(MAX_DECIMALS + 1):
+        scale = 10 ** decimals
+        if all([abs(v * scale) < MAX_INT and float(round(v * scale)) / scale == v for v in values]):
+            return scale
+    return None
+
+# How to store a column of values (see Column types above)
+def getColumn(name, values):
+    column = {'name': name, 'type': 'json'}
+    if all([isInt(v) and abs(v) < MAX_INT for v in values]):
+        column['type'] = 'int'
+    elif all([isinstance(v, float) or (isInt(v) and abs(v) < MAX_INT) for v in values]):
+        scale = getScale(values)
+        if scale is not None:
+            column['type'] = 'decimal'
+            column['scale'] = scale
+    elif all([isinstance(v, basestring) for v in values]):
+        distinct = sorted(set(values))
+        if len(distinct) * 2 <= len(values):
+            column['type'] = 'text'
+            column['values'] = distinct
+    return column
+
+# Delta-encode a column of integers
+def toDeltas(values):
+    values = np.array(values, dtype=np.int64)
+    return np.diff(values, prepend=0).tolist() if len(values) > 0 else []
+
+# Encode a chunk's values of a column
+def encode(column, values):
+    if column['type'] == 'int':
+        return toDeltas(values)
+    if column['type'] == 'decimal':
+        return toDeltas([int(round(v * column['scale'])) for v in values])
+    if column['type'] == 'text':
+        codes = dict([(value, i) for i, value in enumerate(column['values'])])
+        return [codes[v] for v in values]
+    return list(values)
+
+# Decode a chunk's values of a column
+def decode(column, values):
+    if column['type'] == 'int':
+        return np.cumsum(np.array(values, dtype=np.int64)).tolist()
+    if column['type'] == 'decimal':
+        scale = float(column['scale'])
+        return [v / scale for v in np.cumsum(np.array(values, dtype=np.int64)).tolist()]
+    if column['type'] == 'text':
+        return [column['values'][i] for i in values]
+    return values
+
+# Split rows into chunks of {chunk_ms} by their times, or of {CHUNK_ROWS} rows if they have none;
+# returns a list of (first row, rows, start ms, stop ms)
+def getChunks(times, count, chunk_ms=CHUNK_MS):
+    if times is None or any([b < a for a, b in zip(times, times[1:])]):
+        return [(start, min(CHUNK_ROWS, count - start), None, None) for start in range(0, count, CHUNK_ROWS)]
+    windows = [int(t // chunk_ms) for t in times]
+    chunks = []
+    start = 0
+    for i in range(1, count + 1):
+        if i >= count or windows[i] != windows[start]:
+            chunks.append((start, i - start, windows[start] * chunk_ms, (windows[start] + 1) * chunk_ms))
+            start = i
+    return chunks
+
+# Write a JSON file, gzipped if {compress}; gzip's header has no time in it, so unchanged data writes the same bytes
+def writeJson(filename, data, compress=True):
+    text = json.dumps(data, separators=(',', ':'))
+    if compress:
+        with open(filename, 'wb') as raw:
+            with gzip.GzipFile(os.path.basename(filename), 'wb', 9, raw, mtime=0) as f:
+                f.write(text)
+    else:
+        with open(filename, 'wb') as f:
+            f.write(text)
+
+def readJson(filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        return json.load(f)
+
+# Write {rows} (dicts, or lists named by {names}) as a chunked visualization file, with {meta} in its index
+# {times}: a column of each row's ms, or a list of them, to split chunks by time; returns the files written
+def write(filename, rows, meta={}, names=None, times=None, chunk_ms=CHUNK_MS, compress=True):
+    if names is None:
+        names = sorted(rows[0].keys()) if len(rows) > 0 else []
+        if any([sorted(row.keys()) != names for row in rows]):
+            raise ValueError('Rows of %s have different keys' % filename)
+        values = [[row[name] for row in rows] for name in names]
+    else:
+        if any([len(row) != len(names) for row in rows]):
+            raise ValueError('Rows of %s have different lengths than their %s names' % (filename, len(names)))
+        values = [[row[i] for row in rows] for i in range(len(names))]
+    time_column = times if isinstance(times, basestring) else None
+    if time_column is not None:
+        times = values[names.index(time_column)]
+    columns = [getColumn(name, column) for name, column in zip(names, values)]
+    index = {
+        'version': VERSION,
+        'meta': meta,
+        'count': len(rows),
+        'time': time_column,
+        'chunk_ms': chunk_ms if times is not None else None,
+        'columns': columns,
+        'chunks': []
+    }
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # don't leave chunks of an earlier, longer file
+    for compressed in [True, False]:
+        chunk = 0
+        while os.path.exists(getChunkFile(filename, chunk, compressed)):
+            os.remove(getChunkFile(filename, chunk, compressed))
+            chunk += 1
+    files = []
+    for chunk, (start, count, start_ms, stop_ms) in enumerate(getChunks(times, len(rows), chunk_ms)):
+        chunk_file = getChunkFile(filename, chunk, compress)
+        data = [encode(column, values[i][start:start+count]) for i, column in enumerate(columns)]
+        writeJson(chunk_file, {'columns': data}, compress)
+        index['chunks'].append({'file': os.path.basename(chunk_file), 'start': start, 'count': count, 'start_ms': start_ms, 'stop_ms': stop_ms})
+        files.append(chunk_file)
+    writeJson(getIndexFile(filename), index, False)
+    return [getIndexFile(filename)] + files
+
+# Read a chunk of a chunked visualization file as rows
+def readChunk(filename, index, chunk):
+    data = readJson(os.path.join(os.path.dirname(filename), index['chunks'][chunk]['file']))
+    values = [decode(column, column_values) for column, column_values in zip(index['columns'], data['columns'])]
+    return zip(*values) if len(values) > 0 else [[] for i in range(index['chunks'][chunk]['count'])]
+
+# Read a chunked visualization file; returns its rows (dicts, keyed by column name) and meta
+def read(filename):
+    index = readJson(getIndexFile(filename))
+    names = [column['name'] for column in index['columns']]
+    rows = []
+    for chunk in range(len(index['chunks'])):
+        rows += [dict(zip(names, row)) for row in readChunk(filename, index, chunk)]
+    return (rows, index['meta'])
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+##
+# Voice analysis for the players' sample buffers
+# A player plays each instrument on a few SndBufs in turn, so a note is cut off when its buffer comes round again
+# while it's still sounding. From how long each instrument's sample plays (read from its WAV header, at the note's
+# rate) this works out how many buffers each instrument needs so none of its notes is cut off: the most notes that
+# start, in turn, while one of them is still sounding. Tracks write the counts into ck_instruments, on each
+# instrument's index line (e.g. "12,3"), and the players allocate that many buffers for it.
+# Usage (from a track directory, once the sequence is sorted):
+#   buffers = voices.getBufferCounts(sequence, instruments)
+#   w.writerow([index, buffers[index]])
+##
+
+import os
+
+import numpy as np
+
+import wav_file
+
+MAX_BUFFERS = 32 # most buffers an instrument gets, however long its notes ring
+
+# Ms each sample file plays for at a rate of 1, from its WAV header; returns a dict of file => ms
+def getSampleDurations(files, base_dir=''):
+    durations = {}
+    for filename in files:
+        if filename not in durations:
+            sample_rate, channels, frames = wav_file.readHeader(os.path.join(base_dir, filename))
+            durations[filename] = 1000.0 * frames / sample_rate
+    return durations
+
+# Buffers each instrument needs so that no note is cut off: for every note, the notes of its instrument that start,
+# in turn, from it until it stops sounding
+#   instrument_index, elapsed_ms: every note in the order it's played; durations_ms: how long each note sounds
+# Returns an array of buffers per instrument (at least 1, at most {max_buffers})
+def getVoices(instrument_index, elapsed_ms, durations_ms, count, max_buffers=MAX_BUFFERS):
+    instrument_index = np.asarray(instrument_index, dtype=np.int64)
+    elapsed_ms = np.asarray(elapsed_ms, dtype=np.int64)
+    buffers = np.ones(count, dtype=np.int64)
+    if len(elapsed_ms) <= 0:
+        return buffers
+    # every instrument's notes in the order they're played, as one ascending key of instrument, then ms
+    order = np.argsort(instrument_index, kind='mergesort')
+    ends = np.ceil(elapsed_ms + np.asarray(durations_ms, dtype=np.float64)).astype(np.int64)
+    span = int(max(np.max(ends), np.max(elapsed_ms))) + 1
+    keys = instrument_index[order] * span + elapsed_ms[order]
+    # notes that start before each note's end, from it on
+    needed = np.searchsorted(keys, instrument_index[order] * span + ends[order], side='left') - np.arange(len(order))
+    np.maximum.at(buffers, instrument_index[order], needed)
+    return np.minimum(buffers, max_buffers)
+
+# Every note of a sorted sequence (see SequenceBuffer) in the order it's played, and how long it sounds
+#   instruments: the track's instruments, each with its sample 'file'
+# Returns (instrument_index, elapsed_ms, durations_ms) arrays
+def getNotes(sequence, instruments, base_dir=''):
+    sample_durations = getSampleDurations([instrument['file'] for instrument in instruments], base_dir)
+    file_durations = np.array([sample_durations[instrument['file']] for instrument in instruments], dtype=np.float64)
+    blocks = list(sequence.merged())
+    if len(blocks) <= 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
+    instrument_index = np.concatenate([block['instrument_index'] for block in blocks]).astype(np.int64)
+    elapsed_ms = np.concatenate([block['elapsed_ms'] for block in blocks]).astype(np.int64)
+    durations_ms = file_durations[instrument_index]
+    if 'rate' in blocks[0]:
+        # a faster note ends sooner; a note played backwards from the start ends at once
+        rates = np.concatenate([block['rate'] for block in blocks]).astype(np.float64)
+        durations_ms = np.where(rates > 0, durations_ms / np.where(rates > 0, rates, 1), 0)
+    return (instrument_index, elapsed_ms, durations_ms)
+
+# Buffers each instrument of a sorted sequence (see SequenceBuffer) needs, in order of instrument
+#   instruments: the track's instruments, each with its sample 'file'
+def getBufferCounts(sequence, instruments, base_dir='', max_buffers=MAX_BUFFERS):
+    instrument_index, elapsed_ms, durations_ms = getNotes(sequence, instruments, base_dir)
+    if len(elapsed_ms) <= 0:
+        return [1] * len(instruments)
+    buffers = getVoices(instrument_index, elapsed_ms, durations_ms, len(instruments), max_buffers)
+    return buffers.tolist()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+##
+# Minimal WAV file reading and writing with NumPy
+# Reads the PCM (8, 16, 24 and 32-bit) and IEEE float (32 and 64-bit) files found in the instruments/ directories,
+# which the standard wave module can't all read (it has no float support), into float32 arrays of frames x channels.
+# Usage:
+#   sample_rate, frames = wav_file.readWav('instruments/kk_0-21-146.wav')
+#   sample_rate, channels, frame_count = wav_file.readHeader('instruments/kk_0-21-146.wav') # without reading the audio
+#   wav_file.writeWav('data/render.wav', sample_rate, frames)
+##
+
+import os
+import struct
+import wave
+
+import numpy as np
+
+FORMAT_PCM = 1
+FORMAT_FLOAT = 3
+FORMAT_EXTENSIBLE = 0xFFFE
+
+# Decode PCM or float data to float32 in [-1, 1]
+def toFloats(data, format_tag, bits):
+    if format_tag == FORMAT_FLOAT and bits in (32, 64):
+        return np.frombuffer(data, dtype='<f%s' % (bits // 8)).astype(np.float32)
+    if format_tag != FORMAT_PCM:
+        raise ValueError('Unsupported WAV format: %s' % format_tag)
+    if bits == 8:
+        return (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128
+    if bits == 16:
+        return np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768
+    if bits == 24:
+        raw = np.frombuffer(data[:len(data) - len(data) % 3], dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values = np.where(values >= 1 << 23, values - (1 << 24), values)
+        return values.astype(np.float32) / (1 << 23)
+    if bits == 32:
+        return np.frombuffer(data, dtype='<i4').astype(np.float32) / (1 << 31)
+    raise ValueError('Unsupported WAV bit depth: %s' % bits)
+
+# Read a WAV file; returns (sample rate, float32 array of frames x channels)
+def readWav(filename):
+    with open(filename, 'rb') as f:
+        contents = f.read()
+    if contents[:4] != b'RIFF' or contents[8:12] != b'WAVE':
+        raise ValueError('Not a WAV file: %s' % filename)
+    fmt = None
+    data = None
+    position = 12
+    while position + 8 <= len(contents):
+        chunk_id = contents[position:position+4]
+        size = struct.unpack('<I', contents[position+4:position+8])[0]
+        body = contents[position+8:position+8+size]
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', body[:16])
+            if fmt[0] == FORMAT_EXTENSIBLE and len(body) >= 26:
+                fmt = (struct.unpack('<H', body[24:26])[0],) + fmt[1:]
+        elif chunk_id == b'data':
+            data = body
+        position += 8 + size + size % 2
+    if fmt is None or data is None:
+        raise ValueError('WAV file has no format or data: %s' % filename)
+    format_tag, channels, sample_rate, byte_rate, block_align, bits = fmt
+    data = data[:len(data) - len(data) % block_align]
+    frames = toFloats(data, format_tag, bits).reshape(-1, channels)
+    return (sample_rate, frames)
+
+# Read a WAV file's format without its audio; returns (sample rate, channels, frames)
+def readHeader(filename):
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        header = f.read(12)
+        if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ValueError('Not a WAV file: %s' % filename)
+        fmt = None
+        data_size = None
+        position = 12
+        while position + 8 <= file_size:
+            f.seek(position)
+            chunk = f.read(8)
+            chunk_id = chunk[:4]
+            size = struct.unpack('<I', chunk[4:8])[0]
+            if chunk_id == b'fmt ':
+                body = f.read(size)
+                fmt = struct.unpack('<HHIIHH', body[:16])
+            elif chunk_id == b'data':
+                # like readWav, a truncated file has what's left of its data
+                data_size = min(size, file_size - position - 8)
+            position += 8 + size + size % 2
+    if fmt is None or data_size is None:
+        raise ValueError('WAV file has no format or data: %s' % filename)
+    format_tag, channels, sample_rate, byte_rate, block_align, bits = fmt
+    return (sample_rate, channels, data_size // block_align)
+
+# Write float frames (frames, or frames x channels) to a 16-bit PCM WAV file; values outside [-1, 1] are clipped
+def writeWav(filename, sample_rate, frames):
+    frames = np.asarray(frames, dtype=np.float32)
+    if frames.ndim < 2:
+        frames = frames[:, np.newaxis]
+    values = np.round(np.clip(frames, -1.0, 1.0) * 32767).astype('<i2')
+    f = wave.open(filename, 'wb')
+    try:
+        f.setnchannels(frames.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(values.tobytes())
+    finally:
+        f.close()